@@ -0,0 +1,280 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask import Response, g, request
+
+from metrics import format_value, when_sent
+
+
+def parse_limits(value):
+    '''
+    reads "endpoint=limit,endpoint=limit" into a dict
+    '''
+    limits = {}
+    for item in (value or '').split(','):
+        endpoint, _, limit = item.strip().partition('=')
+        if endpoint and limit:
+            limits[endpoint] = int(limit)
+    return limits
+
+
+class LocalLimits:
+    '''
+    Process local state of the admission control: the requests in
+    flight per endpoint and the token buckets
+    '''
+
+    # the slots are held until released, they never expire
+    slot_seconds = None
+
+    def __init__(self, max_buckets=100_000):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._buckets = {}
+        self.max_buckets = max_buckets
+
+    def acquire(self, endpoint, holder, limit):
+        with self._lock:
+            if self._in_flight.get(endpoint, 0) >= limit:
+                return False
+            self._in_flight[endpoint] = self._in_flight.get(endpoint, 0) + 1
+            return True
+
+    def release(self, endpoint, holder):
+        with self._lock:
+            self._in_flight[endpoint] -= 1
+
+    def take(self, key, per_minute, now):
+        '''
+        takes a token from the bucket of key, holding up to per_minute
+        tokens and refilled at per_minute tokens a minute
+        returns 0 when a token was taken, or the seconds until one is available
+        '''
+        with self._lock:
+            if len(self._buckets) >= self.max_buckets:
+                self._buckets = {k: bucket for k, bucket in self._buckets.items() if bucket[1] > now - 60}
+            tokens, updated = self._buckets.get(key, (per_minute, now))
+            tokens, wait = _refill(tokens, updated, per_minute, now)
+            self._buckets[key] = (tokens, now)
+            return wait
+
+
+def _refill(tokens, updated, per_minute, now):
+    '''
+    refills a bucket and takes a token from it when there is one
+    returns the tokens left and the seconds to wait (0 when a token was taken)
+    an empty bucket is full again after a minute, so a bucket untouched
+    for a minute is the same as a new one and can be dropped
+    '''
+    tokens = min(per_minute, tokens + (now - updated) * per_minute / 60)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) * 60 / per_minute
+
+
+class SQLiteLimits:
+    '''
+    State of the admission control kept in a local SQLite file, shared
+    by every worker process of the host
+
+    A request in flight holds a row until it is done, or until
+    ADMISSION_SLOT_SECONDS have passed when its worker died holding it
+    (a streamed response extends its row while it is being sent).
+    Every change is one IMMEDIATE transaction, the file is in WAL mode.
+    '''
+
+    def __init__(self, path, slot_seconds=60, timeout=5.0, prune_every=1000):
+        self.path = path
+        self.slot_seconds = slot_seconds
+        self.timeout = timeout
+        self.prune_every = prune_every
+        self._takes = 0
+        self._local = threading.local()
+        self._connection().executescript('''
+            CREATE TABLE IF NOT EXISTS admission_slot (holder TEXT PRIMARY KEY, endpoint TEXT NOT NULL,
+                                                       expires REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS ix_admission_slot_endpoint ON admission_slot (endpoint, expires);
+            CREATE TABLE IF NOT EXISTS admission_bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL,
+                                                         updated REAL NOT NULL);
+        ''')
+
+    def _connection(self):
+        connection, pid = getattr(self._local, 'connection', (None, None))
+        if connection is None or pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = (connection, os.getpid())
+        return connection
+
+    def _transaction(self, work):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = work(connection)
+            connection.execute('COMMIT')
+            return result
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def acquire(self, endpoint, holder, limit):
+        now = time.time()
+
+        def work(connection):
+            connection.execute('DELETE FROM admission_slot WHERE endpoint = ? AND expires < ?', (endpoint, now))
+            in_flight, = connection.execute(
+                'SELECT count(*) FROM admission_slot WHERE endpoint = ?', (endpoint,)).fetchone()
+            if in_flight >= limit:
+                return False
+            connection.execute('INSERT INTO admission_slot (holder, endpoint, expires) VALUES (?, ?, ?)',
+                               (holder, endpoint, now + self.slot_seconds))
+            return True
+
+        return self._transaction(work)
+
+    def release(self, endpoint, holder):
+        self._connection().execute('DELETE FROM admission_slot WHERE holder = ?', (holder,))
+
+    def extend(self, holder):
+        self._connection().execute('UPDATE admission_slot SET expires = ? WHERE holder = ?',
+                                   (time.time() + self.slot_seconds, holder))
+
+    def take(self, key, per_minute, now):
+        self._takes += 1
+        if self._takes % self.prune_every == 0:
+            self._connection().execute('DELETE FROM admission_bucket WHERE updated < ?', (now - 60,))
+
+        def work(connection):
+            row = connection.execute('SELECT tokens, updated FROM admission_bucket WHERE key = ?', (key,)).fetchone()
+            tokens, wait = _refill(*(row or (per_minute, now)), per_minute, now)
+            connection.execute(
+                'INSERT INTO admission_bucket (key, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                (key, tokens, now))
+            return wait
+
+        return self._transaction(work)
+
+
+class Admission:
+    '''
+    Admission control of the expensive routes
+
+    An endpoint of ADMISSION_CONCURRENCY ("endpoint=limit,...") serves at
+    most that many requests at once on the host, the next ones are
+    answered at once with 503 and a Retry-After header rather than
+    waiting for a worker thread and a database connection. The login and
+    signup forms are also rate limited with token buckets per client
+    address and per email (LOGIN_RATE_PER_CLIENT, LOGIN_RATE_PER_EMAIL,
+    SIGNUP_RATE_PER_CLIENT attempts a minute), over it they get a 429.
+
+    The state is kept in the ADMISSION_STORE_PATH SQLite file (admission.db
+    in the instance folder by default) and shared by all the workers of
+    the host, a sync worker serving a single request at a time. With an
+    empty ADMISSION_STORE_PATH it is process local.
+    The shed requests are counted per endpoint and reason in /metrics.
+    '''
+
+    def __init__(self):
+        self.store = LocalLimits()
+        self.concurrency = {}
+        self.rates = {}
+        self.retry_after = 1
+        self._lock = threading.Lock()
+        self.shed = {}
+
+    def init_app(self, app):
+        self.concurrency = parse_limits(app.config.get('ADMISSION_CONCURRENCY'))
+        self.rates = {
+            'login': {'client': app.config.get('LOGIN_RATE_PER_CLIENT', 30),
+                      'email': app.config.get('LOGIN_RATE_PER_EMAIL', 10)},
+            'signup': {'client': app.config.get('SIGNUP_RATE_PER_CLIENT', 10)},
+        }
+        self.retry_after = app.config.get('ADMISSION_RETRY_AFTER', self.retry_after)
+        path = app.config.get('ADMISSION_STORE_PATH')
+        if path is None:
+            os.makedirs(app.instance_path, exist_ok=True)
+            path = os.path.join(app.instance_path, 'admission.db')
+        if path:
+            self.store = SQLiteLimits(path, app.config.get('ADMISSION_SLOT_SECONDS', 60))
+
+        app.before_request(self.admit)
+        app.after_request(self.hold_while_streaming)
+
+        @when_sent(app)
+        def release_slot(exc):
+            if 'admission_slot' in g:
+                self.store.release(*g.pop('admission_slot'))
+
+    def _reject(self, status, reason, retry_after):
+        with self._lock:
+            key = (request.endpoint, reason)
+            self.shed[key] = self.shed.get(key, 0) + 1
+        message = 'Too many attempts, try again later' if status == 429 else 'The server is busy, try again shortly'
+        return Response(message, status, {'Retry-After': str(max(1, math.ceil(retry_after)))},
+                        mimetype='text/plain')
+
+    def admit(self):
+        '''
+        answers the requests over a limit, before the view runs
+        '''
+        endpoint = request.endpoint
+        rates = self.rates.get(endpoint) if request.method == 'POST' else None
+        if rates:
+            now = time.time()
+            keys = {'client': request.remote_addr, 'email': (request.form.get('email') or '').strip().lower()}
+            for scope, per_minute in rates.items():
+                if per_minute and keys[scope]:
+                    wait = self.store.take(f'{endpoint}:{scope}:{keys[scope]}', per_minute, now)
+                    if wait:
+                        return self._reject(429, f'{scope}_rate', wait)
+
+        limit = self.concurrency.get(endpoint)
+        if limit:
+            holder = uuid.uuid4().hex
+            if not self.store.acquire(endpoint, holder, limit):
+                return self._reject(503, 'concurrency', self.retry_after)
+            g.admission_slot = (endpoint, holder)
+
+    def hold_while_streaming(self, response):
+        '''
+        extends the slot of a streamed response while it is being sent,
+        it would otherwise expire under a long export and let one more in
+        '''
+        if 'admission_slot' not in g or not response.is_streamed or not self.store.slot_seconds:
+            return response
+        _, holder = g.admission_slot
+        store, chunks = self.store, response.response
+
+        def extending():
+            extended = time.monotonic()
+            try:
+                for chunk in chunks:
+                    if time.monotonic() - extended > store.slot_seconds / 2:
+                        store.extend(holder)
+                        extended = time.monotonic()
+                    yield chunk
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+
+        response.response = extending()
+        return response
+
+    def render(self):
+        '''
+        the shed request counters in the Prometheus text format
+        '''
+        with self._lock:
+            shed = dict(self.shed)
+        lines = ['# TYPE http_requests_shed_total counter']
+        for (endpoint, reason), count in sorted(shed.items()):
+            lines += format_value('http_requests_shed_total', count, {'endpoint': endpoint, 'reason': reason})
+        return lines
+
+
+admission = Admission()
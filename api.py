@@ -0,0 +1,118 @@
+import json
+from datetime import date, datetime
+
+import sqlalchemy as sa
+
+from models import db, User, Appointment, Prescription
+from routing import current_branch
+
+try:
+    import orjson
+except ImportError:  # the standard json module is used instead
+    orjson = None
+
+
+'''
+The resources of the JSON API: their table, the rows of it they are
+(None for all), the fields a client can ask for and the ones sent when
+it does not say
+'''
+USER_FIELDS = ('id', 'firstname', 'lastname', 'email', 'phonenumber', 'gender')
+RESOURCES = {
+    'appointments': (Appointment.__table__, None,
+                     ('id', 'doctor_id', 'patient_id', 'starts_at', 'condition', 'firstname', 'lastname',
+                      'gender', 'phone_number', 'created_at', 'updated_at'),
+                     ('id', 'doctor_id', 'patient_id', 'starts_at', 'condition')),
+    'prescriptions': (Prescription.__table__, None,
+                      ('id', 'doctor_id', 'patient_id', 'drug', 'quantity', 'condition', 'created_at', 'updated_at'),
+                      ('id', 'doctor_id', 'patient_id', 'drug', 'quantity', 'condition')),
+    'doctors': (User.__table__, 'doctor', USER_FIELDS, ('id', 'firstname', 'lastname')),
+    'patients': (User.__table__, 'patient', USER_FIELDS, ('id', 'firstname', 'lastname')),
+}
+
+
+class ApiError(ValueError):
+    '''
+    Raised when the API is asked for fields or ids it does not understand
+    '''
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(data):
+    '''
+    the JSON bytes of data, with orjson when it is installed
+    '''
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, default=_default, separators=(',', ':')).encode()
+
+
+def parse_fields(resource, value):
+    '''
+    the fields of the "fields=a,b" argument, the default ones without it
+    '''
+    fields, defaults = RESOURCES[resource][2:]
+    if not value:
+        return defaults
+    wanted = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in wanted if field not in fields]
+    if unknown:
+        raise ApiError(f'unknown fields: {", ".join(unknown)}, {resource} have {", ".join(fields)}')
+    return wanted
+
+
+def parse_ids(value, limit):
+    '''
+    the ids of the "ids=1,2,3" argument, None without it
+    '''
+    if not value:
+        return None
+    try:
+        ids = sorted({int(id) for id in value.split(',') if id.strip()})
+    except ValueError:
+        raise ApiError('ids must be a comma separated list of integers')
+    if len(ids) > limit:
+        raise ApiError(f'at most {limit} ids can be fetched at once')
+    return ids
+
+
+def read(resource, fields, ids=None, after=None, limit=50, doctor_id=None, patient_id=None):
+    '''
+    Reads the rows of a resource as dicts of the given fields, in id order
+
+    A single select of the asked columns only, the rows come back as
+    plain tuples rather than ORM objects. Either the rows of ids are
+    read, or the `limit` rows after the id `after`. doctor_id and
+    patient_id restrict the appointments and prescriptions to the ones
+    of that doctor or patient. Everything is read from the current
+    branch, its database for the appointments and prescriptions.
+    returns the rows and the cursor of the next page (None on the last one)
+    '''
+    table, status = RESOURCES[resource][:2]
+    columns = [table.c[field] for field in fields]
+    query = sa.select(table.c.id, *columns)
+    if status is not None:
+        query = query.where(table.c.status == status, table.c.branch == current_branch())
+    if doctor_id is not None:
+        query = query.where(table.c.doctor_id == doctor_id)
+    if patient_id is not None:
+        query = query.where(table.c.patient_id == patient_id)
+
+    if ids is not None:
+        query = query.where(table.c.id.in_(ids))
+    else:
+        if after is not None:
+            query = query.where(table.c.id > after)
+        query = query.limit(limit + 1)
+
+    rows = db.session.execute(query.order_by(table.c.id)).all()
+    next_cursor = None
+    if ids is None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][0]
+    return [dict(zip(fields, row[1:])) for row in rows], next_cursor
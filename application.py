@@ -1,55 +1,168 @@
+import importlib
 import logging
 import os
-from flask import Flask, flash, redirect, render_template, request, url_for
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_sqlalchemy import SQLAlchemy
+import secrets
+from datetime import datetime, timedelta
+
+import click
+from flask import (Flask, Response, abort, current_app, flash, g, jsonify, redirect, render_template, request,
+                   session, stream_template, stream_with_context, url_for)
+from flask.cli import AppGroup, with_appcontext
 from flask_login import login_required, current_user, login_user, logout_user
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+
+import config
+from models import db, User, Appointment, Prescription, load_user, login as login_manager
+from cache import counters, fragments, user_cache
+from passwords import passwords
+from metrics import format_histogram, format_value, request_metrics
+from admission import admission
+from slots import slot_index
+from search import ADMIN_SEARCH, admin_search, patient_search
+from validation import parse_starts_at, validate_appointment, validate_prescription, validate_user
+from pagination import keyset_paginate, page_size
+from history import HistoryPage
+from api import RESOURCES, ApiError, dumps, parse_fields, parse_ids, read
+from assets import assets
+from conditional import conditional, latest_change
+from report import branch_report
+import routing
+from routing import branches, current_branch, read_only
 
-from models import db, User, Appointment, Prescription, login
 
 '''
-Initialization of the flask application
+The flask commands, as the "module:attribute" of their click command,
+their modules are only imported when one of them is run
 '''
-application = app = Flask(__name__)
-app.secret_key = "secret"
+COMMANDS = {
+    'migrate': 'migrations:migrate_command',
+    'migrate-appointments': 'migrations:migrate_appointments_command',
+    'create-indexes': 'migrations:create_indexes_command',
+    'compile-templates': 'application:compile_templates_command',
+    'build-assets': 'assets:build_assets_command',
+    'import': 'importer:import_cli',
+    'export': 'exporter:export_command',
+    'jobs': 'jobs:jobs_cli',
+    'archive': 'archive:archive_command',
+}
+
+
+class LazyAppGroup(AppGroup):
+    '''
+    The app's command group, loading the COMMANDS on first use
+    '''
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(COMMANDS))
+
+    def get_command(self, ctx, name):
+        if name in COMMANDS and name not in self.commands:
+            module, attribute = COMMANDS[name].split(':')
+            self.add_command(getattr(importlib.import_module(module), attribute), name)
+        return super().get_command(ctx, name)
 
 
 '''
-Setting up the database config 
+The routes of the application, collected by `route` and registered on
+the app by create_app
 '''
-database_name = os.environ['RDS_DB_NAME']
-database_username = os.environ['RDS_USERNAME']
-database_password = os.environ['RDS_PASSWORD']
+routes = []
 
 
-app.config["SQLALCHEMY_DATABASE_URI"] = 'mysql+pymysql://{}:{}@{}/{}'.format(
-    database_username, database_password, f"{os.environ['RDS_HOSTNAME']}:{os.environ['RDS_PORT']}", database_name)
+def route(rule, **options):
+    '''
+    Works like app.route, the endpoint is the name of the view
+    '''
+    def decorator(view):
+        routes.append((rule, options, view))
+        return view
+    return decorator
 
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
-'''
-initialize the data base connection
-and the login service
-'''
-db.init_app(app)
-login.init_app(app)
-login.login_view = 'login'
+def create_app(overrides=None):
+    '''
+    The application factory
+    the configuration is read from the environment (see config.py) and
+    updated with overrides, the database schema is not touched here, it
+    is created and upgraded by `flask migrate`
+    '''
+    app = Flask(__name__)
+    app.cli = LazyAppGroup()
+    app.config.update(config.from_environ())
+    app.config.update(overrides or {})
+    config.size_pools(app.config)
 
+    # the client address and scheme set by the proxies, the rate limits are per client address
+    hops = app.config.get("TRUSTED_PROXY_HOPS", 0)
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
 
-'''
-Create the database tables as defined in models.py
-'''
-@app.before_first_request
-def create_all():
-    db.create_all()
+    if not app.config.get("SECRET_KEY"):
+        logging.warning('SECRET_KEY is not set, the sessions will not survive a restart')
+        app.config["SECRET_KEY"] = secrets.token_hex(32)
 
+    '''
+    initialize the data base connection
+    and the login service
+    '''
+    db.init_app(app)
+    login_manager.init_app(app)
+    login_manager.login_view = 'login'
+    routing.init_app(app)
+    request_metrics.init_app(app)
+    admission.init_app(app)
+    counters.init_app(app)
+    user_cache.init_app(app)
+    fragments.init_app(app)
+    passwords.init_app(app)
+    slot_index.init_app(app)
+    patient_search.init_app(app)
+    admin_search.init_app(app)
+    assets.init_app(app)
+    branch_report.init_app(app)
+
+    for rule, options, view in routes:
+        app.add_url_rule(rule, view_func=view, **options)
+
+    if app.config.get("JINJA_CACHE_DIR"):
+        os.makedirs(app.config["JINJA_CACHE_DIR"], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["JINJA_CACHE_DIR"])
+    if app.config.get("PRECOMPILE_TEMPLATES"):
+        compile_templates(app)
+    return app
+
+
+def compile_templates(app):
+    '''
+    loads every template, so they are compiled once (and kept in memory
+    by the workers forked from this process) rather than on the first
+    request of every worker, the bytecode cache is filled on the way
+    returns the number of templates
+    '''
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+@click.command('compile-templates')
+@with_appcontext
+def compile_templates_command():
+    '''
+    Compiles the templates into the JINJA_CACHE_DIR bytecode cache
+    '''
+    click.echo(f'Compiled {compile_templates(current_app)} templates')
 
 
 # =================================================#
 # ============== UNIVERSAL ROUTE ==================#
 
-@app.route('/')
-@app.route('/index')
+@route('/')
+@route('/index')
 @login_required
 def index():
     '''
@@ -58,7 +171,41 @@ def index():
     return render_template("index.html")
 
 
-@app.route('/forgetpassword', methods=['GET', 'POST'])
+@route('/metrics')
+def metrics():
+    '''
+    The metrics of this worker process in the Prometheus text format
+    only served to admins, or to scrapers connecting to the local
+    interface directly (requests forwarded by the proxy are not local)
+    '''
+    local = request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+    if not local and not (current_user.is_authenticated and current_user.status == 'admin'):
+        abort(403)
+
+    lines = request_metrics.render()
+
+    cache_stats = user_cache.stats()
+    lines.append('# TYPE user_cache_hits_total counter')
+    lines += format_value('user_cache_hits_total', cache_stats['hits'])
+    lines.append('# TYPE user_cache_misses_total counter')
+    lines += format_value('user_cache_misses_total', cache_stats['misses'])
+    lines.append('# TYPE user_cache_evictions_total counter')
+    lines += format_value('user_cache_evictions_total', cache_stats['evictions'])
+    lines.append('# TYPE user_cache_size gauge')
+    lines += format_value('user_cache_size', cache_stats['size'])
+
+    hashing = passwords.stats()
+    lines.append('# TYPE password_hash_seconds histogram')
+    lines += format_histogram('password_hash_seconds', hashing['hash'], {'method': hashing['method']})
+    lines.append('# TYPE password_verify_seconds histogram')
+    lines += format_histogram('password_verify_seconds', hashing['verify'])
+
+    lines += admission.render()
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+@route('/forgetpassword', methods=['GET', 'POST'])
 def forget_password():
     '''
     Forgot password view
@@ -75,8 +222,7 @@ def forget_password():
 
         try:
             user = User.query.filter_by(email=email).first() # fetch user from db
-            user.password = generate_password_hash(
-                password,  method='sha256', salt_length=10)
+            user.password = passwords.hash(password)
             user.update_user() # update the user with new password
             flash('Password Updated Successfully')
             return redirect(url_for('login'))
@@ -93,7 +239,7 @@ def forget_password():
 # ================================================= #
 # =============== ADMIN ROUTES ==================== #
 
-@app.route('/admin', methods=['GET', 'POST'])
+@route('/admin', methods=['GET', 'POST'])
 def admin_signup():
     '''
     The admin signup view
@@ -111,8 +257,9 @@ def admin_signup():
         confirm_password = request.form.get('confirm_password')
 
         # Validate the received values
-        if not all([firstname, lastname, email, user_password, phonenumber, status, confirm_password]):
-            flash("Enter all required fields")
+        error = validate_user(dict(request.form.to_dict(), status=status), statuses=('admin',))
+        if error or not confirm_password:
+            flash(error or "Enter all required fields")
             return redirect(url_for('admin_signup'))
 
         if user_password != confirm_password:
@@ -129,13 +276,10 @@ def admin_signup():
         # Hash user password
         try:
 
-            password = generate_password_hash(
-                user_password, method='sha256', salt_length=10)
-            new_user = User(firstname=firstname, lastname=lastname, email=email,
-                            gender=gender, phonenumber=phonenumber, password=password, status=status)
-            print(new_user)
+            password = passwords.hash(user_password)
+            new_user = User(firstname=firstname, lastname=lastname, email=email, gender=gender,
+                            phonenumber=phonenumber, password=password, status=status, branch=posted_branch())
             new_user.add_user() # add user to db
-            print(new_user)
             flash("Account Created Successfuly")
             return redirect(url_for('login'))
         except Exception as e:
@@ -147,13 +291,14 @@ def admin_signup():
     return render_template("admin-signup.html")
 
 
-@app.route('/admin/dashboard')
+@route('/admin/dashboard')
 @login_required
+@read_only
 def admindashboard():
     '''
     Admin dashboard view
     gives an overview of the number of doctors, patients and
-    appointments
+    appointments of the current branch
     '''
     if request.method == 'GET':
         if current_user.status != 'admin':
@@ -161,16 +306,66 @@ def admindashboard():
         count_map = {}
         try:
             # gets the current count of doctors, patients amd appointment
-            count_map['doctors'] = User.query.filter_by(status='doctor').count()
-            count_map['patients'] = User.query.filter_by(status='patient').count()
-            count_map['appointments'] = Appointment.query.count()
+            # from the counter cache, recomputed only when it has expired
+            branch = current_branch()
+            users_by_status = counters.get(('users_by_status', branch), lambda: User.count_by_status(branch))
+            count_map['doctors'] = users_by_status.get('doctor', 0)
+            count_map['patients'] = users_by_status.get('patient', 0)
+            count_map['appointments'] = counters.get(('appointments', branch), Appointment.count)
         except Exception as e:
-            print("Error : ", str(e))
+            logging.exception(e)
     return render_template("adminDashboard.html", count_map=count_map)
 
 
-@app.route('/admin/doctors', methods=['GET', 'POST'])
+@route('/admin/stats')
+@login_required
+def stats():
+    '''
+    Admin view of the user and fragment cache hit/miss counters, of the
+    password hashing latencies and of the background jobs
+    '''
+    if current_user.status != 'admin':
+        return render_template('403.html')
+    from jobs import job_queue
+
+    return jsonify(user_cache=user_cache.stats(), fragments=fragments.stats(), password_hashing=passwords.stats(),
+                   jobs=job_queue.stats())
+
+
+@route('/admin/branch', methods=['POST'])
 @login_required
+def switch_branch():
+    '''
+    Switches the admin to the branch they picked, the admin views then
+    show its doctors, patients, appointments and prescriptions
+    '''
+    if current_user.status != 'admin':
+        return render_template('403.html')
+    branch = request.form.get('branch')
+    if branch not in branches():
+        abort(400)
+    session['branch'] = branch
+    return redirect(request.referrer or url_for('admindashboard'))
+
+
+@route('/admin/branches')
+@login_required
+def branch_summaries():
+    '''
+    The admin overview of every branch: its doctors, patients,
+    appointments and prescriptions, the branches are read in parallel
+    '''
+    if current_user.status != 'admin':
+        return render_template('403.html')
+    rows, totals = branch_report.summaries()
+    if request.args.get('format') == 'json':
+        return jsonify(branches=rows, totals=totals)
+    return render_template('branches.html', rows=rows, totals=totals)
+
+
+@route('/admin/doctors', methods=['GET', 'POST'])
+@login_required
+@read_only
 def doctors():
     '''
     The admin -> Doctor view
@@ -179,79 +374,224 @@ def doctors():
     if current_user.status != 'admin':
         return render_template('403.html')
 
-    doctors = User.query.filter_by(status='doctor').all() # fetch all the doctors
-
     if request.method == 'POST':
-        # this is an admin action to delete a doctor
-        _id = int(request.form.get('id'))
+        # this is an admin action to delete one or more doctors along
+        # with their appointments and prescriptions
         try:
-            # deletes from the db and removes from the list of 
-            # previously queried doctors
-            User.query.get(_id).delete()
-            doctors = list(filter(lambda x : x.id != _id, 
-                                  doctors))
+            deleted = User.delete_many(posted_ids(), status='doctor', branch=current_branch())
+            flash(f"{deleted} doctor(s) deleted")
         except Exception as e:
-            print("Error", str(e))
-            pass
-    return render_template("doctors.html", doctors=doctors, length=len(doctors))
+            db.session.rollback()
+            logging.exception(e)
+        return redirect(url_for('doctors', **request.args))
+
+    # fetch one page of the doctors of the branch, streamed into the template
+    page = keyset_paginate(User.query.filter_by(status='doctor', branch=current_branch()), User.id, request.args)
+    return stream_template("doctors.html", doctors=page, page=page)
 
 
-@app.route('/admin/patients', methods=['GET', 'POST'])
+@route('/admin/patients', methods=['GET', 'POST'])
 @login_required
+@read_only
 def patients():
     '''
     The admin -> Patient view
     '''
     if current_user.status != 'admin':
         return render_template('403.html')
-    patients = User.query.filter_by(status='patient').all() # fetch all the patients
 
     if request.method == 'POST':
-        # this is an admin action to delete a patient
-        _id = int(request.form.get('id'))
+        # this is an admin action to delete one or more patients along
+        # with their appointments and prescriptions
         try:
-            # deletes from the db and removes from the list of 
-            # previously queried patients
-            User.query.get(_id).delete()
-            patients = list(filter(lambda x : x.id != _id, 
-                                  patients))
+            deleted = User.delete_many(posted_ids(), status='patient', branch=current_branch())
+            flash(f"{deleted} patient(s) deleted")
         except Exception as e:
-            print("Error", str(e))
-            pass
-    return render_template("patients.html", patients=patients, length=len(patients))
+            db.session.rollback()
+            logging.exception(e)
+        return redirect(url_for('patients', **request.args))
+
+    # fetch one page of the patients of the branch, streamed into the template
+    page = keyset_paginate(User.query.filter_by(status='patient', branch=current_branch()), User.id, request.args)
+    return stream_template("patients.html", patients=page, page=page)
 
 
-@app.route('/admin/appointments', methods=['GET', 'POST'])
+@route('/admin/appointments', methods=['GET', 'POST'])
 @login_required
+@read_only
 def allAppointments():
     '''
     The admin -> Appointment view
     '''
     if current_user.status != 'admin':
         return render_template('403.html')
-    
-    appointments = Appointment.query.all()   # fetch all the appointments
 
     if request.method == 'POST':
-        # this is an admin action to remove an appointment
-        _id = int(request.form.get('id'))
+        # this is an admin action to remove one or more appointments
         try:
-            # deletes from the db and removes from the list of 
-            # previously queried appointements
-            Appointment.query.get(_id).delete()
-            appointments = list(filter(lambda x : x.id != _id, 
-                                  appointments))
+            deleted = Appointment.delete_many(posted_ids())
+            flash(f"{deleted} appointment(s) deleted")
         except Exception as e:
-            print("Error", str(e))
-            pass
-    return render_template("appointments.html", appointments=appointments, length=len(appointments))
+            db.session.rollback()
+            logging.exception(e)
+        return redirect(url_for('allAppointments', **request.args))
+
+    # fetch one page of appointments together with their doctors
+    page = keyset_paginate(Appointment.query.options(
+        selectinload(Appointment.doctor)), Appointment.id, request.args)
+    return stream_template("appointments.html", appointments=page, page=page)
+
+
+@route('/admin/search')
+@login_required
+@read_only
+def search():
+    '''
+    The admin search of the users, appointments and prescriptions
+        -> q    : the text searched for, misspellings are tolerated
+        -> kind : users, appointments or prescriptions
+        -> page : the page of the ranked results
+    '''
+    if current_user.status != 'admin':
+        return render_template('403.html')
+
+    kind = request.args.get('kind', 'users')
+    if kind not in ADMIN_SEARCH:
+        abort(404)
+    results = admin_search.search(kind, request.args.get('q'), request.args.get('page', 1, type=int))
+    return render_template("search.html", kinds=ADMIN_SEARCH, kind=kind, results=results)
+
+
+def posted_ids():
+    '''
+    The ids of the rows a delete form was posted for
+    either the single row whose delete button was pressed (`id`)
+    or all the rows that were ticked (`ids`)
+    '''
+    ids = request.form.getlist('id') or request.form.getlist('ids')
+    return [int(_id) for _id in ids if _id.isdigit()]
+
+
+def filter_schedule(query, args):
+    '''
+    Narrows an appointment query down to the requested part of the schedule
+        -> when=upcoming : appointments from now on, soonest first
+        -> when=past     : appointments before now, latest first
+        -> from / to     : appointments between the two days (inclusive)
+    combined with a doctor_id or patient_id filter this is a range scan
+    on the (doctor_id, starts_at) / (patient_id, starts_at) indexes
+    '''
+    now = datetime.now()
+    when = args.get('when')
+
+    try:
+        start = datetime.strptime(args['from'], '%Y-%m-%d') if args.get('from') else None
+        end = datetime.strptime(args['to'], '%Y-%m-%d') + timedelta(days=1) if args.get('to') else None
+    except ValueError:
+        flash('Enter the dates as YYYY-MM-DD')
+        start = end = None
+
+    if start is not None:
+        query = query.filter(Appointment.starts_at >= start)
+    if end is not None:
+        query = query.filter(Appointment.starts_at < end)
+
+    if when == 'upcoming':
+        return query.filter(Appointment.starts_at >= now).order_by(Appointment.starts_at.asc())
+    if when == 'past':
+        return query.filter(Appointment.starts_at < now).order_by(Appointment.starts_at.desc())
+    return query.order_by(Appointment.starts_at.asc())
+
+
+def next_start(**filters):
+    '''
+    the next starts_at to come of the appointments matching filters when
+    the page is narrowed down to the upcoming or past ones, as that
+    appointment moves from one to the other by time alone
+    '''
+    if request.args.get('when') not in ('upcoming', 'past'):
+        return None
+    return db.session.query(db.func.min(Appointment.starts_at)) \
+        .filter_by(**filters).filter(Appointment.starts_at >= datetime.now()).scalar()
+
+
+def user_options(role, prefix=''):
+    '''
+    the <option> list of every user of a role in the current branch,
+    rendered once per version of the role in the fragment cache
+    '''
+    branch = current_branch()
+    return Markup(fragments.get(f'{role}-options:{branch}', role, lambda: render_template(
+        'useroptions.html', users=User.query.filter_by(status=role, branch=branch).order_by(User.id),
+        prefix=prefix)))
+
+
+def first_doctor_id():
+    '''
+    the id of the doctor listed first in the booking form
+    '''
+    branch = current_branch()
+    id = fragments.get(f'first-doctor:{branch}', 'doctor', lambda: str(
+        db.session.query(db.func.min(User.id)).filter_by(status='doctor', branch=branch).scalar() or ''))
+    return int(id) if id else None
+
+
+def in_branch(user_id, status):
+    '''
+    whether the user is a user of status in the current branch, read
+    from the user cache
+    '''
+    user = load_user(user_id) if user_id is not None else None
+    return user is not None and user.status == status and user.branch == current_branch()
+
+
+def posted_branch():
+    '''
+    the branch picked in a signup form, the current one when none was
+    '''
+    branch = request.form.get('branch')
+    return branch if branch in branches() else current_branch()
+
+
+@route('/admin/export/<kind>.<fmt>')
+@login_required
+def export_table(kind, fmt):
+    '''
+    The admin export of the appointments or prescriptions as CSV or JSON lines
+        -> doctor_id / patient_id : only the rows of this doctor / patient
+        -> from / to              : only the appointments between these days
+        -> gzip=1                 : compress the download
+    the rows are streamed as they are read, in constant memory
+    '''
+    from exporter import EXPORTS, FORMATS, ExportError, export, parse_day
+
+    if current_user.status != 'admin':
+        return render_template('403.html')
+    if kind not in EXPORTS or fmt not in FORMATS:
+        abort(404)
+
+    gzip = request.args.get('gzip') == '1'
+    try:
+        chunks = export(kind, fmt, gzip,
+                        doctor_id=request.args.get('doctor_id', type=int),
+                        patient_id=request.args.get('patient_id', type=int),
+                        start=parse_day(request.args.get('from')),
+                        end=parse_day(request.args.get('to')))
+    except ExportError as e:
+        return jsonify(error=str(e)), 400
+
+    filename = f'{kind}.{fmt}.gz' if gzip else f'{kind}.{fmt}'
+    return Response(stream_with_context(chunks),
+                    mimetype='application/gzip' if gzip else FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 
 # ====================================================== #
 # ================= DOCTOR ROUTES ===================== #
 
-@app.route('/doctordashboard')
+@route('/doctordashboard')
 @login_required
+@read_only
 def doctordashboard():
     '''
     The doctor dashboard
@@ -260,11 +600,13 @@ def doctordashboard():
     if request.method == 'GET':
         if current_user.status != 'doctor':
             return render_template('403.html')
-    appointments = len(Appointment.query.filter_by(doctor_id=current_user.id).all())
+    doctor_id = current_user.id
+    appointments = counters.get(('doctor_appointments', doctor_id),
+                                lambda: Appointment.count(doctor_id))
     return render_template("doctordash.html", total_appointments=appointments)
 
 
-@app.route('/editdoctorprofile')
+@route('/editdoctorprofile')
 @login_required
 def editdoctorprofile():
     '''
@@ -302,8 +644,11 @@ def editdoctorprofile():
     return render_template('editdoctorprofile.html')
 
 
-@app.route('/doctorappointments', methods=['GET', 'POST'])
+@route('/doctorappointments', methods=['GET', 'POST'])
 @login_required
+@read_only
+@conditional(lambda: [latest_change(Appointment, doctor_id=current_user.id)],
+             until=lambda: next_start(doctor_id=current_user.id), roles=('patient',))
 def doctorprofile():
     '''
     The Doctors -> Appointment view
@@ -312,56 +657,64 @@ def doctorprofile():
 
     if current_user.status != 'doctor':
         return render_template('403.html')
-    appointments = []
-    appointments_query = Appointment.query.filter_by(
-        doctor_id=current_user.id).all()
-    for appointment in appointments_query:
-        patient = User.query.get(appointment.patient_id)
-        appointments.append({"appointment": appointment, "patient": patient})
 
     if request.method == 'POST':
-        # the doctor action to delete an appointment
-        _id = int(request.form.get('id'))
+        # the doctor action to delete one or more of their appointments
         try:
-            # deletes from the db and removes from the list of 
-            # previously queried appointements
-            Appointment.query.get(_id).delete()
-            appointments = list(filter(lambda x : x['appointment'].id != _id, 
-                                  appointments))
+            deleted = Appointment.delete_many(posted_ids(), doctor_id=current_user.id)
+            flash(f"{deleted} appointment(s) deleted")
         except Exception as e:
-            print("Error", str(e))
-            pass
+            db.session.rollback()
+            logging.exception(e)
+        return redirect(url_for('doctorprofile', **request.args))
+
+    # the patients are loaded in one extra query rather than one per appointment
+    appointments_query = filter_schedule(Appointment.query.options(
+        selectinload(Appointment.patient)).filter_by(
+        doctor_id=current_user.id), request.args).all()
+    appointments = [{"appointment": appointment, "patient": appointment.patient}
+                    for appointment in appointments_query]
 
     return render_template("doctorappointments.html", appointments=appointments)
 
 
-@app.route('/addprescription', methods=['GET', 'POST'])
+@route('/addprescription', methods=['GET', 'POST'])
 @login_required
 def add_prescription():
     '''
     The Doctor's add prescription view
     enables the doctor to create a prescription for a patient
     '''
-    users = User.query.filter_by(status='patient')
-
     if request.method == 'GET':
         if current_user.status != 'doctor':
             return render_template('403.html')
         else:
-            return render_template("addprescription.html", users=users)
+            return render_template("addprescription.html")
 
     if request.method == 'POST':
-        # a doctor's action to create a new prescribtion
-        drug = request.form.get('drug')
-        quantity = request.form.get('quantity')
+        # a doctor's action to create a new prescribtion, of one or more drugs
+        drugs = request.form.getlist('drug')
+        quantities = request.form.getlist('quantity')
         condition = request.form.get('condition')
-        patient_id = request.form.get('patient')
+        patient_id = request.form.get('patient', type=int)
         doctor_id = current_user.id
 
+        items = [(drug, quantity) for drug, quantity in zip(drugs, quantities) if drug or quantity]
+        errors = [validate_prescription(dict(
+            drug=drug, quantity=quantity, condition=condition, patient_id=patient_id, doctor_id=doctor_id))
+            for drug, quantity in items or [(None, None)]]
+        error = next((error for error in errors if error), None)
+        if not error and not in_branch(patient_id, 'patient'):
+            error = "The patient is not a patient of this branch"
+        if error:
+            flash(error)
+            return redirect(url_for('add_prescription'))
+
         try:
-            new_prescription = Prescription(
+            # all the drugs are saved in one transaction
+            Prescription.add_many(Prescription(
                 drug=drug, quantity=quantity, condition=condition, patient_id=patient_id, doctor_id=doctor_id)
-            new_prescription.add_prescription()
+                for drug, quantity in items)
             flash("New Prescription has been added")
             redirect(url_for('add_prescription'))
         except Exception as e:
@@ -369,43 +722,42 @@ def add_prescription():
             logging.exception(e)
         finally:
             db.session.close()
-    return render_template("addprescription.html", users=users)
+    return render_template("addprescription.html")
 
 # ====================================================== #
 # ================= PATIENT ROUTES ===================== #
 
 
-@app.route('/patientdashboard', methods=['GET', 'POST'])
+@route('/patientdashboard', methods=['GET', 'POST'])
 @login_required
+@read_only
+@conditional(lambda: [latest_change(Appointment, patient_id=current_user.id)],
+             until=lambda: next_start(patient_id=current_user.id), roles=('doctor',))
 def patientdashboard():
     '''
     The patient dashboard
     gives an overview on the current appointments
     '''
-    appointments_query = Appointment.query.filter_by(
-    patient_id=current_user.id).all()
-    appointments = []
-    for appointment in appointments_query:
-        doctor = User.query.get(appointment.doctor_id)
-        appointments.append({"appointment": appointment, "doctor": doctor})
-
     if request.method == 'POST':
-        # the patient action to delete an appointment
-        _id = int(request.form.get('id'))
+        # the patient action to delete one or more of their appointments
         try:
-            # deletes from the db and removes from the list of 
-            # previously query appointements
-            Appointment.query.get(_id).delete()
-            appointments = list(filter(lambda x : x['appointment'].id != _id, 
-                                  appointments))
+            deleted = Appointment.delete_many(posted_ids(), patient_id=current_user.id)
+            flash(f"{deleted} appointment(s) deleted")
         except Exception as e:
-            print("Error", str(e))
-            pass
-        
+            db.session.rollback()
+            logging.exception(e)
+        return redirect(url_for('patientdashboard', **request.args))
+
+    appointments_query = filter_schedule(Appointment.query.options(
+        selectinload(Appointment.doctor)).filter_by(
+        patient_id=current_user.id), request.args).all()
+    appointments = [{"appointment": appointment, "doctor": appointment.doctor}
+                    for appointment in appointments_query]
+
     return render_template('patient.html', appointments=appointments)
 
 
-@app.route('/editpatientprofile', methods=['GET', 'POST'])
+@route('/editpatientprofile', methods=['GET', 'POST'])
 @login_required
 def editpatientprofile():
     '''
@@ -447,84 +799,255 @@ def editpatientprofile():
 
 # Book Appointment
 
-@app.route('/bookappointment', methods=['POST', 'GET'])
+@route('/bookappointment', methods=['POST', 'GET'])
 @login_required
 def bookappointment():
 
     '''
     The Patient's book appointment view
     enables the patient to book an appointment with a doctor
+    in one of the doctor's free slots
     '''
     if request.method == 'GET':
         if current_user.status != 'patient':
             return render_template('403.html')
 
-    doctors = User.query.filter_by(status='doctor').all()
-
     if request.method == 'POST':
         firstname = request.form.get('firstname')
         lastname = request.form.get('lastname')
         gender = request.form.get('gender')
-        date = request.form.get('date')
-        time = request.form.get('time')
+        slot = request.form.get('slot')
         phone_number = request.form.get('phonenumber')
-        doctor_id = int(request.form.get('select-doctor'))
+        doctor_id = request.form.get('select-doctor', type=int)
         patient_id = int(current_user.id)
         condition = request.form.get('injury-condition')
+        # the same slot every week for a number of weeks, physiotherapy for example
+        weeks = request.form.get('weeks', 1, type=int)
+        weeks = max(1, min(weeks, current_app.config['APPOINTMENT_SERIES_MAX_WEEKS']))
+
+        # ensure all the fields are complete and the slot can be read
+        error = validate_appointment(dict(
+            firstname=firstname, lastname=lastname, gender=gender, starts_at=slot, phone_number=phone_number,
+            doctor_id=doctor_id, patient_id=patient_id, condition=condition))
+        if not error and not in_branch(doctor_id, 'doctor'):
+            error = "Pick one of the doctors of your branch"
+        if error:
+            flash(error)
+            return redirect(url_for('bookappointment'))
+
+        starts_at = parse_starts_at(slot)
+        if starts_at < datetime.now() or not slot_index.is_slot(starts_at):
+            flash("Pick one of the available slots")
+            return redirect(url_for('bookappointment'))
 
-        if not all([firstname, lastname, date, time, phone_number, doctor_id, gender, condition]):
-            # ensure all the fields are complete
-            flash("Enter all required fields")
+        series = [starts_at + timedelta(weeks=week) for week in range(weeks)]
+        taken = [slot for slot in series if not slot_index.is_free(doctor_id, slot)]
+        if taken == series[:1]:
+            flash("This slot has just been booked, pick another one")
             return redirect(url_for('bookappointment'))
+        if taken:
+            flash("The doctor is not free on " + ", ".join(slot.strftime('%Y-%m-%d') for slot in taken))
+            return redirect(url_for('bookappointment'))
+
         try:
-            appointment = Appointment(firstname=firstname, lastname=lastname, gender=gender, date=date, time=time,
-                                      phone_number=phone_number, doctor_id=doctor_id, patient_id=patient_id, condition=condition)
-            appointment.add_appointment()
-            flash("Appointment has been booked")
+            # the whole series is booked in one transaction, or none of it
+            Appointment.add_many(Appointment(
+                firstname=firstname, lastname=lastname, gender=gender, starts_at=slot, phone_number=phone_number,
+                doctor_id=doctor_id, patient_id=patient_id, condition=condition) for slot in series)
+            flash("Appointment has been booked" if weeks == 1 else f"{weeks} weekly appointments have been booked")
             return redirect(url_for('patientdashboard'))
+        except IntegrityError:
+            # another worker booked the same slot first
+            db.session.rollback()
+            slot_index.invalidate(doctor_id)
+            flash("This slot has just been booked, pick another one")
+            return redirect(url_for('bookappointment'))
         except Exception as e:
             db.session.rollback()
             logging.exception(e)
         finally:
             db.session.close()
 
-    return render_template("bookappointment.html", doctors=doctors)
+    # the doctor list is a cached fragment, only the first doctor's slots are looked up
+    doctor_id = first_doctor_id()
+    slots = slot_index.free_slots(doctor_id, datetime.now(), current_app.config['SLOTS_OFFERED']) if doctor_id else []
+    return render_template("bookappointment.html", doctor_options=user_options('doctor', 'Dr. '), slots=slots)
+
+
+@route('/slots')
+@login_required
+def free_slots():
+    '''
+    The free slots of a doctor, used by the book appointment form
+        -> doctor_id : the doctor
+        -> date      : the first day to look at (defaults to now)
+        -> count     : the number of slots wanted
+    '''
+    doctor_id = request.args.get('doctor_id', type=int)
+    count = min(request.args.get('count', current_app.config['SLOTS_OFFERED'], type=int), 100)
+    try:
+        after = max(datetime.strptime(request.args['date'], '%Y-%m-%d'), datetime.now())
+    except (KeyError, ValueError):
+        after = datetime.now()
+
+    if doctor_id is None:
+        return jsonify(error='doctor_id is required'), 400
+    # the busy slots are read from the current branch, a doctor of another one would look free
+    if not in_branch(doctor_id, 'doctor'):
+        return jsonify(error='doctor_id is not a doctor of this branch'), 400
+    slots = slot_index.free_slots(doctor_id, after, count)
+    return jsonify(slots=[slot.strftime('%Y-%m-%dT%H:%M') for slot in slots])
+
+
+@route('/patients/search')
+@login_required
+def search_patients():
+    '''
+    Type-ahead search of the patients, used by the prescription form
+        -> q     : a name, email or phone number prefix
+        -> limit : the number of patients wanted
+    '''
+    if current_user.status not in ('doctor', 'admin'):
+        abort(403)
+    patients = patient_search.search(request.args.get('q'), limit=request.args.get('limit', type=int))
+    return jsonify(patients=patients)
 
 
-@app.route('/patientappointments')
+@route('/patientappointments')
 @login_required
 def patientappointment():
     return render_template('patientappointment.html')
 
 
-@app.route('/patientdata')
+@route('/patientdata')
 @login_required
 def patientdata():
-    return render_template('doctorpatientdata.html')
+    '''
+    The patient data is their medical history
+    '''
+    return patientdetails()
 
 
-@app.route('/prescriptions')
+@route('/prescriptions')
 @login_required
+@read_only
+@conditional(lambda: [latest_change(Prescription, patient_id=current_user.id)], roles=('doctor',))
 def prescription():
-    prescriptions = []
-    query_prescriptions = Prescription.query.filter_by(
+    query_prescriptions = Prescription.query.options(
+        selectinload(Prescription.doctor)).filter_by(
         patient_id=current_user.id)
-    for prescription in query_prescriptions:
-        doctor = User.query.get(prescription.doctor_id)
-        prescriptions.append({'prescription': prescription, 'doctor': doctor})
+    prescriptions = [{'prescription': prescription, 'doctor': prescription.doctor}
+                     for prescription in query_prescriptions]
     return render_template('prescription.html', prescriptions=prescriptions)
 
 
-@app.route('/patientdetails')
+@route('/patientdetails')
 @login_required
 def patientdetails():
-    return render_template('doctorpatientdetails.html')
+    '''
+    Sends a patient to their medical history, and a doctor or an admin
+    to the one of the patient_id argument (to their appointments or the
+    patient list without it)
+    '''
+    if current_user.status == 'patient':
+        return redirect(url_for('medicalhistory', patient_id=current_user.id))
+    patient_id = request.args.get('patient_id', type=int)
+    if patient_id is not None:
+        return redirect(url_for('medicalhistory', patient_id=patient_id))
+    return redirect(url_for('doctorprofile' if current_user.status == 'doctor' else 'patients'))
+
+
+def history_patient(patient_id):
+    '''
+    the patient whose history is asked for, the patients can only see
+    their own history, the doctors and admins the one of any patient of
+    the current branch
+    '''
+    if current_user.status == 'patient' and current_user.id != patient_id:
+        abort(403)
+    if 'history_patient' not in g:
+        g.history_patient = db.session.get(User, patient_id)
+    if (g.history_patient is None or g.history_patient.status != 'patient'
+            or g.history_patient.branch != current_branch()):
+        abort(404)
+    return g.history_patient
+
+
+def history_changes():
+    patient_id = request.view_args['patient_id']
+    history_patient(patient_id)
+    return [latest_change(Appointment, patient_id=patient_id), latest_change(Prescription, patient_id=patient_id)]
+
+
+@route('/patients/<int:patient_id>/history')
+@login_required
+@read_only
+@conditional(history_changes, roles=('doctor',))
+def medicalhistory(patient_id):
+    '''
+    The medical history of a patient
+    their appointments and prescriptions on one timeline, newest first
+        -> after    : the cursor of the page to continue from
+        -> per_page : the number of entries per page
+        -> archived : 1 to include the archived appointments and prescriptions
+    '''
+    patient = history_patient(patient_id)
+    page = HistoryPage(patient_id, page_size(request.args), request.args.get('after'),
+                       archived=request.args.get('archived') == '1')
+    layouts = {'patient': 'layouts/patient_dashboard.html', 'doctor': 'layouts/doctor_dashboard.html'}
+    return render_template('PatientMedicalhistory.html', patient=patient, page=page,
+                           layout=layouts.get(current_user.status, 'layouts/admin_dashboard_layout.html'))
+
+
+@route('/patients/<int:patient_id>/history.json')
+@login_required
+@read_only
+def medicalhistory_api(patient_id):
+    '''
+    The medical history of a patient as JSON, a page of entries and the
+    cursor of the next one (null on the last page)
+    '''
+    history_patient(patient_id)
+    page = HistoryPage(patient_id, page_size(request.args), request.args.get('after'),
+                       archived=request.args.get('archived') == '1')
+    return jsonify(entries=page.as_dicts(), next_cursor=page.next_cursor)
+
+
+@route('/api/v1/<resource>')
+@login_required
+@read_only
+def api_read(resource):
+    '''
+    The read only JSON API of the appointments, prescriptions, doctors and patients
+        -> fields   : the comma separated fields wanted
+        -> ids      : the comma separated ids to fetch, instead of a page
+        -> after    : the id the page continues after
+        -> per_page : the number of rows per page
+    the admins read everything, the doctors and patients their own
+    appointments and prescriptions, and the patients cannot list patients
+    '''
+    if resource not in RESOURCES:
+        abort(404)
+    scope = {}
+    if resource in ('appointments', 'prescriptions') and current_user.status != 'admin':
+        scope = {f'{current_user.status}_id': current_user.id}
+    elif resource == 'patients' and current_user.status == 'patient':
+        abort(403)
+
+    try:
+        fields = parse_fields(resource, request.args.get('fields'))
+        ids = parse_ids(request.args.get('ids'), current_app.config['MAX_PAGE_SIZE'])
+    except ApiError as e:
+        return jsonify(error=str(e)), 400
+    rows, next_cursor = read(resource, fields, ids, request.args.get('after', type=int),
+                             page_size(request.args), **scope)
+    return Response(dumps({'data': rows, 'next_cursor': next_cursor}), mimetype='application/json')
 
 
 # ========================================================= #
 # ================== AUTHENTICATION ======================= #
 
-@app.route('/login', methods=['POST', 'GET'])
+@route('/login', methods=['POST', 'GET'])
 def login():
     '''
     The login view for all users
@@ -535,27 +1058,39 @@ def login():
         password = request.form.get('password')
 
         user = User.query.filter_by(email=email).first()
-        print(user)
         # check if the user actually exists
         # take the user-supplied password, hash it, and compare it to the hashed password in the database
-        if not user or not check_password_hash(user.password, password):
+        matches, needs_rehash = passwords.verify(user.password, password) if user else (False, False)
+        if not matches:
             flash('Please check your login details and try again.')
             # if the user doesn't exist or password is wrong, reload the page
             return redirect(url_for('login'))
-        if user is not None and check_password_hash(user.password, password):
-            login_user(user)
-            # if the above check passes, then we know the user has the right credentials
-            if user.status == 'patient':
-                return redirect(url_for('patientdashboard'))
-            elif user.status == 'doctor':
-                return redirect(url_for('doctordashboard'))
-            elif user.status == 'admin':
-                return redirect(url_for('admindashboard'))
+
+        if needs_rehash:
+            # the stored hash uses an outdated method, upgrade it while
+            # the plain password is at hand
+            try:
+                user.password = passwords.hash(password)
+                user.update_user()
+            except Exception as e:
+                db.session.rollback()
+                logging.exception(e)
+
+        login_user(user)
+        # an admin starts on their own branch
+        session.pop('branch', None)
+        # if the above check passes, then we know the user has the right credentials
+        if user.status == 'patient':
+            return redirect(url_for('patientdashboard'))
+        elif user.status == 'doctor':
+            return redirect(url_for('doctordashboard'))
+        elif user.status == 'admin':
+            return redirect(url_for('admindashboard'))
 
     return render_template("login.html")
 
 
-@app.route('/signup', methods=['POST', 'GET'])
+@route('/signup', methods=['POST', 'GET'])
 def signup():
     '''
     The signup view for the both the doctors and the patients
@@ -563,7 +1098,6 @@ def signup():
 
     if request.method == 'POST':
         # Read the posted values from the UI
-        print("Posting...")
 
         firstname = request.form.get('firstname')
         lastname = request.form.get('lastname')
@@ -575,13 +1109,12 @@ def signup():
         confirm_password = request.form.get('confirm_password')
 
         # Validate the received values
-        if not all([firstname, lastname, email, gender, user_password, phonenumber, status, confirm_password]):
-            print("There is an error")
-            flash("Enter all required fields")
+        error = validate_user(request.form.to_dict())
+        if error or not confirm_password:
+            flash(error or "Enter all required fields")
             return redirect(url_for('signup'))
 
         if user_password != confirm_password:
-            print("Password not mathcin")
             flash('Password Mismatch')
             return redirect(url_for('signup'))
 
@@ -589,17 +1122,15 @@ def signup():
         user = User.query.filter_by(email=email).first()
 
         if user:
-            print("User exists already")
             flash("User already exist")
             return redirect(url_for('signup'))
 
         # Hash user password
         try:
 
-            password = generate_password_hash(
-                user_password, method='sha256', salt_length=10)
+            password = passwords.hash(user_password)
             new_user = User(firstname=firstname, lastname=lastname, email=email, gender=gender,
-                            phonenumber=phonenumber, password=password, status=status)
+                            phonenumber=phonenumber, password=password, status=status, branch=posted_branch())
             new_user.add_user()
             flash("Account Created Successfuly")
             return redirect(url_for('login'))
@@ -612,7 +1143,7 @@ def signup():
     return render_template("register.html")
 
 
-@ app.route('/logout')
+@route('/logout')
 def logout():
     '''
     The logout handler
@@ -622,4 +1153,4 @@ def logout():
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,118 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+
+from cache import counters
+from models import db, Appointment, AppointmentArchive, Prescription, PrescriptionArchive
+from routing import branches, use_branch
+
+
+class Archiver:
+    '''
+    Moves the rows the views no longer show out of the hot tables
+
+    The appointments that started more than ARCHIVE_APPOINTMENTS_AFTER_DAYS
+    ago and the prescriptions written more than PRESCRIPTION_ACTIVE_DAYS
+    ago are moved to the appointment_archive and prescription_archive
+    tables, keeping the hot tables and their indexes small. Every batch of
+    ARCHIVE_BATCH_SIZE rows is copied and deleted in its own transaction,
+    so the archiving can be stopped and run again, and the archiver
+    sleeps ARCHIVE_BATCH_PAUSE seconds between batches to leave the
+    database to the web workers. The branches are archived one after the
+    other, each in its own database.
+    '''
+
+    def __init__(self):
+        self.appointments_after = timedelta(days=365)
+        self.prescriptions_after = timedelta(days=180)
+        self.batch_size = 1000
+        self.pause = 0.1
+
+    def init_app(self, app):
+        self.appointments_after = timedelta(days=app.config.get('ARCHIVE_APPOINTMENTS_AFTER_DAYS', 365))
+        self.prescriptions_after = timedelta(days=app.config.get('PRESCRIPTION_ACTIVE_DAYS', 180))
+        self.batch_size = app.config.get('ARCHIVE_BATCH_SIZE', self.batch_size)
+        self.pause = app.config.get('ARCHIVE_BATCH_PAUSE', self.pause)
+
+    def kinds(self, now):
+        '''
+        the hot model, archive model and archived condition of every kind of row
+        '''
+        return {
+            'appointments': (Appointment, AppointmentArchive,
+                             Appointment.starts_at < now - self.appointments_after),
+            'prescriptions': (Prescription, PrescriptionArchive,
+                              Prescription.created_at < now - self.prescriptions_after),
+        }
+
+    def archive_batch(self, model, archive, condition, now):
+        '''
+        moves one batch of rows to the archive in a single transaction
+        returns the number of rows moved
+        '''
+        table, archived = model.__table__, archive.__table__
+        ids = [id for id, in db.session.query(model.id).filter(condition).limit(self.batch_size)]
+        if not ids:
+            db.session.rollback()
+            return 0
+
+        names = [column.name for column in table.columns]
+        db.session.execute(archived.insert().from_select(
+            names + ['archived_at'],
+            sa.select(*table.columns, sa.literal(now, sa.DateTime)).where(table.c.id.in_(ids))))
+        db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        db.session.commit()
+        return len(ids)
+
+    def archive(self, kinds=None, max_batches=None, only=None):
+        '''
+        archives the given kinds of rows (all of them by default) of the
+        given branches (all of them by default), up to max_batches
+        batches of each kind per branch
+        returns the number of rows moved by kind
+        '''
+        now = datetime.now()
+        moved = {}
+        for branch in branches():
+            if only and branch not in only:
+                continue
+            with use_branch(branch):
+                for kind, (model, archive, condition) in self.kinds(now).items():
+                    if kinds and kind not in kinds:
+                        continue
+                    moved.setdefault(kind, 0)
+                    batches = 0
+                    while max_batches is None or batches < max_batches:
+                        count = self.archive_batch(model, archive, condition, now)
+                        if not count:
+                            break
+                        moved[kind] += count
+                        batches += 1
+                        logging.info('archived %d %s of %s', moved[kind], kind, branch)
+                        time.sleep(self.pause)
+        if moved.get('appointments'):
+            counters.invalidate()
+        return moved
+
+
+archiver = Archiver()
+
+
+@click.command('archive')
+@click.option('--kind', 'kinds', multiple=True, type=click.Choice(['appointments', 'prescriptions']),
+              help='Only archive these rows, can be repeated')
+@click.option('--max-batches', type=int, help='Stop after this many batches of every kind')
+@click.option('--branch', 'only', multiple=True, help='Only archive these branches, can be repeated')
+@with_appcontext
+def archive_command(kinds, max_batches, only):
+    '''
+    Moves the old appointments and prescriptions to the archive tables
+    '''
+    archiver.init_app(current_app)
+    moved = archiver.archive(kinds, max_batches, only)
+    click.echo(', '.join(f'{count} {kind}' for kind, count in moved.items()) + ' archived')
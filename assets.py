@@ -0,0 +1,241 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import with_appcontext
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # the .br variants are only built when brotli is installed
+    brotli = None
+
+
+'''
+The files that are worth compressing, the images already are
+'''
+COMPRESSIBLE = ('.css', '.js', '.svg', '.html', '.txt', '.json')
+
+MANIFEST = 'manifest.json'
+
+'''
+The references of a stylesheet to other files: url(...) and @import "..."
+'''
+CSS_REFERENCE = re.compile(r'''url\(\s*(['"]?)(?P<url>[^'")]*?)\1\s*\)|@import\s+(['"])(?P<imported>[^'"]+)\3''')
+
+
+def fingerprint(path, digest):
+    '''
+    inserts the digest of a file in its name: css/style.css -> css/style.<digest>.css
+    '''
+    root, extension = os.path.splitext(path)
+    return f'{root}.{digest}{extension}'
+
+
+class AssetError(Exception):
+    '''
+    Raised when a stylesheet refers to a file the build cannot find
+    '''
+
+
+def _is_external(url):
+    '''
+    whether a reference is left as it is: a data URI, another site or a fragment
+    '''
+    return not url or url.startswith(('#', '//')) or ':' in url.split('/', 1)[0]
+
+
+def _resolve(path, url, static_url):
+    '''
+    the path in the static folder of the file that the reference url of the
+    stylesheet at path points to, as the browser resolves it from the
+    static URL of the stylesheet, None when it points out of the folder
+    '''
+    target = re.sub(r'\\(.)', r'\1', re.split(r'[?#]', url, 1)[0])
+    resolved = posixpath.normpath(posixpath.join(posixpath.dirname(f'{static_url}/{path}'), target))
+    prefix = static_url.rstrip('/') + '/'
+    return resolved[len(prefix):] if resolved.startswith(prefix) else None
+
+
+def _references(path, content, static_url, sources):
+    '''
+    the static paths the stylesheet at path refers to
+    '''
+    targets = set()
+    for match in CSS_REFERENCE.finditer(content):
+        url = match.group('url') if match.group('url') is not None else match.group('imported')
+        if _is_external(url):
+            continue
+        target = _resolve(path, url, static_url)
+        if target not in sources:
+            raise AssetError(f'{path}: {url} is not a file of the static folder')
+        targets.add(target)
+    return targets
+
+
+def _stylesheet_order(stylesheets):
+    '''
+    the stylesheets ordered so that every one comes after those it refers to
+    '''
+    order, done, visiting = [], set(), set()
+
+    def visit(path):
+        if path in done:
+            return
+        if path in visiting:
+            raise AssetError(f'{path} imports itself')
+        visiting.add(path)
+        for target in sorted(stylesheets[path]):
+            if target in stylesheets:
+                visit(target)
+        visiting.discard(path)
+        done.add(path)
+        order.append(path)
+
+    for path in sorted(stylesheets):
+        visit(path)
+    return order
+
+
+def build_assets(static_folder, output, static_url='/static'):
+    '''
+    Copies every file of the static folder to output under a fingerprinted
+    name, with .gz (and .br when brotli is installed) variants of the
+    compressible ones, and writes the manifest mapping the original names
+    to the fingerprinted ones
+
+    The url() and @import references of the stylesheets are rewritten to
+    the fingerprinted names, a stylesheet is built after the ones it
+    imports so that its own name covers theirs. A reference to a file
+    that is not in the static folder raises an AssetError.
+    returns the manifest
+    '''
+    sources = {}
+    for directory, _, files in os.walk(static_folder):
+        if os.path.abspath(directory).startswith(os.path.abspath(output)):
+            continue
+        for name in files:
+            source = os.path.join(directory, name)
+            with open(source, 'rb') as f:
+                sources[os.path.relpath(source, static_folder).replace(os.sep, '/')] = f.read()
+
+    stylesheets = {path: _references(path, content.decode(), static_url, sources)
+                   for path, content in sources.items() if path.endswith('.css')}
+    manifest = {}
+    shutil.rmtree(output, ignore_errors=True)
+
+    def write(path, content):
+        built = fingerprint(path, hashlib.sha256(content).hexdigest()[:12])
+        target = os.path.join(output, built)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(content)
+        if path.endswith(COMPRESSIBLE):
+            with open(target + '.gz', 'wb') as f:
+                f.write(gzip.compress(content, 9, mtime=0))
+            if brotli is not None:
+                with open(target + '.br', 'wb') as f:
+                    f.write(brotli.compress(content))
+        manifest[path] = built
+
+    for path in sorted(sources):
+        if path not in stylesheets:
+            write(path, sources[path])
+
+    for path in _stylesheet_order(stylesheets):
+        def rewrite(match):
+            url = match.group('url') if match.group('url') is not None else match.group('imported')
+            if _is_external(url):
+                return match.group(0)
+            suffix = url[len(re.split(r'[?#]', url, 1)[0]):]
+            built = posixpath.relpath(manifest[_resolve(path, url, static_url)], posixpath.dirname(path) or '.')
+            return match.group(0).replace(url, built.replace(' ', '\\ ') + suffix, 1)
+
+        write(path, CSS_REFERENCE.sub(rewrite, sources[path].decode()).encode())
+
+    with open(os.path.join(output, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class Assets:
+    '''
+    Fingerprinted static files
+
+    `asset_url('style.css')` in a template gives the URL of the built,
+    fingerprinted copy of static/style.css (see `flask build-assets`),
+    served under /assets/ with far-future cache headers, and precompressed
+    (brotli or gzip, as the browser accepts) when a variant was built.
+    Until the assets are built it falls back to the plain static URL.
+    '''
+
+    def __init__(self, max_age=365 * 24 * 3600):
+        self.max_age = max_age
+        self.output = None
+        self.manifest = {}
+        self.version = ''
+
+    def init_app(self, app):
+        self.max_age = app.config.get('ASSET_MAX_AGE', self.max_age)
+        self.output = app.config.get('ASSET_DIR') or os.path.join(app.static_folder, 'dist')
+        self.load()
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+        app.jinja_env.globals['asset_url'] = self.url
+
+    def load(self):
+        try:
+            with open(os.path.join(self.output, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+        # changes whenever a static file does, for the ETags of the pages
+        self.version = hashlib.sha256(json.dumps(self.manifest, sort_keys=True).encode()).hexdigest()[:12]
+
+    def url(self, path):
+        built = self.manifest.get(path)
+        if built is None:
+            return url_for('static', filename=path)
+        return url_for('assets', filename=built)
+
+    def serve(self, filename):
+        '''
+        sends a built asset, precompressed when the browser accepts it
+        '''
+        encodings = request.accept_encodings
+        for encoding, extension in (('br', '.br'), ('gzip', '.gz')):
+            variant = safe_join(self.output, filename + extension)
+            if encodings[encoding] and variant and os.path.isfile(variant):
+                response = send_from_directory(self.output, filename + extension, max_age=self.max_age,
+                                               mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(self.output, filename, max_age=self.max_age)
+
+        response.headers['Cache-Control'] = f'public, max-age={self.max_age}, immutable'
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+assets = Assets()
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    '''
+    Builds the fingerprinted and precompressed static files
+    '''
+    try:
+        manifest = build_assets(current_app.static_folder, assets.output, current_app.static_url_path)
+    except AssetError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Built {len(manifest)} assets in {assets.output}'
+               + ('' if brotli else ' (brotli is not installed, gzip only)'))
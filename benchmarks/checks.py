@@ -0,0 +1,459 @@
+'''
+Checks of what the benchmark does not cover, against copies of the 1k dataset
+
+The benchmark runs on a single SQLite database without built assets,
+these checks drive the application through the Flask test client with
+the databases and the files it does not have, and fail when a row or a
+read ends up in the wrong one, a file is missing or the app cannot start:
+
+    branches : two branches with their own SQLite files (BRANCH_DATABASES),
+               the clinical data is written to and read from the database
+               of its branch, the jobs run against the branch they were
+               queued from, the branch overview sums every database and a
+               deleted user is removed from all of them
+    assets   : the static files are built (flask build-assets) and every
+               file a built stylesheet imports or refers to is served
+    replica  : a replica SQLite file (REPLICA_DATABASE_URL), the GET
+               requests of the read only views read from it, the writes
+               and the reads that follow them stay on the primary
+    memory   : the app is created on an in-memory SQLite database
+               (DATABASE_URL=sqlite://), the local stand-in of the tests
+    legacy   : flask migrate on a database with the schema and the double
+               bookings of the first release
+    admission: a streamed export outlives ADMISSION_SLOT_SECONDS and still
+               holds its admission slot until it has been sent
+
+    python -m benchmarks.checks
+    python -m benchmarks.checks branches
+
+Every check runs in its own process, on its own copies of the dataset.
+'''
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.run import ROOT, dataset_path, logged_in
+
+
+class CheckFailed(AssertionError):
+    '''
+    Raised when the application does not behave as a check expects
+    '''
+
+
+def expect(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+
+
+def count(path, table, **where):
+    '''
+    the number of rows of table in the SQLite file path matching where,
+    read around the application
+    '''
+    clause = ' AND '.join(f'{column} = ?' for column in where) or '1'
+    with sqlite3.connect(path) as connection:
+        return connection.execute(f'SELECT count(*) FROM "{table}" WHERE {clause}', tuple(where.values())).fetchone()[0]
+
+
+def book(client, doctor_id):
+    '''
+    books the first free slot of a doctor as the patient logged in client
+    '''
+    slot = client.get(f'/slots?doctor_id={doctor_id}&count=1').get_json()['slots'][0]
+    return client.post('/bookappointment', data={
+        'firstname': 'Check', 'lastname': 'Patient', 'gender': 'male', 'slot': slot,
+        'phonenumber': '1', 'select-doctor': str(doctor_id), 'injury-condition': 'Malaria'})
+
+
+'''
+The branches with their own database in the branches check
+'''
+BRANCHES = ('north', 'south')
+
+
+def check_branches(app, workdir):
+    from benchmarks.dataset import PASSWORD
+    from cache import user_cache
+    from jobs import job_queue
+    from migrations import migrate
+    from models import db, User, Job
+
+    main = os.path.join(workdir, 'main.db')
+    files = {branch: os.path.join(workdir, f'{branch}.db') for branch in BRANCHES}
+
+    # doctorN and patientN move to the Nth branch, the appointments and
+    # prescriptions they had stay in the main database
+    users = {}
+    with app.app_context():
+        migrate()
+        for number, branch in enumerate(BRANCHES, 1):
+            doctor = User.query.filter_by(email=f'doctor{number}@bench.test').one()
+            patient = User.query.filter_by(email=f'patient{number}@bench.test').one()
+            doctor.branch = patient.branch = branch
+            users[branch] = doctor.id, doctor.email, patient.id, patient.email
+        db.session.commit()
+    user_cache.invalidate()
+    main_appointments = count(main, 'appointment')
+    main_prescriptions = count(main, 'prescription')
+
+    for branch, (doctor_id, doctor_email, patient_id, patient_email) in users.items():
+        response = book(logged_in(app, patient_email, PASSWORD), doctor_id)
+        expect(response.status_code == 302, f'{branch}: booking answered {response.status_code}')
+        response = logged_in(app, doctor_email, PASSWORD).post('/addprescription', data=dict(
+            drug='Paracetamol', quantity='Twice a day', condition='Malaria', patient=str(patient_id)))
+        expect(response.status_code < 400, f'{branch}: prescribing answered {response.status_code}')
+
+    for branch, (doctor_id, doctor_email, patient_id, patient_email) in users.items():
+        for other, path in files.items():
+            expected = 1 if other == branch else 0
+            expect(count(path, 'appointment', patient_id=patient_id) == expected,
+                   f'{branch}: {expected} appointment expected in the {other} database')
+            expect(count(path, 'prescription', patient_id=patient_id) == expected,
+                   f'{branch}: {expected} prescription expected in the {other} database')
+    expect(count(main, 'appointment') == main_appointments, 'a branch appointment was written to the main database')
+    expect(count(main, 'prescription') == main_prescriptions, 'a branch prescription was written to the main database')
+    print('ok  branches: the clinical data is written to the database of its branch')
+
+    north, south = (users[branch] for branch in BRANCHES)
+    response = logged_in(app, north[3], PASSWORD).get(f'/slots?doctor_id={south[0]}')
+    expect(response.status_code == 400, f'the slots of a doctor of another branch answered {response.status_code}')
+    print('ok  branches: the slots of a doctor of another branch are refused')
+
+    # the confirmations are queued in the main database, a job reading the
+    # main database instead of its branch's would find other rows by the same ids
+    outbox = os.path.join(workdir, 'outbox.jsonl')
+    with app.app_context():
+        queued = [job.arguments.get('branch') for job in Job.query.filter_by(status='queued')]
+        expect(sorted(queued) == sorted(BRANCHES * 2), f'jobs queued for the branches {queued}')
+        job_queue.init_app(app)
+        done, failed = job_queue.work(once=True)
+    expect((done, failed) == (4, 0), f'{done} jobs done, {failed} failed')
+    with open(outbox) as f:
+        recipients = sorted(json.loads(line)['email'] for line in f)
+    expected = sorted(patient_email for *_, patient_email in users.values()) * 2
+    expect(recipients == sorted(expected), f'notifications sent to {recipients}')
+    print('ok  branches: the jobs run against the branch they were queued from')
+
+    admin = logged_in(app, 'admin@bench.test', PASSWORD)
+    report = admin.get('/admin/branches?format=json').get_json()
+    rows = {row['branch']: row for row in report['branches']}
+    expect(list(rows) == [app.config['DEFAULT_BRANCH'], *BRANCHES], f'branches reported {list(rows)}')
+    databases = dict(files, **{app.config['DEFAULT_BRANCH']: main})
+    for branch, row in rows.items():
+        path = databases[branch]
+        expect(row['appointments'] == count(path, 'appointment'), f'{branch}: appointments {row["appointments"]}')
+        expect(row['prescriptions'] == count(path, 'prescription'), f'{branch}: prescriptions {row["prescriptions"]}')
+        expect(row['doctors'] == count(main, 'user', status='doctor', branch=branch), f'{branch}: doctors {row["doctors"]}')
+    expect(report['totals']['appointments'] == sum(count(path, 'appointment') for path in databases.values()),
+           'the appointments total is not the sum of the branches')
+    print('ok  branches: the branch overview reads every database')
+
+    branch = BRANCHES[0]
+    patient_id = users[branch][2]
+    before = sum(count(path, table, patient_id=patient_id)
+                 for path in databases.values() for table in ('appointment', 'prescription'))
+    others = {other: count(files[other], 'appointment') for other in BRANCHES[1:]}
+    admin.post('/admin/branch', data={'branch': branch})
+    admin.post('/admin/patients', data={'id': str(patient_id)})
+    expect(count(main, 'user', id=patient_id) == 0, f'{branch}: the patient was not deleted')
+    for name, path in databases.items():
+        for table in ('appointment', 'prescription'):
+            expect(count(path, table, patient_id=patient_id) == 0,
+                   f'{branch}: the {table}s of the deleted patient are left in the {name} database')
+    expect(before > 1, 'the deleted patient had no rows outside their branch')
+    expect(all(count(files[other], 'appointment') == n for other, n in others.items()),
+           'the appointments of another branch were deleted')
+    print('ok  branches: a deleted user is removed from every database')
+
+
+def check_replica(app, workdir):
+    import sqlalchemy as sa
+    from sqlalchemy.engine import Engine
+
+    from benchmarks.dataset import PASSWORD
+    from migrations import migrate
+    from models import db, User
+
+    primary = os.path.join(workdir, 'main.db')
+    replica = os.path.join(workdir, 'replica.db')
+
+    # the replica is a copy of the migrated primary where a doctor has
+    # another name, the pages show which of the two they were read from
+    with app.app_context():
+        migrate()
+        doctor_id = User.query.filter_by(email='doctor0@bench.test').one().id
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+    with sqlite3.connect(primary) as source, sqlite3.connect(replica) as target:
+        source.backup(target)
+    with sqlite3.connect(replica) as connection:
+        connection.execute("UPDATE user SET firstname = 'Replicated' WHERE id = ?", (doctor_id,))
+
+    statements = []
+
+    def track(connection, cursor, statement, *args):
+        kind = statement.split(None, 1)[0].upper()
+        if kind in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'):
+            statements.append((os.path.basename(connection.engine.url.database), kind))
+
+    sa.event.listen(Engine, 'before_cursor_execute', track)
+
+    def request(call):
+        '''
+        the response of call, the databases it read from and those it wrote to
+        '''
+        statements.clear()
+        response = call()
+        response.get_data()
+        return (response, {database for database, kind in statements if kind in ('SELECT', 'WITH')},
+                {database for database, kind in statements if kind not in ('SELECT', 'WITH')})
+
+    admin = logged_in(app, 'admin@bench.test', PASSWORD)
+    patient = logged_in(app, 'patient0@bench.test', PASSWORD)
+
+    # the logged in user is loaded before the view runs, from the primary
+    # (and then from the user cache)
+    admin.get('/admin/doctors')
+    patient.get('/patientdashboard')
+    response, databases, _ = request(lambda: admin.get('/admin/doctors'))
+    expect(databases == {'replica.db'}, f'GET /admin/doctors read from {databases}')
+    expect(b'Replicated' in response.data, 'GET /admin/doctors did not show the replica rows')
+    print('ok  replica: the read only views read from the replica')
+
+    appointments = count(primary, 'appointment')
+    response, _, writes = request(lambda: book(patient, doctor_id))
+    expect(response.status_code == 302, f'booking answered {response.status_code}')
+    expect(writes == {'main.db'}, f'the booking wrote to {writes}')
+    expect(count(primary, 'appointment') == appointments + 1, 'the booking is not in the primary')
+    expect(count(replica, 'appointment') == appointments, 'the booking was written to the replica')
+    print('ok  replica: the writes go to the primary')
+
+    _, databases, _ = request(lambda: patient.get('/patientdashboard'))
+    expect(databases == {'main.db'}, f'GET /patientdashboard after a booking read from {databases}')
+    _, databases, _ = request(lambda: admin.get('/admin/patients'))
+    expect(databases == {'replica.db'}, f'GET /admin/patients of another user read from {databases}')
+    time.sleep(app.config['REPLICA_STICKY_SECONDS'] + 0.1)
+    _, databases, _ = request(lambda: patient.get('/patientdashboard'))
+    expect(databases == {'replica.db'}, f'GET /patientdashboard once the writes are old read from {databases}')
+    print('ok  replica: a user reads their own writes from the primary for a while')
+
+
+def check_assets(app, workdir):
+    from urllib.parse import urljoin
+
+    from assets import CSS_REFERENCE, AssetError, assets, build_assets
+
+    manifest = build_assets(app.static_folder, assets.output, app.static_url_path)
+    assets.load()
+    client = app.test_client()
+    with app.test_request_context():
+        pending = [assets.url(path) for path in manifest if path.endswith('.css')]
+    fetched = set()
+    while pending:
+        url = pending.pop()
+        if url in fetched:
+            continue
+        fetched.add(url)
+        response = client.get(url, headers={'Accept-Encoding': 'identity'})
+        expect(response.status_code == 200, f'{url} answered {response.status_code}')
+        expect(url.startswith('/assets/'), f'{url} is not a built asset')
+        if url.endswith('.css'):
+            for match in CSS_REFERENCE.finditer(response.get_data(as_text=True)):
+                reference = match.group('url') if match.group('url') is not None else match.group('imported')
+                if not reference.startswith('data:'):
+                    pending.append(urljoin(url, reference.replace('\\ ', ' ')))
+    print(f'ok  assets: the built stylesheets and the {len(fetched)} files they lead to are served')
+
+    broken = os.path.join(workdir, 'broken')
+    os.makedirs(broken)
+    with open(os.path.join(broken, 'form.css'), 'w') as f:
+        f.write('@import url("missing.css");\n')
+    try:
+        build_assets(broken, os.path.join(broken, 'dist'))
+    except AssetError:
+        print('ok  assets: a reference to a missing file fails the build')
+    else:
+        raise CheckFailed('a stylesheet importing a missing file was built')
+
+
+def check_memory(app, workdir):
+    from benchmarks.dataset import PASSWORD
+    from models import db
+
+    with app.app_context():
+        db.create_all()
+        pool = type(db.engine.pool).__name__
+    response = app.test_client().post('/signup', data=dict(
+        firstname='Check', lastname='Patient', email='check@memory.test', phonenumber='1', status='patient',
+        gender='male', password=PASSWORD, confirm_password=PASSWORD))
+    expect(response.status_code == 302, f'signup answered {response.status_code}')
+    logged_in(app, 'check@memory.test', PASSWORD)
+    print(f'ok  memory: the app runs on an in-memory SQLite database ({pool})')
+
+
+'''
+The schema and rows of a database from before the migrations: the same
+doctor booked twice at 10:00 on the 1st of March 2023 (in two of the
+legacy date formats), and an appointment with a date that cannot be read
+'''
+LEGACY_DATABASE = '''
+CREATE TABLE user (id INTEGER PRIMARY KEY, firstname VARCHAR(100), lastname VARCHAR(100), email VARCHAR(100) UNIQUE,
+    phonenumber VARCHAR(100), gender VARCHAR(50), password VARCHAR(1000), status VARCHAR(50));
+CREATE TABLE appointment (id INTEGER PRIMARY KEY, firstname VARCHAR(100), lastname VARCHAR(100), gender VARCHAR(50),
+    date VARCHAR(50), time VARCHAR(50), phone_number VARCHAR(20), doctor_id INTEGER, patient_id INTEGER,
+    condition VARCHAR(50));
+CREATE TABLE prescription (id INTEGER PRIMARY KEY, drug VARCHAR(100), quantity VARCHAR(100),
+    condition VARCHAR(100), patient_id INTEGER, doctor_id INTEGER);
+INSERT INTO user VALUES (1, 'Ada', 'Eze', 'doctor@legacy.test', '1', 'female', '', 'doctor'),
+    (2, 'Ben', 'Ibe', 'patient@legacy.test', '1', 'male', '', 'patient');
+INSERT INTO appointment VALUES (1, 'Ben', 'Ibe', 'male', '2023-03-01', '10:00', '1', 1, 2, 'Malaria'),
+    (2, 'Ben', 'Ibe', 'male', '01/03/2023', '10:00 AM', '1', 1, 2, 'Malaria'),
+    (3, 'Ben', 'Ibe', 'male', '2023-03-02', '11:00', '1', 1, 2, 'Malaria'),
+    (4, 'Ben', 'Ibe', 'male', 'next week', '', '1', 1, 2, 'Malaria');
+INSERT INTO prescription VALUES (1, 'Paracetamol', 'Twice a day', 'Malaria', 2, 1);
+'''
+
+
+def check_legacy(app, workdir):
+    import sqlalchemy as sa
+
+    from migrations import UNIQUE_BOOKING, double_bookings, migrate_command
+    from models import db
+
+    database = os.path.join(workdir, 'legacy.db')
+    with sqlite3.connect(database) as connection:
+        connection.executescript(LEGACY_DATABASE)
+
+    def indexes():
+        with app.app_context():
+            return {index['name'] for index in sa.inspect(db.engine).get_indexes('appointment')}
+
+    result = app.test_cli_runner().invoke(migrate_command)
+    expect(result.exit_code == 0, f'flask migrate failed: {result.output}{result.exception!r}')
+    expect('appointments 1, 2' in result.output, f'flask migrate did not report the double booking: {result.output}')
+    expect(UNIQUE_BOOKING not in indexes(), f'{UNIQUE_BOOKING} was created over a double booking')
+    with app.app_context():
+        doubled = double_bookings()
+    expect(list(doubled.values()) == [[1, 2]], f'double bookings found {doubled}')
+    print('ok  legacy: flask migrate reports the double bookings and leaves the unique index out')
+
+    with sqlite3.connect(database) as connection:
+        connection.execute("UPDATE appointment SET starts_at = '2023-03-01 10:30:00.000000' WHERE id = 2")
+    result = app.test_cli_runner().invoke(migrate_command)
+    expect(result.exit_code == 0 and 'booked twice' not in result.output, f'flask migrate: {result.output}')
+    expect(UNIQUE_BOOKING in indexes(), f'{UNIQUE_BOOKING} was not created once the bookings were moved')
+    print('ok  legacy: the unique index is created once the double bookings are moved')
+
+
+def check_admission(app, workdir):
+    from benchmarks.dataset import PASSWORD
+    from migrations import migrate
+
+    with app.app_context():
+        migrate()
+    client = logged_in(app, 'admin@bench.test', PASSWORD)
+    export = client.get('/admin/export/appointments.csv', buffered=False)
+    chunks = iter(export.response)
+    expect(export.status_code == 200 and next(chunks), f'the export answered {export.status_code}')
+    time.sleep(app.config['ADMISSION_SLOT_SECONDS'] * 1.5)
+    expect(next(chunks, None), 'the export has a single chunk')
+    status = client.get('/admin/export/prescriptions.csv').status_code
+    expect(status == 503, f'a second export answered {status} while the first was being sent')
+    print('ok  admission: a streamed export holds its slot past ADMISSION_SLOT_SECONDS')
+
+    export.close()
+    status = client.get('/admin/export/prescriptions.csv').status_code
+    expect(status == 200, f'an export answered {status} once the first one was sent')
+    print('ok  admission: the slot is released once the export has been sent')
+
+
+CHECKS = {
+    'assets': check_assets,
+    'memory': check_memory,
+    'legacy': check_legacy,
+    'branches': check_branches,
+    'replica': check_replica,
+    'admission': check_admission,
+}
+
+
+def environment(name, workdir):
+    '''
+    the environment of the process of a check: its databases in workdir
+    '''
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{os.path.join(workdir, "main.db")}',
+               JOB_OUTBOX_PATH=os.path.join(workdir, 'outbox.jsonl'),
+               FRAGMENT_CACHE_PATH=os.path.join(workdir, 'fragments.db'),
+               ADMISSION_STORE_PATH=os.path.join(workdir, 'admission.db'),
+               ASSET_DIR=os.path.join(workdir, 'dist'),
+               LOGIN_RATE_PER_CLIENT='1000000', LOGIN_RATE_PER_EMAIL='1000000')
+    env.pop('REPLICA_DATABASE_URL', None)
+    env.pop('BRANCH_DATABASES', None)
+    if name == 'branches':
+        env['BRANCH_DATABASES'] = ','.join(
+            f'{branch}=sqlite:///{os.path.join(workdir, branch + ".db")}' for branch in BRANCHES)
+    if name == 'legacy':
+        env['DATABASE_URL'] = f'sqlite:///{os.path.join(workdir, "legacy.db")}'
+    if name == 'memory':
+        env['DATABASE_URL'] = 'sqlite://'
+    if name == 'admission':
+        env['ADMISSION_CONCURRENCY'] = 'export_table=1'
+        env['ADMISSION_SLOT_SECONDS'] = '1'
+    if name == 'replica':
+        env['REPLICA_DATABASE_URL'] = f'sqlite:///{os.path.join(workdir, "replica.db")}'
+        env['REPLICA_STICKY_SECONDS'] = '1'
+    return env
+
+
+def child(name, workdir):
+    '''
+    runs inside the process of one check, its databases are already set
+    '''
+    from application import create_app
+
+    app = create_app({'TESTING': True})
+    CHECKS[name](app, workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('check', nargs='*', help=f'the checks to run: {", ".join(CHECKS)} (default all)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(ROOT, '.bench'))
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        try:
+            child(args.child, args.workdir)
+        except CheckFailed as e:
+            print(f'FAILED {args.child}: {e}', file=sys.stderr)
+            return 1
+        return 0
+
+    unknown = [name for name in args.check if name not in CHECKS]
+    if unknown:
+        parser.error(f'unknown check {", ".join(unknown)}')
+
+    dataset = dataset_path(args.data_dir, '1k', args.seed)
+    failed = []
+    for name in args.check or CHECKS:
+        with tempfile.TemporaryDirectory() as workdir:
+            shutil.copyfile(dataset, os.path.join(workdir, 'main.db'))
+            command = [sys.executable, '-m', 'benchmarks.checks', '--child', name, '--workdir', workdir]
+            if subprocess.run(command, env=environment(name, workdir), cwd=ROOT).returncode:
+                failed.append(name)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
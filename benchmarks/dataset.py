@@ -0,0 +1,122 @@
+'''
+Seeded generator of a synthetic hospital
+
+The same scale and seed always give the same rows. Doctors get a
+skewed (Zipf like) share of the appointments, so the busiest doctor's
+pages show how the views behave for the heaviest users, and the
+appointments are spread over the past two years and the coming weeks.
+'''
+import random
+from datetime import datetime, time, timedelta
+
+import sqlalchemy as sa
+from werkzeug.security import generate_password_hash
+
+
+'''
+The dataset sizes, by total number of appointment rows
+'''
+SCALES = {
+    '1k': dict(doctors=10, patients=200, appointments=1_000, prescriptions=500),
+    '100k': dict(doctors=200, patients=20_000, appointments=100_000, prescriptions=50_000),
+    '1m': dict(doctors=1_000, patients=100_000, appointments=1_000_000, prescriptions=500_000),
+}
+
+PASSWORD = 'Benchmark1'
+FIRSTNAMES = ('Ada', 'Ben', 'Chioma', 'Dan', 'Efe', 'Femi', 'Grace', 'Hauwa', 'Ike', 'Joy', 'Kemi', 'Lola')
+LASTNAMES = ('Adeyemi', 'Bello', 'Chukwu', 'Danjuma', 'Eze', 'Fashola', 'Garba', 'Hassan', 'Ibe', 'Okafor')
+CONDITIONS = ('Malaria', 'Typhoid', 'Ulcer', 'Fracture', 'Migraine', 'Asthma', 'Hypertension', 'Check up')
+DRUGS = ('Paracetamol', 'Ibuprofen', 'Amoxicillin', 'Artemether', 'Omeprazole', 'Salbutamol', 'Lisinopril')
+
+BATCH_SIZE = 10_000
+
+
+def _batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _users(rng, counts, password):
+    for i in range(counts['doctors']):
+        yield dict(firstname=rng.choice(FIRSTNAMES), lastname=rng.choice(LASTNAMES),
+                   email=f'doctor{i}@bench.test', phonenumber=f'080{i:08d}',
+                   gender=rng.choice(('male', 'female')), password=password, status='doctor')
+    for i in range(counts['patients']):
+        yield dict(firstname=rng.choice(FIRSTNAMES), lastname=rng.choice(LASTNAMES),
+                   email=f'patient{i}@bench.test', phonenumber=f'070{i:08d}',
+                   gender=rng.choice(('male', 'female')), password=password, status='patient')
+    yield dict(firstname='Bench', lastname='Admin', email='admin@bench.test', phonenumber='0900000000',
+               gender='female', password=password, status='admin')
+
+
+def _appointments(rng, counts, doctor_ids, patient_ids, now, slot=timedelta(minutes=30)):
+    '''
+    appointments on free 30 minute slots between 08:00 and 17:00, from
+    two years back to eight weeks ahead
+    '''
+    weights = [1 / (rank + 1) ** 0.8 for rank in range(len(doctor_ids))]
+    first_day = now.date() - timedelta(days=730)
+    days = 730 + 56
+    slots_per_day = 18
+    booked = set()
+
+    for doctor_id in rng.choices(doctor_ids, weights, k=counts['appointments']):
+        while True:
+            day, index = rng.randrange(days), rng.randrange(slots_per_day)
+            if (doctor_id, day, index) not in booked:
+                booked.add((doctor_id, day, index))
+                break
+        starts_at = datetime.combine(first_day + timedelta(days=day), time(8)) + index * slot
+        # booked up to a month ahead
+        created_at = min(starts_at - timedelta(minutes=rng.randrange(30 * 24 * 60)), now)
+        yield dict(firstname=rng.choice(FIRSTNAMES), lastname=rng.choice(LASTNAMES),
+                   gender=rng.choice(('male', 'female')), starts_at=starts_at,
+                   phone_number='0800000000', doctor_id=doctor_id,
+                   patient_id=rng.choice(patient_ids), condition=rng.choice(CONDITIONS),
+                   created_at=created_at, updated_at=created_at)
+
+
+def _prescriptions(rng, counts, doctor_ids, patient_ids, now):
+    '''
+    prescriptions written over the past two years
+    '''
+    weights = [1 / (rank + 1) ** 0.8 for rank in range(len(doctor_ids))]
+    for doctor_id in rng.choices(doctor_ids, weights, k=counts['prescriptions']):
+        created_at = now - timedelta(minutes=rng.randrange(730 * 24 * 60))
+        yield dict(drug=rng.choice(DRUGS), quantity='One tablet morning and night',
+                   condition=rng.choice(CONDITIONS), patient_id=rng.choice(patient_ids), doctor_id=doctor_id,
+                   created_at=created_at, updated_at=created_at)
+
+
+def generate(db, scale, seed=0, password_method='pbkdf2:sha256:260000'):
+    '''
+    Creates the tables and fills them with the dataset of the given scale
+    all the users share the password PASSWORD, hashed once
+    '''
+    from models import User, Appointment, Prescription
+
+    counts = SCALES[scale]
+    rng = random.Random(seed)
+    now = datetime.now().replace(minute=0, second=0, microsecond=0)
+    password = generate_password_hash(PASSWORD, password_method)
+
+    db.create_all()
+    for batch in _batches(_users(rng, counts, password)):
+        db.session.execute(sa.insert(User), batch)
+    db.session.commit()
+
+    doctor_ids = [id for id, in db.session.query(User.id).filter_by(status='doctor').order_by(User.id)]
+    patient_ids = [id for id, in db.session.query(User.id).filter_by(status='patient').order_by(User.id)]
+
+    for batch in _batches(_appointments(rng, counts, doctor_ids, patient_ids, now)):
+        db.session.execute(sa.insert(Appointment), batch)
+        db.session.commit()
+    for batch in _batches(_prescriptions(rng, counts, doctor_ids, patient_ids, now)):
+        db.session.execute(sa.insert(Prescription), batch)
+        db.session.commit()
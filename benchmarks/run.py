@@ -0,0 +1,361 @@
+'''
+Benchmark of the application routes against a synthetic hospital
+
+Every route is driven through the Flask test client against a SQLite
+copy of a seeded dataset (see benchmarks/dataset.py), and the p50/p95
+latency and the number of SQL queries per request are reported.
+The run fails when a route issues more queries than in the stored
+baseline, or when its p95 grows past the baseline by more than the
+tolerance.
+
+    python -m benchmarks.run --scale 1k
+    python -m benchmarks.run --scale 1k --scale 100k --scale 1m
+    python -m benchmarks.run --scale 1k --update-baseline
+
+Every scale runs in its own process, the datasets are generated once
+and kept in --data-dir.
+'''
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class Bench:
+    '''
+    Times the requests of every route and counts their SQL queries
+    '''
+
+    def __init__(self, repeat):
+        import sqlalchemy as sa
+        from sqlalchemy.engine import Engine
+
+        self.repeat = repeat
+        self.queries = 0
+        self.results = {}
+        sa.event.listen(Engine, 'after_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.queries += 1
+
+    def measure(self, name, call, repeat=None):
+        '''
+        calls call(i) repeat times, call returns a test client response
+        '''
+        latencies, queries = [], []
+        for i in range(repeat or self.repeat):
+            self.queries = 0
+            started = time.perf_counter()
+            response = call(i)
+            response.get_data()  # streamed views render while the body is read
+            latencies.append(time.perf_counter() - started)
+            queries.append(self.queries)
+            if response.status_code >= 500:
+                raise RuntimeError(f'{name} answered {response.status_code}')
+
+        self.record(name, latencies, queries)
+
+    def record(self, name, latencies, queries):
+        self.results[name] = {
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'queries': max(queries),
+        }
+
+
+def logged_in(app, email, password):
+    client = app.test_client()
+    response = client.post('/login', data={'email': email, 'password': password})
+    assert response.status_code == 302, f'cannot log in as {email}'
+    return client
+
+
+def run_routes(bench, app):
+    '''
+    drives every route of the application
+    '''
+    from sqlalchemy import func
+
+    from benchmarks.dataset import PASSWORD
+    from models import db, User, Appointment
+
+    with app.app_context():
+        doctor_id, = db.session.query(Appointment.doctor_id).group_by(Appointment.doctor_id).order_by(
+            func.count().desc()).first()
+        patient_id, = db.session.query(Appointment.patient_id).group_by(Appointment.patient_id).order_by(
+            func.count().desc()).first()
+        doctor_email = db.session.get(User, doctor_id).email
+        patient_email = db.session.get(User, patient_id).email
+        last_appointment = db.session.query(func.max(Appointment.id)).scalar()
+        doctor_appointments = [id for id, in db.session.query(Appointment.id).filter_by(
+            doctor_id=doctor_id).order_by(Appointment.id).limit(bench.repeat)]
+        patient_appointments = [id for id, in db.session.query(Appointment.id).filter_by(
+            patient_id=patient_id).order_by(Appointment.id.desc()).limit(bench.repeat)]
+        other_appointments = [id for id, in db.session.query(Appointment.id).filter(
+            Appointment.doctor_id != doctor_id, Appointment.patient_id != patient_id).order_by(
+            Appointment.id.desc()).limit(bench.repeat)]
+        other_patients = [id for id, in db.session.query(User.id).filter(
+            User.status == 'patient', User.id != patient_id).order_by(User.id.desc()).limit(bench.repeat)]
+        # the profile views overwrite the user, they get users of their own
+        edited_doctor, = db.session.query(User.email).filter(
+            User.status == 'doctor', User.id != doctor_id).order_by(User.id).first()
+        edited_patient = db.session.query(User).filter(
+            User.status == 'patient', User.id != patient_id).order_by(User.id).first()
+        edited_patient = {column: getattr(edited_patient, column)
+                          for column in ('firstname', 'lastname', 'email', 'phonenumber', 'gender')}
+        other_doctors = [id for id, in db.session.query(User.id).filter(
+            User.status == 'doctor', User.id != doctor_id, User.email != edited_doctor).order_by(
+            User.id.desc()).limit(bench.repeat)]
+
+    def pick(ids, i):
+        return str(ids[i]) if i < len(ids) else '0'
+
+    bench.measure('login', lambda i: app.test_client().post(
+        '/login', data={'email': doctor_email, 'password': PASSWORD}))
+    bench.measure('signup', lambda i: app.test_client().post('/signup', data=dict(
+        firstname='New', lastname='Patient', email=f'new{i}@bench.test', phonenumber='1',
+        status='patient', gender='male', password=PASSWORD, confirm_password=PASSWORD)))
+    bench.measure('admin_signup', lambda i: app.test_client().post('/admin', data=dict(
+        firstname='New', lastname='Admin', email=f'newadmin{i}@bench.test', phonenumber='1',
+        gender='female', password=PASSWORD, confirm_password=PASSWORD)))
+    bench.measure('forgetpassword', lambda i: app.test_client().post('/forgetpassword', data={
+        'email': edited_patient['email'], 'password': PASSWORD, 'confirm-password': PASSWORD}))
+
+    admin = logged_in(app, 'admin@bench.test', PASSWORD)
+    doctor = logged_in(app, doctor_email, PASSWORD)
+    patient = logged_in(app, patient_email, PASSWORD)
+
+    bench.measure('index', lambda i: admin.get('/'))
+    bench.measure('admindashboard', lambda i: admin.get('/admin/dashboard'))
+    bench.measure('doctors', lambda i: admin.get('/admin/doctors'))
+    bench.measure('patients', lambda i: admin.get('/admin/patients'))
+    bench.measure('allAppointments', lambda i: admin.get('/admin/appointments'))
+    bench.measure('allAppointments (last page)', lambda i: admin.get(
+        f'/admin/appointments?before={last_appointment + 1}'))
+    bench.measure('export_table (busiest doctor)', lambda i: admin.get(
+        f'/admin/export/appointments.csv?doctor_id={doctor_id}'), repeat=3)
+    bench.measure('search (users)', lambda i: admin.get('/admin/search?kind=users&q=Okafr'))
+    bench.measure('search (appointments)', lambda i: admin.get('/admin/search?kind=appointments&q=Hypertenson'))
+    bench.measure('metrics', lambda i: admin.get('/metrics'))
+    bench.measure('stats', lambda i: admin.get('/admin/stats'))
+    bench.measure('branch_summaries', lambda i: admin.get('/admin/branches'))
+    bench.measure('switch_branch', lambda i: admin.post('/admin/branch', data={'branch': 'main'}))
+
+    bench.measure('doctordashboard', lambda i: doctor.get('/doctordashboard'))
+    bench.measure('doctorprofile', lambda i: doctor.get('/doctorappointments'))
+    bench.measure('doctorprofile (upcoming)', lambda i: doctor.get('/doctorappointments?when=upcoming'))
+    bench.measure('add_prescription (form)', lambda i: doctor.get('/addprescription'))
+    bench.measure('search_patients', lambda i: doctor.get('/patients/search?q=' + 'OBA'[i % 3:][:2]))
+    bench.measure('add_prescription', lambda i: doctor.post('/addprescription', data=dict(
+        drug='Paracetamol', quantity='Twice a day', condition='Malaria', patient=str(patient_id))))
+
+    editing_doctor = logged_in(app, edited_doctor, PASSWORD)
+    bench.measure('editdoctorprofile', lambda i: editing_doctor.get('/editdoctorprofile'))
+
+    bench.measure('patientdashboard', lambda i: patient.get('/patientdashboard'))
+    bench.measure('prescription', lambda i: patient.get('/prescriptions'))
+    bench.measure('patientappointment', lambda i: patient.get('/patientappointments'))
+    bench.measure('patientdata', lambda i: patient.get('/patientdata'))
+    bench.measure('patientdetails', lambda i: patient.get('/patientdetails'))
+    bench.measure('patientdetails (doctor)', lambda i: doctor.get(f'/patientdetails?patient_id={patient_id}'))
+    bench.measure('medicalhistory', lambda i: doctor.get(f'/patients/{patient_id}/history'))
+    bench.measure('medicalhistory_api', lambda i: doctor.get(f'/patients/{patient_id}/history.json'))
+    bench.measure('api appointments', lambda i: doctor.get('/api/v1/appointments?per_page=500'))
+    bench.measure('api appointments (ids)', lambda i: admin.get(
+        f'/api/v1/appointments?fields=id,starts_at&ids={",".join(map(str, doctor_appointments))}'))
+    bench.measure('medicalhistory (archived)', lambda i: doctor.get(f'/patients/{patient_id}/history?archived=1'))
+    etag = patient.get('/patientdashboard').headers['ETag']
+    bench.measure('patientdashboard (not modified)', lambda i: patient.get(
+        '/patientdashboard', headers={'If-None-Match': etag}))
+    bench.measure('bookappointment (form)', lambda i: patient.get('/bookappointment'))
+    bench.measure('free_slots', lambda i: patient.get(f'/slots?doctor_id={doctor_id}'))
+
+    def book(i):
+        slot = patient.get(f'/slots?doctor_id={doctor_id}&count=1').get_json()['slots'][0]
+        return patient.post('/bookappointment', data={
+            'firstname': 'Bench', 'lastname': 'Patient', 'gender': 'male', 'slot': slot,
+            'phonenumber': '1', 'select-doctor': str(doctor_id), 'injury-condition': 'Malaria'})
+    bench.measure('bookappointment', book)
+    editing_patient = logged_in(app, edited_patient['email'], PASSWORD)
+    bench.measure('editpatientprofile', lambda i: editing_patient.post('/editpatientprofile', data=edited_patient))
+
+    bench.measure('doctorprofile (delete)', lambda i: doctor.post(
+        '/doctorappointments', data={'id': pick(doctor_appointments, i)}))
+    bench.measure('patientdashboard (delete)', lambda i: patient.post(
+        '/patientdashboard', data={'id': pick(patient_appointments, i)}))
+    bench.measure('allAppointments (delete)', lambda i: admin.post(
+        '/admin/appointments', data={'id': pick(other_appointments, i)}))
+    bench.measure('patients (delete)', lambda i: admin.post(
+        '/admin/patients', data={'id': pick(other_patients, i)}))
+    bench.measure('doctors (delete)', lambda i: admin.post(
+        '/admin/doctors', data={'id': pick(other_doctors, i)}))
+
+    sessions = [logged_in(app, 'admin@bench.test', PASSWORD) for _ in range(3)]
+    bench.measure('logout', lambda i: sessions[i].get('/logout'), repeat=3)
+
+
+def child(args):
+    '''
+    runs inside the process of one scale, DATABASE_URL is already set
+    '''
+    if args.generate:
+        from application import create_app
+        from benchmarks.dataset import generate
+        from models import db
+
+        app = create_app()
+        with app.app_context():
+            generate(db, args.scale[0], args.seed, app.config['PASSWORD_HASH_METHOD'])
+        return
+
+    # the cold start of a worker: importing the app, creating it and
+    # serving its first request, timed before anything else is imported
+    started = time.perf_counter()
+    from application import create_app
+    imported = time.perf_counter()
+    app = create_app({'TESTING': True})
+    created = time.perf_counter()
+
+    bench = Bench(args.repeat)
+    bench.record('startup (import)', [imported - started], [0])
+    bench.record('startup (create_app)', [created - imported], [0])
+    bench.measure('startup (first request)', lambda i: app.test_client().get('/login'), repeat=1)
+
+    # datasets generated by an older tree lack the newer tables, columns and indexes
+    from migrations import migrate
+
+    with app.app_context():
+        migrate()
+
+    run_routes(bench, app)
+    with open(args.json_out, 'w') as f:
+        json.dump(bench.results, f)
+
+
+def dataset_path(data_dir, scale, seed):
+    '''
+    the SQLite file of the dataset of a scale, generated if needed
+    '''
+    os.makedirs(data_dir, exist_ok=True)
+    dataset = os.path.join(os.path.abspath(data_dir), f'hospital-{scale}-{seed}.db')
+    if not os.path.exists(dataset):
+        print(f'generating the {scale} dataset in {dataset}', file=sys.stderr)
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{dataset}')
+        subprocess.run([sys.executable, '-m', 'benchmarks.run', '--child', '--generate', '--scale', scale,
+                        '--seed', str(seed)], env=env, cwd=ROOT, check=True)
+    return dataset
+
+
+def run_scale(args, scale, workdir):
+    '''
+    generates the dataset of a scale if needed and benchmarks a copy of it
+    '''
+    dataset = dataset_path(args.data_dir, scale, args.seed)
+    command = [sys.executable, '-m', 'benchmarks.run', '--child', '--scale', scale,
+               '--seed', str(args.seed), '--repeat', str(args.repeat)]
+
+    database = os.path.join(workdir, f'{scale}.db')
+    shutil.copyfile(dataset, database)
+    results = os.path.join(workdir, f'{scale}.json')
+    # the routes are driven from a single client, far over the login rate limits,
+    # and the shared caches start empty
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{database}', LOGIN_RATE_PER_CLIENT='1000000',
+               LOGIN_RATE_PER_EMAIL='1000000', SIGNUP_RATE_PER_CLIENT='1000000',
+               FRAGMENT_CACHE_PATH=os.path.join(workdir, f'{scale}-fragments.db'),
+               ADMISSION_STORE_PATH=os.path.join(workdir, f'{scale}-admission.db'))
+    subprocess.run(command + ['--json-out', results], env=env, cwd=ROOT, check=True)
+    with open(results) as f:
+        return json.load(f)
+
+
+def report(results):
+    scales = list(results)
+    routes = list(results[scales[0]])
+    header = f'{"route":<32}' + ''.join(f'{scale + " p50/p95 ms":>24}{"queries":>9}' for scale in scales)
+    print(header)
+    print('-' * len(header))
+    for route in routes:
+        line = f'{route:<32}'
+        for scale in scales:
+            result = results[scale][route]
+            line += f'{result["p50_ms"]:>12.2f} /{result["p95_ms"]:>9.2f}{result["queries"]:>9}'
+        print(line)
+
+
+def compare(results, baseline, tolerance, slack_ms):
+    '''
+    returns the regressions of results against the baseline
+    '''
+    regressions = []
+    for scale, routes in results.items():
+        for route, result in routes.items():
+            expected = baseline.get(scale, {}).get(route)
+            if expected is None:
+                continue
+            if result['queries'] > expected['queries']:
+                regressions.append(f'{scale} {route}: {result["queries"]} queries, '
+                                   f'baseline {expected["queries"]}')
+            if result['p95_ms'] > expected['p95_ms'] * (1 + tolerance) + slack_ms:
+                regressions.append(f'{scale} {route}: p95 {result["p95_ms"]}ms, '
+                                   f'baseline {expected["p95_ms"]}ms')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', action='append', choices=['1k', '100k', '1m'],
+                        help='dataset scale, can be repeated (default 1k)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20, help='requests per route')
+    parser.add_argument('--data-dir', default=os.path.join(ROOT, '.bench'))
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed p95 growth, 0.5 = +50%%')
+    parser.add_argument('--slack-ms', type=float, default=5.0, help='allowed p95 growth in ms on top')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--generate', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--json-out', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.scale = args.scale or ['1k']
+
+    if args.child:
+        return child(args)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = {scale: run_scale(args, scale, workdir) for scale in args.scale}
+    report(results)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'baseline written to {args.baseline}')
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance, args.slack_ms)
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
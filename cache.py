@@ -0,0 +1,345 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class CounterCache:
+    '''
+    Process local cache for the dashboard counters
+
+    Values are computed on the first read and then kept up to date by the
+    model write paths through `incr`, or dropped through `invalidate`.
+    Writes made by other worker processes are not seen here, so every
+    value also expires after COUNTER_CACHE_TTL seconds.
+    '''
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def init_app(self, app):
+        self.ttl = app.config.get('COUNTER_CACHE_TTL', self.ttl)
+
+    def get(self, key, compute):
+        '''
+        returns the cached value for key, computing it when it is missing
+        or has expired
+        '''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+
+        value = compute()
+        with self._lock:
+            self._values[key] = (value, now + self.ttl)
+        return value
+
+    def incr(self, key, amount=1, field=None):
+        '''
+        adds amount to a cached counter, or to one field of a cached
+        dict of counters, nothing is done if the key is not cached
+        '''
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return
+            if field is None:
+                self._values[key] = (entry[0] + amount, entry[1])
+            else:
+                entry[0][field] = entry[0].get(field, 0) + amount
+
+    def invalidate(self, *keys):
+        '''
+        drops the given keys, or every key when none is given
+        '''
+        with self._lock:
+            if not keys:
+                self._values.clear()
+            for key in keys:
+                self._values.pop(key, None)
+
+
+counters = CounterCache()
+
+
+class LocalStore:
+    '''
+    Process local version counters of the fragment cache
+    the rendered fragments themselves are kept by the FragmentCache
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def version(self, role):
+        return self._versions.get(role, 0)
+
+    def versions(self, roles):
+        return tuple(self._versions.get(role, 0) for role in roles)
+
+    def bump(self, role):
+        with self._lock:
+            self._versions[role] = self._versions.get(role, 0) + 1
+
+    def get(self, name, version):
+        return None
+
+    def put(self, name, version, value):
+        pass
+
+
+class SQLiteStore:
+    '''
+    Version counters and rendered fragments kept in a local SQLite file,
+    shared by every worker process of the host
+
+    Each thread of each process gets its own connection (the connections
+    of a master process are not reused by the workers forked from it),
+    the file is in WAL mode so the readers do not wait for a writer.
+    '''
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connection().executescript('''
+            CREATE TABLE IF NOT EXISTS fragment_version (role TEXT PRIMARY KEY, version INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS fragment (name TEXT PRIMARY KEY, version INTEGER NOT NULL, value TEXT NOT NULL);
+        ''')
+
+    def _connection(self):
+        connection, pid = getattr(self._local, 'connection', (None, None))
+        if connection is None or pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = (connection, os.getpid())
+        return connection
+
+    def version(self, role):
+        row = self._connection().execute(
+            'SELECT version FROM fragment_version WHERE role = ?', (role,)).fetchone()
+        return row[0] if row else 0
+
+    def versions(self, roles):
+        '''
+        the versions of several roles in one query
+        '''
+        found = dict(self._connection().execute(
+            f'SELECT role, version FROM fragment_version WHERE role IN ({", ".join("?" * len(roles))})',
+            tuple(roles)))
+        return tuple(found.get(role, 0) for role in roles)
+
+    def bump(self, role):
+        self._connection().execute(
+            'INSERT INTO fragment_version (role, version) VALUES (?, 1) '
+            'ON CONFLICT (role) DO UPDATE SET version = version + 1', (role,))
+
+    def get(self, name, version):
+        row = self._connection().execute(
+            'SELECT value FROM fragment WHERE name = ? AND version = ?', (name, version)).fetchone()
+        return row[0] if row else None
+
+    def put(self, name, version, value):
+        # an older render finishing late never replaces a newer one
+        self._connection().execute(
+            'INSERT INTO fragment (name, version, value) VALUES (?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET version = excluded.version, value = excluded.value '
+            'WHERE excluded.version >= fragment.version', (name, version, value))
+
+
+def version_store(app):
+    '''
+    the version store of the caches: process local by default, the
+    FRAGMENT_CACHE_PATH SQLite file when it is set (a relative path is
+    in the instance folder)
+    '''
+    path = app.config.get('FRAGMENT_CACHE_PATH')
+    if not path:
+        return LocalStore()
+    os.makedirs(app.instance_path, exist_ok=True)
+    return SQLiteStore(os.path.join(app.instance_path, path))
+
+
+class UserCache:
+    '''
+    Process local LRU cache of the authenticated user identities
+
+    Keeps at most USER_CACHE_SIZE users for USER_CACHE_TTL seconds so the
+    login manager does not look the user up on every request.
+    Entries are plain dicts of the user columns (never ORM objects, which
+    would be bound to a session that is gone by the next request) and are
+    invalidated by the User write paths.
+
+    An invalidation bumps the version of the user (or of all the users)
+    in the version store shared with the fragment cache, an entry cached
+    under an older version is loaded again. With FRAGMENT_CACHE_PATH set
+    the versions are shared, an edit made by one worker is seen by all
+    the workers of the host on their next request, otherwise another
+    worker process sees it once its entry is USER_CACHE_TTL seconds old.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=300, store=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store = store or LocalStore()
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('USER_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('USER_CACHE_TTL', self.ttl)
+        self.store = version_store(app)
+
+    def get(self, key, load):
+        '''
+        returns the cached entry for key, or calls load() on a miss and
+        caches what it returns unless it is None
+        '''
+        now = time.monotonic()
+        version = self.store.versions(('users', f'user:{key}'))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now and entry[2] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation
+
+        value = load()
+        if value is None:
+            return None
+
+        with self._lock:
+            if generation != self._generation:
+                # invalidated while loading, the value may already be stale
+                return value
+            self._entries[key] = (value, now + self.ttl, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, *keys):
+        '''
+        drops the given keys, or every key when none is given, in every worker
+        '''
+        with self._lock:
+            self._generation += 1
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
+        for role in [f'user:{key}' for key in keys] or ['users']:
+            self.store.bump(role)
+
+    def stats(self):
+        '''
+        the hit/miss counters of the cache
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+user_cache = UserCache()
+
+
+class FragmentCache:
+    '''
+    Cache of rendered template fragments (the doctor and patient pick-lists)
+
+    Every fragment depends on one role ("doctor", "patient") and is cached
+    under the current version of that role, which the User write paths
+    bump through `bump`. A bump makes every fragment of the role stale at
+    once, whatever was rendered before it is never served again.
+
+    The versions and the fragments are process local by default, a bump
+    made by another worker process is not seen here and the fragments
+    expire after FRAGMENT_CACHE_TTL seconds as well. With FRAGMENT_CACHE_PATH
+    set they are kept in that SQLite file and shared by all the workers
+    of the host (see version_store).
+    '''
+
+    def __init__(self, store=None, ttl=300):
+        self.store = store or LocalStore()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rendered = {}
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('FRAGMENT_CACHE_TTL', self.ttl)
+        self.store = version_store(app)
+
+    def get(self, name, role, render):
+        '''
+        returns the fragment called name for the current version of role,
+        render() is only called when no worker has rendered that version
+        '''
+        version = self.store.version(role)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._rendered.get(name)
+            if entry is not None and entry[0] == version and entry[2] > now:
+                self.hits += 1
+                return entry[1]
+
+        value = self.store.get(name, version)
+        if value is None:
+            value = render()
+            self.store.put(name, version, value)
+            with self._lock:
+                self.misses += 1
+        else:
+            with self._lock:
+                self.shared_hits += 1
+
+        with self._lock:
+            entry = self._rendered.get(name)
+            if entry is None or entry[0] <= version:
+                self._rendered[name] = (version, value, now + self.ttl)
+        return value
+
+    def bump(self, *roles):
+        '''
+        makes the fragments of the given roles stale
+        '''
+        for role in roles:
+            self.store.bump(role)
+
+    def stats(self):
+        '''
+        the hit/miss counters of the cache
+        '''
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'store': type(self.store).__name__,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
+
+
+fragments = FragmentCache()
@@ -0,0 +1,67 @@
+import hashlib
+from datetime import timezone
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+from assets import assets
+from cache import fragments
+from models import db
+from routing import current_branch
+
+
+def latest_change(model, **filters):
+    '''
+    the number of rows of model matching filters and their latest
+    update, in a single query
+    '''
+    count, latest = db.session.query(db.func.count(model.id), db.func.max(model.updated_at)).filter_by(**filters).one()
+    return count, latest
+
+
+def conditional(changes, roles=(), until=None):
+    '''
+    Answers the GET requests of a per-user page with 304 Not Modified when
+    the browser's copy is still current, before anything is rendered
+
+    changes() returns the latest_change of every kind of row the page
+    shows. The ETag covers them (the row counts catch deletes), the
+    fragment cache versions of roles (whose names the page shows), the
+    logged in user and their branch, the query string and the static
+    assets. The Last-Modified header is the latest update, it is sent for
+    information only: a delete does not move it, so only the ETag is
+    checked.
+    until(), when given, returns the next time the page changes by time
+    alone (e.g. an appointment moving from upcoming to past), the ETag
+    covers it so the page is rendered again once that time has passed.
+    Pages with flashed messages are always rendered.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes') or not current_user.is_authenticated:
+                return view(*args, **kwargs)
+
+            marks = changes()
+            moment = until() if until is not None else None
+            versions = [fragments.store.version(role) for role in roles]
+            user = sorted(vars(current_user).items())
+            etag = hashlib.sha256(repr((request.full_path, user, current_branch(), versions, marks,
+                                        moment, assets.version)).encode()).hexdigest()[:32]
+            latest = max((updated_at for _, updated_at in marks if updated_at is not None), default=None)
+
+            if not is_resource_modified(request.environ, etag=etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            if latest is not None:
+                response.last_modified = latest.astimezone(timezone.utc)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
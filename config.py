@@ -0,0 +1,257 @@
+import os
+
+import sqlalchemy as sa
+from sqlalchemy.pool import QueuePool
+
+from routing import REPLICA, branch_bind
+
+
+'''
+The engine options only a QueuePool takes
+'''
+POOL_SIZING = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+def from_environ(environ=os.environ):
+    '''
+    Reads the configuration of the application from the environment
+    returns it as a dict for app.config, nothing is required at import time
+    '''
+    config = {}
+
+    '''
+    Setting up the database config
+    DATABASE_URL, when set, replaces the RDS_* variables (e.g. a local sqlite file)
+    '''
+    if 'DATABASE_URL' in environ:
+        config["SQLALCHEMY_DATABASE_URI"] = environ['DATABASE_URL']
+    elif 'RDS_HOSTNAME' in environ:
+        database_name = environ['RDS_DB_NAME']
+        database_username = environ['RDS_USERNAME']
+        database_password = environ['RDS_PASSWORD']
+
+        config["SQLALCHEMY_DATABASE_URI"] = 'mysql+pymysql://{}:{}@{}/{}'.format(
+            database_username, database_password, f"{environ['RDS_HOSTNAME']}:{environ['RDS_PORT']}", database_name)
+
+    '''
+    The optional read replica, read only views are served from it
+    either REPLICA_DATABASE_URL or the RDS_REPLICA_HOSTNAME of a replica
+    of the RDS database
+    '''
+    if 'REPLICA_DATABASE_URL' in environ:
+        config["SQLALCHEMY_BINDS"] = {REPLICA: environ['REPLICA_DATABASE_URL']}
+    elif 'RDS_REPLICA_HOSTNAME' in environ and 'RDS_HOSTNAME' in environ:
+        config["SQLALCHEMY_BINDS"] = {REPLICA: 'mysql+pymysql://{}:{}@{}/{}'.format(
+            database_username, database_password,
+            f"{environ['RDS_REPLICA_HOSTNAME']}:{environ.get('RDS_REPLICA_PORT', environ['RDS_PORT'])}",
+            database_name)}
+    config["REPLICA_STICKY_SECONDS"] = int(environ.get('REPLICA_STICKY_SECONDS', 5))
+
+    '''
+    The hospital branches: the clinical data (appointments, prescriptions
+    and their archives) of DEFAULT_BRANCH is kept in the main database,
+    the one of every branch of BRANCH_DATABASES ("code=url,code=url") in
+    its own database. The users and the logins stay in the main database.
+    '''
+    config["DEFAULT_BRANCH"] = environ.get('DEFAULT_BRANCH', 'main')
+    config["BRANCHES"] = [config["DEFAULT_BRANCH"]]
+    for item in environ.get('BRANCH_DATABASES', '').split(','):
+        branch, _, url = item.strip().partition('=')
+        if branch and url and branch != config["DEFAULT_BRANCH"]:
+            config.setdefault("SQLALCHEMY_BINDS", {})[branch_bind(branch)] = url
+            config["BRANCHES"].append(branch)
+
+    '''
+    How many branches the admin branch overview reads at once
+    '''
+    config["BRANCH_REPORT_WORKERS"] = int(environ.get('BRANCH_REPORT_WORKERS', 8))
+
+    '''
+    Connection pool of every engine: pool size and overflow, connections are
+    recycled before MySQL's wait_timeout closes them and checked before use
+    (see size_pools, the sizing only applies to the pooled databases)
+    '''
+    config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        'pool_size': int(environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 280)),
+        'pool_pre_ping': environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true',
+    }
+
+    config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    '''
+    Pagination of the admin list views
+    '''
+    config["PAGE_SIZE"] = int(environ.get('PAGE_SIZE', 50))
+    config["MAX_PAGE_SIZE"] = int(environ.get('MAX_PAGE_SIZE', 500))
+    config["PAGE_CHUNK_SIZE"] = int(environ.get('PAGE_CHUNK_SIZE', 100))
+
+    '''
+    How long the dashboard counters are cached for, in seconds
+    '''
+    config["COUNTER_CACHE_TTL"] = int(environ.get('COUNTER_CACHE_TTL', 60))
+
+    '''
+    Size and lifetime (in seconds) of the logged in user cache
+    '''
+    config["USER_CACHE_SIZE"] = int(environ.get('USER_CACHE_SIZE', 1024))
+    config["USER_CACHE_TTL"] = int(environ.get('USER_CACHE_TTL', 300))
+
+    '''
+    The rendered doctor / patient pick-lists: how long a worker keeps them
+    (in seconds) and the SQLite file that shares them, and the versions of
+    the cached users, between the workers of the host (relative to the
+    instance folder, they are process local when it is unset)
+    '''
+    config["FRAGMENT_CACHE_TTL"] = int(environ.get('FRAGMENT_CACHE_TTL', 300))
+    config["FRAGMENT_CACHE_PATH"] = environ.get('FRAGMENT_CACHE_PATH')
+
+    '''
+    Password hashing method (werkzeug format: algorithm and cost) and the
+    number of threads the hashing runs on
+    '''
+    config["PASSWORD_HASH_METHOD"] = environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    config["PASSWORD_SALT_LENGTH"] = int(environ.get('PASSWORD_SALT_LENGTH', 16))
+    config["PASSWORD_HASH_WORKERS"] = int(environ.get('PASSWORD_HASH_WORKERS', 4))
+
+    '''
+    The appointment slots: their length in minutes, the clinic opening hours,
+    how far ahead they can be booked (in days), how long a doctor's booked
+    slots are cached for (in seconds), how many are offered in the form and
+    for how many weeks a weekly series of appointments can be booked at once
+    '''
+    config["APPOINTMENT_SLOT_MINUTES"] = int(environ.get('APPOINTMENT_SLOT_MINUTES', 30))
+    config["CLINIC_OPENS"] = environ.get('CLINIC_OPENS', '08:00')
+    config["CLINIC_CLOSES"] = environ.get('CLINIC_CLOSES', '17:00')
+    config["SLOT_HORIZON_DAYS"] = int(environ.get('SLOT_HORIZON_DAYS', 60))
+    config["SLOT_INDEX_TTL"] = int(environ.get('SLOT_INDEX_TTL', 60))
+    config["SLOTS_OFFERED"] = int(environ.get('SLOTS_OFFERED', 20))
+    config["APPOINTMENT_SERIES_MAX_WEEKS"] = int(environ.get('APPOINTMENT_SERIES_MAX_WEEKS', 26))
+
+    '''
+    The type-ahead patient search: the number of results returned by default
+    and at most, and whether the patients are searched in an in memory prefix
+    index (rebuilt on user writes or after PATIENT_SEARCH_INDEX_TTL seconds)
+    rather than with indexed prefix queries
+    '''
+    config["PATIENT_SEARCH_LIMIT"] = int(environ.get('PATIENT_SEARCH_LIMIT', 10))
+    config["PATIENT_SEARCH_MAX_LIMIT"] = int(environ.get('PATIENT_SEARCH_MAX_LIMIT', 50))
+    config["PATIENT_SEARCH_INDEX"] = environ.get('PATIENT_SEARCH_INDEX', 'false').lower() == 'true'
+    config["PATIENT_SEARCH_INDEX_TTL"] = int(environ.get('PATIENT_SEARCH_INDEX_TTL', 300))
+
+    '''
+    Number of results per page of the admin search
+    '''
+    config["SEARCH_PAGE_SIZE"] = int(environ.get('SEARCH_PAGE_SIZE', 20))
+
+    '''
+    The background jobs run by `flask jobs work`: how often a failed job is
+    tried, the retry delays (doubled on every attempt), how long a worker
+    holds a job, when and in which batches the appointment reminders go out,
+    and the transport of the notifications ("local" writes them to
+    JOB_OUTBOX_PATH, or "module:Class" of a real transport)
+    '''
+    config["JOB_MAX_ATTEMPTS"] = int(environ.get('JOB_MAX_ATTEMPTS', 5))
+    config["JOB_BACKOFF_SECONDS"] = int(environ.get('JOB_BACKOFF_SECONDS', 30))
+    config["JOB_MAX_BACKOFF_SECONDS"] = int(environ.get('JOB_MAX_BACKOFF_SECONDS', 3600))
+    config["JOB_LEASE_SECONDS"] = int(environ.get('JOB_LEASE_SECONDS', 300))
+    config["REMINDER_LEAD_HOURS"] = int(environ.get('REMINDER_LEAD_HOURS', 24))
+    config["REMINDER_INTERVAL_SECONDS"] = int(environ.get('REMINDER_INTERVAL_SECONDS', 600))
+    config["REMINDER_BATCH_SIZE"] = int(environ.get('REMINDER_BATCH_SIZE', 100))
+    config["JOB_TRANSPORT"] = environ.get('JOB_TRANSPORT', 'local')
+    config["JOB_OUTBOX_PATH"] = environ.get('JOB_OUTBOX_PATH')
+
+    '''
+    The archiving of the old rows by `flask archive`: the appointments
+    that started this many days ago, the prescriptions written this many
+    days ago, the rows moved per transaction and the seconds to wait
+    between two transactions
+    '''
+    config["ARCHIVE_APPOINTMENTS_AFTER_DAYS"] = int(environ.get('ARCHIVE_APPOINTMENTS_AFTER_DAYS', 365))
+    config["PRESCRIPTION_ACTIVE_DAYS"] = int(environ.get('PRESCRIPTION_ACTIVE_DAYS', 180))
+    config["ARCHIVE_BATCH_SIZE"] = int(environ.get('ARCHIVE_BATCH_SIZE', 1000))
+    config["ARCHIVE_BATCH_PAUSE"] = float(environ.get('ARCHIVE_BATCH_PAUSE', 0.1))
+
+    '''
+    Admission control: the requests served at once by the expensive
+    endpoints ("endpoint=limit,..." for the whole host), the login and
+    signup attempts allowed per minute (per client address and per email),
+    the Retry-After of the shed requests, and the SQLite file sharing the
+    limits between the workers (instance/admission.db by default, the
+    limits are process local when it is empty). A slot left by a dead
+    worker expires after ADMISSION_SLOT_SECONDS, a streamed response
+    keeps extending its own until it has been sent
+    '''
+    config["ADMISSION_CONCURRENCY"] = environ.get(
+        'ADMISSION_CONCURRENCY', 'login=8,signup=4,allAppointments=4,doctorprofile=8,export_table=2,search=4')
+    config["LOGIN_RATE_PER_CLIENT"] = int(environ.get('LOGIN_RATE_PER_CLIENT', 30))
+    config["LOGIN_RATE_PER_EMAIL"] = int(environ.get('LOGIN_RATE_PER_EMAIL', 10))
+    config["SIGNUP_RATE_PER_CLIENT"] = int(environ.get('SIGNUP_RATE_PER_CLIENT', 10))
+    config["ADMISSION_RETRY_AFTER"] = int(environ.get('ADMISSION_RETRY_AFTER', 1))
+    config["ADMISSION_STORE_PATH"] = environ.get('ADMISSION_STORE_PATH')
+    config["ADMISSION_SLOT_SECONDS"] = int(environ.get('ADMISSION_SLOT_SECONDS', 60))
+
+    '''
+    The number of proxies in front of the app, the client address of a
+    request is read from the X-Forwarded-For header they set. 0 when the
+    clients connect directly, which must not trust a header they can set
+    themselves (the Elastic Beanstalk config sets 1 for the nginx of the
+    instance)
+    '''
+    config["TRUSTED_PROXY_HOPS"] = int(environ.get('TRUSTED_PROXY_HOPS', 0))
+
+    '''
+    Queries and requests slower than these (in seconds) are logged
+    '''
+    config["SLOW_QUERY_SECONDS"] = float(environ.get('SLOW_QUERY_SECONDS', 0.5))
+    config["SLOW_REQUEST_SECONDS"] = float(environ.get('SLOW_REQUEST_SECONDS', 2.0))
+
+    '''
+    The key signing the session cookies, it must be the same in every
+    worker: without SECRET_KEY, create_app makes up one per master process
+    '''
+    config["SECRET_KEY"] = environ.get('SECRET_KEY')
+
+    '''
+    Where the compiled templates are cached between restarts, and whether
+    create_app compiles all of them up front (before gunicorn forks its
+    workers when the app is preloaded)
+    '''
+    config["JINJA_CACHE_DIR"] = environ.get('JINJA_CACHE_DIR')
+    config["PRECOMPILE_TEMPLATES"] = environ.get('PRECOMPILE_TEMPLATES', 'true').lower() == 'true'
+
+    '''
+    Where `flask build-assets` writes the fingerprinted static files
+    (static/dist by default) and how long browsers may keep them
+    '''
+    config["ASSET_DIR"] = environ.get('ASSET_DIR')
+    config["ASSET_MAX_AGE"] = int(environ.get('ASSET_MAX_AGE', 365 * 24 * 3600))
+
+    return config
+
+
+def engine_options(url, options):
+    '''
+    the engine options of the database at url: the pool sizing is left
+    out when its engine does not use a QueuePool (e.g. an in-memory SQLite
+    database, which keeps a single connection)
+    '''
+    url = sa.engine.make_url(url)
+    if issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        return dict(options)
+    return {key: value for key, value in options.items() if key not in POOL_SIZING}
+
+
+def size_pools(config):
+    '''
+    Gives the main database and every bind the SQLALCHEMY_ENGINE_OPTIONS
+    that fit its engine, once the configuration is complete
+    '''
+    options = config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+    if config.get("SQLALCHEMY_DATABASE_URI"):
+        config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(config["SQLALCHEMY_DATABASE_URI"], options)
+    config["SQLALCHEMY_BINDS"] = {
+        key: dict(engine_options(value, options), url=value) if isinstance(value, (str, sa.engine.URL)) else value
+        for key, value in config.get("SQLALCHEMY_BINDS", {}).items()}
@@ -0,0 +1,183 @@
+import csv
+import io
+import json
+import sys
+import zlib
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from flask.cli import with_appcontext
+
+from models import db, Appointment, Prescription
+from routing import REPLICA, branch_bind, branches, current_branch, use_branch
+
+
+'''
+The tables that can be exported, with the column their date range
+filter applies to
+'''
+EXPORTS = {
+    'appointments': (Appointment.__table__, Appointment.__table__.c.starts_at),
+    'prescriptions': (Prescription.__table__, None),
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+class ExportError(ValueError):
+    '''
+    Raised when an export is asked for with filters it does not support
+    '''
+
+
+def parse_day(value):
+    '''
+    parses a YYYY-MM-DD day filter, None stays None
+    '''
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ExportError(f'{value} is not a YYYY-MM-DD date')
+
+
+def export_rows(kind, doctor_id=None, patient_id=None, start=None, end=None, chunk_size=1000):
+    '''
+    Returns a generator of the rows of an export as dicts, in id order
+    the filters are checked here rather than once the export has started
+    streaming, `end` is inclusive
+    '''
+    table, date_column = EXPORTS[kind]
+    if (start or end) and date_column is None:
+        raise ExportError(f'{kind} cannot be filtered by date')
+
+    filters = []
+    if doctor_id is not None:
+        filters.append(table.c.doctor_id == doctor_id)
+    if patient_id is not None:
+        filters.append(table.c.patient_id == patient_id)
+    if start is not None:
+        filters.append(date_column >= start)
+    if end is not None:
+        filters.append(date_column < end + timedelta(days=1))
+
+    # the rows of the current branch, from its own database when it has
+    # one, else from the replica of the main one when there is one
+    engine = db.engines.get(branch_bind(current_branch())) or db.engines.get(REPLICA, db.engine)
+    return _read_chunks(engine, table, filters, chunk_size)
+
+
+def _read_chunks(engine, table, filters, chunk_size):
+    '''
+    The table is read in keyset chunks of chunk_size rows, each on its own
+    connection and transaction with a streamed (server side) cursor, so
+    neither memory nor the length of any transaction grows with the size
+    of the export.
+    '''
+    last_id = 0
+    while True:
+        query = sa.select(table).where(table.c.id > last_id, *filters).order_by(table.c.id).limit(chunk_size)
+        count = 0
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(query)
+            for row in result.mappings():
+                count += 1
+                last_id = row['id']
+                yield dict(row)
+        if count < chunk_size:
+            return
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return value
+
+
+def encode_rows(rows, fmt, chunk_rows=500):
+    '''
+    Encodes rows as CSV (with a header line) or JSON lines
+    yields one string per chunk_rows rows
+    '''
+    buffer = io.StringIO()
+    writer = None
+    count = 0
+
+    for row in rows:
+        if fmt == 'csv':
+            if writer is None:
+                writer = csv.DictWriter(buffer, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow({key: _value(value) for key, value in row.items()})
+        else:
+            buffer.write(json.dumps({key: _value(value) for key, value in row.items()}))
+            buffer.write('\n')
+
+        count += 1
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_chunks(chunks):
+    '''
+    gzips a stream of strings on the fly
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(kind, fmt='csv', gzip=False, chunk_size=1000, **filters):
+    '''
+    The full export pipeline: rows -> encoded text -> (gzipped) bytes
+    '''
+    chunks = encode_rows(export_rows(kind, chunk_size=chunk_size, **filters), fmt)
+    if gzip:
+        return gzip_chunks(chunks)
+    return (chunk.encode('utf-8') for chunk in chunks)
+
+
+@click.command('export')
+@click.argument('kind', type=click.Choice(list(EXPORTS)))
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='csv', show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help='File to write to (defaults to stdout)')
+@click.option('--doctor-id', type=int)
+@click.option('--patient-id', type=int)
+@click.option('--from', 'start', help='First day, YYYY-MM-DD')
+@click.option('--to', 'end', help='Last day, YYYY-MM-DD')
+@click.option('--gzip', is_flag=True, help='Compress the output')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows read per query')
+@click.option('--branch', help='The branch to export (defaults to DEFAULT_BRANCH)')
+@with_appcontext
+def export_command(kind, fmt, output, doctor_id, patient_id, start, end, gzip, chunk_size, branch):
+    '''
+    Streams the appointment or prescription table as CSV or JSON lines
+    '''
+    if branch and branch not in branches():
+        raise click.BadParameter(f'{branch} is not one of {", ".join(branches())}', param_hint='--branch')
+    try:
+        with use_branch(branch or current_branch()):
+            chunks = export(kind, fmt, gzip, chunk_size, doctor_id=doctor_id, patient_id=patient_id,
+                            start=parse_day(start), end=parse_day(end))
+        out = open(output, 'wb') if output else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if output:
+                out.close()
+    except ExportError as e:
+        raise click.BadParameter(str(e))
@@ -0,0 +1,26 @@
+'''
+gunicorn settings
+
+The app is created once in the master process (preload_app) and the
+workers are forked from it, so they start with the modules imported and
+the templates compiled instead of each doing it on its first request.
+Database connections must not be shared across a fork, the engines of
+every worker drop the pooled connections they inherited.
+'''
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+preload_app = True
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+
+def post_fork(server, worker):
+    from models import db
+    from wsgi import application
+
+    with application.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
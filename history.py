@@ -0,0 +1,122 @@
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from models import db, User, Appointment, AppointmentArchive, Prescription, PrescriptionArchive
+
+
+'''
+The rows of the medical history, by kind of entry: their hot and archive
+models and the columns they fill besides the time the entry was written
+and its condition, the start of an appointment and the drug and quantity
+of a prescription
+'''
+HISTORY = {
+    'appointment': (Appointment, AppointmentArchive, ('starts_at',)),
+    'prescription': (Prescription, PrescriptionArchive, ('drug', 'quantity')),
+}
+
+HISTORY_COLUMNS = (('starts_at', sa.DateTime), ('drug', sa.String(100)), ('quantity', sa.String(100)))
+
+
+def _cursor(entry):
+    return f'{entry.created_at.isoformat()}_{entry.kind}_{entry.id}'
+
+
+def parse_cursor(cursor):
+    '''
+    reads the (created_at, kind, id) of the entry a page continues after,
+    returns None when there is no cursor or it cannot be understood
+    '''
+    try:
+        created_at, kind, id = cursor.split('_')
+        if kind not in HISTORY:
+            return None
+        return datetime.fromisoformat(created_at), kind, int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _after(table, kind, cursor):
+    '''
+    the condition of the entries of kind that come after the cursor,
+    entries are ordered by created_at, kind and id, all descending
+    '''
+    created_at, cursor_kind, id = cursor
+    if kind > cursor_kind:
+        return table.c.created_at < created_at
+    if kind < cursor_kind:
+        return table.c.created_at <= created_at
+    return sa.or_(table.c.created_at < created_at, sa.and_(table.c.created_at == created_at, table.c.id < id))
+
+
+def _entries(kind, model, patient_id, cursor, limit):
+    '''
+    the `limit` latest entries of kind in the table of model after the
+    cursor, a backward range scan on its (patient_id, created_at, id) index
+    '''
+    filled = HISTORY[kind][2]
+    table = model.__table__
+    columns = [table.c[name] if name in filled else sa.cast(sa.null(), type_).label(name)
+               for name, type_ in HISTORY_COLUMNS]
+
+    query = sa.select(sa.literal(kind, sa.String(20)).label('kind'), table.c.id, table.c.created_at,
+                      table.c.condition, *columns, sa.literal('archived_at' in table.c).label('archived'),
+                      table.c.doctor_id)
+    query = query.where(table.c.patient_id == patient_id, table.c.created_at.is_not(None))
+    if cursor is not None:
+        query = query.where(_after(table, kind, cursor))
+    return query.order_by(table.c.created_at.desc(), table.c.id.desc()).limit(limit).subquery()
+
+
+class HistoryPage:
+    '''
+    One page of the medical history of a patient, newest entries first
+
+    The page is a single UNION ALL of the latest per_page + 1 appointments
+    and prescriptions after the cursor, each LIMITed on its own index, so
+    the first page of a long history costs the same as a short one.
+    The archive tables (see archive.py) are only read with archived set,
+    the archived rows keep their ids so the cursors work across both.
+    The entries are read from the database of the current branch, the
+    names of their doctors from the main one in a second query.
+    '''
+
+    def __init__(self, patient_id, per_page, after=None, archived=False):
+        self.after = after
+        self.archived = archived
+        models = [(kind, model) for kind, (hot, archive, _) in HISTORY.items()
+                  for model in ((hot, archive) if archived else (hot,))]
+        branches = [_entries(kind, model, patient_id, parse_cursor(after), per_page + 1) for kind, model in models]
+        union = sa.union_all(*(sa.select(branch) for branch in branches)).subquery()
+        query = sa.select(union).order_by(union.c.created_at.desc(), union.c.kind.desc(),
+                                          union.c.id.desc()).limit(per_page + 1)
+
+        rows = db.session.execute(query).all()
+        self.entries = rows[:per_page]
+        self.next_cursor = _cursor(self.entries[-1]) if len(rows) > per_page else None
+        doctor_ids = {entry.doctor_id for entry in self.entries}
+        self.doctors = {row.id: row for row in db.session.query(User.id, User.firstname, User.lastname).filter(
+            User.id.in_(doctor_ids))} if doctor_ids else {}
+
+    def doctor_name(self, entry):
+        '''
+        the name of the doctor of an entry, empty when they were removed
+        '''
+        doctor = self.doctors.get(entry.doctor_id)
+        return f'{doctor.firstname} {doctor.lastname}' if doctor else ''
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def as_dicts(self):
+        '''
+        the entries as JSON serializable dicts
+        '''
+        return [{'kind': entry.kind, 'id': entry.id, 'archived': bool(entry.archived),
+                 'created_at': entry.created_at.isoformat(),
+                 'condition': entry.condition,
+                 'starts_at': entry.starts_at.isoformat() if entry.starts_at else None,
+                 'drug': entry.drug, 'quantity': entry.quantity,
+                 'doctor': {'id': entry.doctor_id, 'name': self.doctor_name(entry)}}
+                for entry in self.entries]
@@ -0,0 +1,297 @@
+import csv
+import itertools
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup, with_appcontext
+from werkzeug.security import generate_password_hash
+
+from cache import counters, fragments
+from models import db, User, Appointment, Prescription
+from passwords import passwords
+from routing import branches, current_branch, use_branch
+from slots import slot_index
+from validation import (parse_starts_at, validate_appointment, validate_prescription,
+                        validate_user, APPOINTMENT_FIELDS, PRESCRIPTION_FIELDS, USER_FIELDS)
+
+
+@click.group('import', cls=AppGroup)
+@click.option('--branch', help='The branch the rows are imported into (defaults to DEFAULT_BRANCH)')
+@with_appcontext
+def import_cli(branch):
+    '''
+    Bulk import users, appointments and prescriptions from CSV or JSONL files
+    '''
+    if branch:
+        if branch not in branches():
+            raise click.BadParameter(f'{branch} is not one of {", ".join(branches())}', param_hint='--branch')
+        click.get_current_context().with_resource(use_branch(branch))
+
+
+def read_rows(path):
+    '''
+    Streams the rows of a CSV (with a header line) or JSONL file
+    yields the line number and the row as a dict
+    '''
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line_number, line in enumerate(f, start=1):
+                if line.strip():
+                    yield line_number, json.loads(line)
+        else:
+            for line_number, row in enumerate(csv.DictReader(f), start=2):
+                yield line_number, row
+
+
+def batches(rows, size):
+    '''
+    groups an iterable in lists of at most size items
+    '''
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class ImportReport:
+    '''
+    Counts the rows of an import and keeps the rejected ones
+    '''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.read = 0
+        self.inserted = 0
+        self.rejected = []
+
+    def reject(self, line_number, reason):
+        self.rejected.append((line_number, reason))
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.inserted / elapsed if elapsed else 0.0
+        return (f'{self.read} rows read, {self.inserted} inserted, {len(self.rejected)} rejected '
+                f'in {elapsed:.1f}s ({rate:.0f} rows/s)')
+
+
+def _int_fields(row, fields):
+    '''
+    converts the id fields of a row, returns False if one is not a number
+    '''
+    try:
+        for field in fields:
+            row[field] = int(row[field])
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def _statuses(ids):
+    '''
+    maps the given user ids to their status, the users of other branches are left out
+    '''
+    return dict(db.session.query(User.id, User.status).filter(User.id.in_(set(ids)),
+                                                               User.branch == current_branch()))
+
+
+def _insert(model, rows, report):
+    '''
+    inserts a batch with a single executemany and commits it
+    '''
+    if not rows:
+        return
+    try:
+        db.session.execute(sa.insert(model), [row for _, row in rows])
+        db.session.commit()
+        report.inserted += len(rows)
+    except sa.exc.IntegrityError as e:
+        db.session.rollback()
+        for line_number, _ in rows:
+            report.reject(line_number, f'batch failed: {e.orig}')
+
+
+def import_users(path, batch_size, processes, prehashed, report):
+    '''
+    imports users, hashing their passwords in `processes` worker processes
+    (none are started for prehashed passwords)
+    '''
+    hash_password = partial(generate_password_hash, method=passwords.method,
+                            salt_length=passwords.salt_length)
+
+    with nullcontext() if prehashed else ProcessPoolExecutor(processes) as pool:
+        for batch in batches(read_rows(path), batch_size):
+            report.read += len(batch)
+            valid, emails = [], set()
+
+            for line_number, row in batch:
+                row = {field: row.get(field) for field in USER_FIELDS}
+                error = validate_user(row)
+                if not error and row['email'] in emails:
+                    error = 'Email repeated in the file'
+                if error:
+                    report.reject(line_number, error)
+                    continue
+                emails.add(row['email'])
+                valid.append((line_number, row))
+
+            existing = {email for email, in db.session.query(User.email).filter(User.email.in_(emails))}
+            rows = []
+            for line_number, row in valid:
+                if row['email'] in existing:
+                    report.reject(line_number, 'User already exist')
+                else:
+                    rows.append((line_number, row))
+
+            if not prehashed:
+                hashes = pool.map(hash_password, [row['password'] for _, row in rows],
+                                  chunksize=max(1, len(rows) // 64))
+                for (_, row), password in zip(rows, hashes):
+                    row['password'] = password
+
+            _insert(User, rows, report)
+            click.echo(report.summary())
+
+    counters.invalidate()
+    fragments.bump('doctor', 'patient')
+
+
+def import_appointments(path, batch_size, report):
+    '''
+    imports appointments, the doctors and patients must already exist
+    '''
+    for batch in batches(read_rows(path), batch_size):
+        report.read += len(batch)
+        valid = []
+
+        for line_number, row in batch:
+            row = {field: row.get(field) for field in APPOINTMENT_FIELDS}
+            error = validate_appointment(row)
+            if not error and not _int_fields(row, ('doctor_id', 'patient_id')):
+                error = 'Unknown doctor or patient'
+            if error:
+                report.reject(line_number, error)
+                continue
+            row['starts_at'] = parse_starts_at(row['starts_at'])
+            valid.append((line_number, row))
+
+        statuses = _statuses([row['doctor_id'] for _, row in valid] + [row['patient_id'] for _, row in valid])
+        booked = set(db.session.query(Appointment.doctor_id, Appointment.starts_at).filter(
+            sa.tuple_(Appointment.doctor_id, Appointment.starts_at).in_(
+                [(row['doctor_id'], row['starts_at']) for _, row in valid]))) if valid else set()
+
+        rows = []
+        for line_number, row in valid:
+            slot = (row['doctor_id'], row['starts_at'])
+            if statuses.get(row['doctor_id']) != 'doctor' or statuses.get(row['patient_id']) != 'patient':
+                report.reject(line_number, 'Unknown doctor or patient')
+            elif slot in booked:
+                report.reject(line_number, 'The doctor already has an appointment at this time')
+            else:
+                booked.add(slot)
+                rows.append((line_number, row))
+
+        _insert(Appointment, rows, report)
+        click.echo(report.summary())
+
+    counters.invalidate()
+    slot_index.invalidate()
+
+
+def import_prescriptions(path, batch_size, report):
+    '''
+    imports prescriptions, the doctors and patients must already exist
+    '''
+    for batch in batches(read_rows(path), batch_size):
+        report.read += len(batch)
+        valid = []
+
+        for line_number, row in batch:
+            row = {field: row.get(field) for field in PRESCRIPTION_FIELDS}
+            error = validate_prescription(row)
+            if not error and not _int_fields(row, ('doctor_id', 'patient_id')):
+                error = 'Unknown doctor or patient'
+            if error:
+                report.reject(line_number, error)
+                continue
+            valid.append((line_number, row))
+
+        statuses = _statuses([row['doctor_id'] for _, row in valid] + [row['patient_id'] for _, row in valid])
+        rows = []
+        for line_number, row in valid:
+            if statuses.get(row['doctor_id']) != 'doctor' or statuses.get(row['patient_id']) != 'patient':
+                report.reject(line_number, 'Unknown doctor or patient')
+            else:
+                rows.append((line_number, row))
+
+        _insert(Prescription, rows, report)
+        click.echo(report.summary())
+
+
+def _finish(report, rejects):
+    '''
+    prints the summary of an import and writes out the rejected rows
+    '''
+    click.echo(report.summary())
+    if rejects:
+        with open(rejects, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['line', 'reason'])
+            writer.writerows(report.rejected)
+        click.echo(f'Rejected rows written to {rejects}')
+    else:
+        for line_number, reason in report.rejected[:20]:
+            click.echo(f'  line {line_number}: {reason}')
+
+
+batch_size_option = click.option('--batch-size', default=1000, show_default=True,
+                                  help='Number of rows inserted per transaction')
+rejects_option = click.option('--rejects', type=click.Path(dir_okay=False),
+                              help='CSV file to write the rejected rows to')
+
+
+@import_cli.command('users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@batch_size_option
+@rejects_option
+@click.option('--processes', type=int, help='Number of processes hashing the passwords (defaults to the CPU count)')
+@click.option('--prehashed', is_flag=True, help='The passwords in the file are already hashed')
+def import_users_command(path, batch_size, rejects, processes, prehashed):
+    '''
+    Imports users (firstname, lastname, email, phonenumber, gender, password, status)
+    '''
+    report = ImportReport()
+    import_users(path, batch_size, processes, prehashed, report)
+    _finish(report, rejects)
+
+
+@import_cli.command('appointments')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@batch_size_option
+@rejects_option
+def import_appointments_command(path, batch_size, rejects):
+    '''
+    Imports appointments (firstname, lastname, gender, starts_at, phone_number, doctor_id, patient_id, condition)
+    '''
+    report = ImportReport()
+    import_appointments(path, batch_size, report)
+    _finish(report, rejects)
+
+
+@import_cli.command('prescriptions')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@batch_size_option
+@rejects_option
+def import_prescriptions_command(path, batch_size, rejects):
+    '''
+    Imports prescriptions (drug, quantity, condition, patient_id, doctor_id)
+    '''
+    report = ImportReport()
+    import_prescriptions(path, batch_size, report)
+    _finish(report, rejects)
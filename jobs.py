@@ -0,0 +1,311 @@
+import importlib
+import json
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.orm import selectinload
+
+from models import db, Appointment, Job, Prescription
+from routing import branches, use_branch
+
+
+jobs_cli = AppGroup('jobs', help='Run the background jobs (notifications and appointment reminders)')
+
+
+class LocalTransport:
+    '''
+    Stand-in transport that delivers nothing: the messages are appended
+    to JOB_OUTBOX_PATH as JSON lines, or logged when it is not set
+    '''
+
+    def __init__(self, app):
+        self.path = app.config.get('JOB_OUTBOX_PATH')
+
+    def send(self, messages):
+        if not self.path:
+            for message in messages:
+                logging.info('notification to %s: %s', message['email'], message['subject'])
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for message in messages:
+                f.write(json.dumps(message) + '\n')
+
+
+def load_transport(app):
+    '''
+    the transport named by JOB_TRANSPORT: "local" or the "module:Class"
+    of a class taking the app and sending lists of messages
+    (dicts of email, phone, subject and body)
+    '''
+    name = app.config.get('JOB_TRANSPORT', 'local')
+    if name == 'local':
+        return LocalTransport(app)
+    module, _, cls = name.partition(':')
+    return getattr(importlib.import_module(module), cls)(app)
+
+
+def _message(user, phone, subject, body):
+    return {'email': user.email, 'phone': phone or user.phonenumber, 'subject': subject, 'body': body}
+
+
+def _appointment_message(appointment, subject):
+    doctor = appointment.doctor
+    return _message(appointment.patient, appointment.phone_number, subject,
+                    f'Your appointment with Dr. {doctor.firstname} {doctor.lastname} '
+                    f'is on {appointment.date} at {appointment.time}.')
+
+
+def _appointments(ids):
+    return Appointment.query.options(selectinload(Appointment.doctor), selectinload(Appointment.patient)).filter(
+        Appointment.id.in_(ids)).order_by(Appointment.id).all()
+
+
+def booking_confirmation(queue, appointment_id=None, appointment_ids=()):
+    '''
+    tells the patient their appointment is booked, the appointments of a
+    series are confirmed in a single message
+    (the jobs queued before series existed have a single appointment_id)
+    '''
+    appointments = _appointments(list(appointment_ids) or [appointment_id])
+    if len(appointments) == 1:
+        queue.transport.send([_appointment_message(appointments[0], 'Appointment booked')])
+    elif appointments:
+        doctor = appointments[0].doctor
+        dates = ', '.join(f'{appointment.date} at {appointment.time}' for appointment in appointments)
+        queue.transport.send([_message(
+            appointments[0].patient, appointments[0].phone_number, 'Appointments booked',
+            f'Your {len(appointments)} appointments with Dr. {doctor.firstname} {doctor.lastname} '
+            f'are on {dates}.')])
+
+
+def prescription_notice(queue, prescription_id=None, prescription_ids=()):
+    '''
+    tells the patient a doctor prescribed them drugs, in a single message
+    for all the drugs of a prescription
+    '''
+    prescriptions = Prescription.query.options(selectinload(Prescription.doctor), selectinload(
+        Prescription.patient)).filter(Prescription.id.in_(list(prescription_ids) or [prescription_id])).order_by(
+        Prescription.id).all()
+    if not prescriptions:
+        return
+    doctor = prescriptions[0].doctor
+    drugs = '; '.join(f'{prescription.drug}: {prescription.quantity}' for prescription in prescriptions)
+    queue.transport.send([_message(
+        prescriptions[0].patient, None, 'New prescription',
+        f'Dr. {doctor.firstname} {doctor.lastname} prescribed you {drugs}.')])
+
+
+def send_reminders(queue, appointment_ids):
+    '''
+    reminds a batch of patients of their upcoming appointment, the ones
+    deleted since the batch was scheduled are skipped
+    '''
+    messages = [_appointment_message(appointment, 'Appointment reminder')
+                for appointment in _appointments(appointment_ids)]
+    if messages:
+        queue.transport.send(messages)
+
+
+def schedule_reminders(queue, until=None):
+    '''
+    Queues the reminders of the appointments starting between `until`
+    (where the previous run stopped) and REMINDER_LEAD_HOURS from now,
+    in batches of REMINDER_BATCH_SIZE, and queues the next run of the
+    scheduler REMINDER_INTERVAL_SECONDS later. Appointments booked for
+    less than the lead time ahead only get their booking confirmation.
+    '''
+    now = datetime.now()
+    start = datetime.fromisoformat(until) if until else now
+    end = now + queue.reminder_lead
+
+    ids = [id for id, in db.session.query(Appointment.id).filter(
+        Appointment.starts_at > start, Appointment.starts_at <= end).order_by(Appointment.starts_at)]
+    for i in range(0, len(ids), queue.reminder_batch_size):
+        Job.enqueue('send_reminders', appointment_ids=ids[i:i + queue.reminder_batch_size])
+
+    Job.enqueue('schedule_reminders', run_at=now + queue.reminder_interval, until=max(start, end).isoformat())
+
+
+'''
+The function running each kind of job, with the job's payload as keyword arguments
+'''
+HANDLERS = {
+    'booking_confirmation': booking_confirmation,
+    'prescription_notice': prescription_notice,
+    'send_reminders': send_reminders,
+    'schedule_reminders': schedule_reminders,
+}
+
+
+class JobQueue:
+    '''
+    The worker side of the job table
+
+    A worker claims the due jobs a batch at a time (SKIP LOCKED on MySQL,
+    so several workers never claim the same job) by marking them running
+    under its name for JOB_LEASE_SECONDS. A job whose worker died is
+    claimed again once its lease has expired. The rows a job writes and
+    its completion are committed together (in one transaction per database
+    when the job's branch has its own, see routing.py). A job runs against
+    the branch it was queued from. A failed job is retried after
+    JOB_BACKOFF_SECONDS, doubled on every attempt, and marked failed
+    after JOB_MAX_ATTEMPTS attempts.
+    '''
+
+    def __init__(self):
+        self.max_attempts = 5
+        self.backoff = 30
+        self.max_backoff = 3600
+        self.lease = timedelta(seconds=300)
+        self.reminder_lead = timedelta(hours=24)
+        self.reminder_interval = timedelta(seconds=600)
+        self.reminder_batch_size = 100
+        self.transport = None
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    def init_app(self, app):
+        self.max_attempts = app.config.get('JOB_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff = app.config.get('JOB_BACKOFF_SECONDS', self.backoff)
+        self.max_backoff = app.config.get('JOB_MAX_BACKOFF_SECONDS', self.max_backoff)
+        self.lease = timedelta(seconds=app.config.get('JOB_LEASE_SECONDS', 300))
+        self.reminder_lead = timedelta(hours=app.config.get('REMINDER_LEAD_HOURS', 24))
+        self.reminder_interval = timedelta(seconds=app.config.get('REMINDER_INTERVAL_SECONDS', 600))
+        self.reminder_batch_size = app.config.get('REMINDER_BATCH_SIZE', self.reminder_batch_size)
+        self.transport = load_transport(app)
+
+    def claim(self, limit):
+        '''
+        marks up to limit due jobs as running for this worker and returns them
+        '''
+        now = datetime.now()
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        due = sa.or_(Job.status == 'queued', sa.and_(Job.status == 'running', Job.locked_until < now))
+        ids = [id for id, in db.session.query(Job.id).filter(due, Job.run_at <= now).order_by(
+            Job.run_at, Job.id).limit(limit).with_for_update(skip_locked=True)]
+        if ids:
+            Job.query.filter(Job.id.in_(ids), due).update({
+                'status': 'running', 'locked_by': self.worker, 'locked_until': now + self.lease,
+                'attempts': Job.attempts + 1}, synchronize_session=False)
+        db.session.commit()
+        if not ids:
+            return []
+        return Job.query.filter(Job.id.in_(ids), Job.status == 'running',
+                                Job.locked_by == self.worker).order_by(Job.run_at, Job.id).all()
+
+    def run(self, job):
+        '''
+        runs a claimed job, returns whether it succeeded
+        '''
+        arguments = job.arguments
+        try:
+            with use_branch(arguments.pop('branch', None) or branches()[0]):
+                HANDLERS[job.kind](self, **arguments)
+            job.status = 'done'
+            job.locked_until = None
+            db.session.commit()
+            return True
+        except Exception as e:
+            db.session.rollback()
+            logging.exception('job %s (%s) failed', job.id, job.kind)
+            job.last_error = f'{type(e).__name__}: {e}'
+            job.locked_until = None
+            if job.attempts >= self.max_attempts:
+                job.status = 'failed'
+            else:
+                job.status = 'queued'
+                job.run_at = datetime.now() + timedelta(
+                    seconds=min(self.backoff * 2 ** (job.attempts - 1), self.max_backoff))
+            db.session.commit()
+            return False
+
+    def work(self, batch_size=10, poll=1.0, once=False):
+        '''
+        runs the due jobs until stopped, or until none is due when once is set
+        returns the number of jobs run and of jobs that failed
+        '''
+        done = failed = 0
+        while True:
+            jobs = self.claim(batch_size)
+            for job in jobs:
+                if self.run(job):
+                    done += 1
+                else:
+                    failed += 1
+            if not jobs:
+                if once:
+                    return done, failed
+                time.sleep(poll)
+
+    def start_scheduler(self):
+        '''
+        queues the reminder scheduler of every branch it is not already queued for
+        returns the branches it was queued for
+        '''
+        scheduled = {job.arguments.get('branch') or branches()[0] for job in Job.query.filter(
+            Job.kind == 'schedule_reminders', Job.status.in_(('queued', 'running')))}
+        started = [branch for branch in branches() if branch not in scheduled]
+        for branch in started:
+            Job.enqueue('schedule_reminders', branch=branch)
+        db.session.commit()
+        return started
+
+    def stats(self):
+        '''
+        the number of jobs of every status
+        '''
+        rows = db.session.query(Job.status, sa.func.count(Job.id)).group_by(Job.status)
+        return {status: count for status, count in rows}
+
+    def purge(self, older_than):
+        '''
+        removes the done jobs created before older_than, returns how many
+        '''
+        deleted = Job.query.filter(Job.status == 'done', Job.created_at < older_than).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+job_queue = JobQueue()
+
+
+@jobs_cli.command('work')
+@click.option('--batch-size', default=10, show_default=True, help='Number of jobs claimed at a time')
+@click.option('--poll', default=1.0, show_default=True, help='Seconds to wait when no job is due')
+@click.option('--once', is_flag=True, help='Stop once no job is due')
+@click.option('--no-scheduler', is_flag=True, help='Do not queue the reminder scheduler')
+def work_command(batch_size, poll, once, no_scheduler):
+    '''
+    Runs the background jobs
+    '''
+    job_queue.init_app(current_app)
+    if not no_scheduler:
+        job_queue.start_scheduler()
+    done, failed = job_queue.work(batch_size, poll, once)
+    click.echo(f'{done} jobs done, {failed} failed')
+
+
+@jobs_cli.command('stats')
+def stats_command():
+    '''
+    Prints the number of jobs of every status
+    '''
+    for status, count in sorted(job_queue.stats().items()):
+        click.echo(f'{status}: {count}')
+
+
+@jobs_cli.command('purge')
+@click.option('--days', default=30, show_default=True, help='Age of the done jobs to remove')
+def purge_command(days):
+    '''
+    Removes the old done jobs
+    '''
+    deleted = job_queue.purge(datetime.now() - timedelta(days=days))
+    click.echo(f'{deleted} jobs removed')
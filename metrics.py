@@ -0,0 +1,208 @@
+import bisect
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Default latency buckets, in seconds
+'''
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    '''
+    A thread safe latency histogram with fixed buckets
+    keeps the count per bucket (upper bounds, in seconds), the total
+    number of observations and their sum
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        '''
+        returns the cumulative count for every bucket bound, the last
+        bound being '+Inf', along with the count and the sum
+        '''
+        with self._lock:
+            counts, count, total = list(self._counts), self.count, self.sum
+
+        cumulative, running = [], 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'count': count, 'sum': total}
+
+
+'''
+Buckets of the number of SQL queries a request issues
+'''
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _labels(labels):
+    return ','.join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def format_histogram(name, snapshot, labels=None):
+    '''
+    renders a histogram snapshot in the Prometheus text format
+    '''
+    labels = labels or {}
+    lines = []
+    for bound, count in snapshot['buckets']:
+        lines.append(f'{name}_bucket{{{_labels(dict(labels, le=bound))}}} {count}')
+    suffix = f'{{{_labels(labels)}}}' if labels else ''
+    lines.append(f'{name}_sum{suffix} {snapshot["sum"]}')
+    lines.append(f'{name}_count{suffix} {snapshot["count"]}')
+    return lines
+
+
+def format_value(name, value, labels=None):
+    '''
+    renders a counter or gauge in the Prometheus text format
+    '''
+    suffix = f'{{{_labels(labels)}}}' if labels else ''
+    return [f'{name}{suffix} {value}']
+
+
+def when_sent(app):
+    '''
+    registers the decorated function(exc) to run once the response of a
+    request has been sent, a teardown runs after the last chunk of a
+    streamed response (its request context is kept until then)
+    '''
+    return app.teardown_request
+
+
+class RequestMetrics:
+    '''
+    Per endpoint request metrics of this process
+
+    For every request it records the latency, the number of SQL queries
+    and the time spent in them (counted through the SQLAlchemy engine
+    events), and logs the queries slower than SLOW_QUERY_SECONDS and the
+    requests slower than SLOW_REQUEST_SECONDS.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.sql_queries = {}
+        self.sql_time = {}
+        self.responses = {}
+        self.slow_queries = 0
+        self.slow_query_seconds = 0.5
+        self.slow_request_seconds = 2.0
+        self._listening = False
+
+    def init_app(self, app):
+        self.slow_query_seconds = app.config.get('SLOW_QUERY_SECONDS', self.slow_query_seconds)
+        self.slow_request_seconds = app.config.get('SLOW_REQUEST_SECONDS', self.slow_request_seconds)
+
+        if not self._listening:
+            # every engine, including the replica and the ones created later
+            event.listen(Engine, 'before_cursor_execute', self._before_query)
+            event.listen(Engine, 'after_cursor_execute', self._after_query)
+            self._listening = True
+
+        @app.before_request
+        def start_request_timer():
+            g.metrics_started = time.perf_counter()
+            g.sql_queries = 0
+            g.sql_time = 0.0
+
+        @app.after_request
+        def remember_status(response):
+            g.metrics_status = response.status_code
+            return response
+
+        @when_sent(app)
+        def record_request(exc):
+            if 'metrics_started' not in g:
+                return
+            self.observe(request.endpoint or 'unmatched',
+                         g.get('metrics_status', 500),
+                         time.perf_counter() - g.metrics_started,
+                         g.sql_queries, g.sql_time)
+
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    def _after_query(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_started
+        if has_request_context():
+            g.sql_queries = g.get('sql_queries', 0) + 1
+            g.sql_time = g.get('sql_time', 0.0) + elapsed
+        if elapsed >= self.slow_query_seconds:
+            with self._lock:
+                self.slow_queries += 1
+            logger.warning('slow query (%.3fs) in %s: %s', elapsed,
+                           request.endpoint if has_request_context() else '-', statement)
+
+    def _histogram(self, histograms, endpoint, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            if endpoint not in histograms:
+                histograms[endpoint] = Histogram(buckets)
+            return histograms[endpoint]
+
+    def observe(self, endpoint, status, seconds, queries, sql_seconds):
+        self._histogram(self.latency, endpoint).observe(seconds)
+        self._histogram(self.sql_queries, endpoint, QUERY_COUNT_BUCKETS).observe(queries)
+        self._histogram(self.sql_time, endpoint).observe(sql_seconds)
+        with self._lock:
+            key = (endpoint, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+        if seconds >= self.slow_request_seconds:
+            logger.warning('slow request (%.3fs, %d queries, %.3fs in SQL) to %s',
+                           seconds, queries, sql_seconds, endpoint)
+
+    def render(self):
+        '''
+        the request metrics in the Prometheus text format
+        '''
+        with self._lock:
+            latency = dict(self.latency)
+            sql_queries = dict(self.sql_queries)
+            sql_time = dict(self.sql_time)
+            responses = dict(self.responses)
+            slow_queries = self.slow_queries
+
+        lines = ['# TYPE http_request_duration_seconds histogram']
+        for endpoint, histogram in sorted(latency.items()):
+            lines += format_histogram('http_request_duration_seconds', histogram.snapshot(), {'endpoint': endpoint})
+        lines.append('# TYPE http_request_sql_queries histogram')
+        for endpoint, histogram in sorted(sql_queries.items()):
+            lines += format_histogram('http_request_sql_queries', histogram.snapshot(), {'endpoint': endpoint})
+        lines.append('# TYPE http_request_sql_seconds histogram')
+        for endpoint, histogram in sorted(sql_time.items()):
+            lines += format_histogram('http_request_sql_seconds', histogram.snapshot(), {'endpoint': endpoint})
+        lines.append('# TYPE http_responses_total counter')
+        for (endpoint, status), count in sorted(responses.items()):
+            lines += format_value('http_responses_total', count, {'endpoint': endpoint, 'status': status})
+        lines.append('# TYPE sql_slow_queries_total counter')
+        lines += format_value('sql_slow_queries_total', slow_queries)
+        return lines
+
+
+request_metrics = RequestMetrics()
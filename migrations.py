@@ -0,0 +1,344 @@
+import logging
+from datetime import datetime
+
+import click
+import sqlalchemy as sa
+from flask.cli import with_appcontext
+
+from models import db, Appointment, Prescription, User
+from routing import SHARDED, branch_bind, branches
+from search import create_search_tables
+
+
+'''
+Formats the appointment date and time strings were saved with
+before they were stored as a single DateTime column
+'''
+LEGACY_DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y', '%d-%m-%Y')
+LEGACY_TIME_FORMATS = ('%H:%M', '%H:%M:%S', '%I:%M%p', '%I:%M %p', '%I%p')
+
+
+def parse_legacy_schedule(date, time):
+    '''
+    Parses the legacy appointment date and time strings into a datetime
+    returns None when the strings cannot be understood
+    '''
+    if not date:
+        return None
+    date, time = date.strip(), (time or '00:00').strip().upper()
+
+    for date_format in LEGACY_DATE_FORMATS:
+        try:
+            day = datetime.strptime(date, date_format).date()
+            break
+        except ValueError:
+            continue
+    else:
+        return None
+
+    for time_format in LEGACY_TIME_FORMATS:
+        try:
+            return datetime.combine(day, datetime.strptime(time, time_format).time())
+        except ValueError:
+            continue
+    return None
+
+
+'''
+The unique index that stops a doctor from being booked twice at the same time
+'''
+UNIQUE_BOOKING = 'uq_appointment_doctor_starts_at'
+
+
+def double_bookings(engine=None):
+    '''
+    the ids of the appointments a doctor has at the same time, by
+    (doctor_id, starts_at): the legacy schema let them be booked and the
+    UNIQUE_BOOKING index cannot be created while there are any
+    engine defaults to the main database
+    '''
+    table = Appointment.__table__
+    slot = (table.c.doctor_id, table.c.starts_at)
+    doubled = sa.select(*slot).where(table.c.starts_at.is_not(None)).group_by(*slot).having(
+        sa.func.count() > 1).subquery()
+    query = sa.select(table.c.id, *slot).join(doubled, sa.and_(
+        table.c.doctor_id == doubled.c.doctor_id, table.c.starts_at == doubled.c.starts_at)).order_by(
+        table.c.doctor_id, table.c.starts_at, table.c.id)
+    found = {}
+    with (engine or db.engine).connect() as connection:
+        for id, doctor_id, starts_at in connection.execute(query):
+            found.setdefault((doctor_id, starts_at), []).append(id)
+    return found
+
+
+def create_table_indexes(engine, table):
+    '''
+    creates the indexes of table missing from the database, but
+    UNIQUE_BOOKING while doctors are double booked (it is logged and
+    created by a later migration once they have been moved)
+    returns the names of the created indexes
+    '''
+    existing = {index['name'] for index in sa.inspect(engine).get_indexes(table.name)}
+    created = []
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        if index.name == UNIQUE_BOOKING:
+            doubled = double_bookings(engine)
+            if doubled:
+                logging.warning('%s is not created, %d doctors are booked twice at the same time: %s',
+                                UNIQUE_BOOKING, len(doubled), list(doubled.values()))
+                continue
+        # indexes for another database (FULLTEXT) are skipped here
+        index.create(engine)
+        created.append(index.name)
+    return created
+
+
+def _drop_index(table_name, index_name):
+    '''
+    drops an index that has been replaced, if it is still there
+    '''
+    table = sa.Table(table_name, sa.MetaData(), autoload_with=db.engine)
+    for index in table.indexes:
+        if index.name == index_name:
+            index.drop(db.engine)
+
+
+def migrate_appointment_schedule(batch_size=1000):
+    '''
+    Moves the appointment schedule from the legacy `date`/`time` string
+    columns to the `starts_at` DateTime column and creates its indexes
+
+    The rows are converted in batches of `batch_size`, each batch in its
+    own transaction, so the migration can be stopped and run again.
+    The legacy columns are left in place to be dropped by hand once the
+    data has been checked. The unique (doctor_id, starts_at) index is left
+    out while a doctor has two appointments at the same time (see
+    double_bookings), those have to be moved first.
+    returns the number of migrated rows and the ids that could not be parsed
+    '''
+    table = Appointment.__table__
+    columns = {column['name'] for column in sa.inspect(db.engine).get_columns(table.name)}
+
+    if 'starts_at' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(sa.text('ALTER TABLE appointment ADD COLUMN starts_at DATETIME'))
+
+    migrated, rejected = 0, []
+    if {'date', 'time'} <= columns:
+        select_batch = sa.text(
+            'SELECT id, date, time FROM appointment '
+            'WHERE starts_at IS NULL AND id > :last_id ORDER BY id LIMIT :limit')
+        update_batch = sa.text(
+            'UPDATE appointment SET starts_at = :starts_at WHERE id = :id')
+        last_id = 0
+
+        while True:
+            with db.engine.begin() as connection:
+                rows = connection.execute(
+                    select_batch, {'last_id': last_id, 'limit': batch_size}).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+
+                updates = []
+                for row in rows:
+                    starts_at = parse_legacy_schedule(row.date, row.time)
+                    if starts_at is None:
+                        rejected.append(row.id)
+                    else:
+                        updates.append({'id': row.id, 'starts_at': starts_at})
+                if updates:
+                    connection.execute(update_batch, updates)
+                migrated += len(updates)
+
+    create_table_indexes(db.engine, table)
+    # the unique index replaces the plain one, which stays while the unique one cannot be created
+    if UNIQUE_BOOKING in {index['name'] for index in sa.inspect(db.engine).get_indexes(table.name)}:
+        _drop_index('appointment', 'ix_appointment_doctor_starts_at')
+
+    if rejected:
+        logging.warning('%d appointments have an unreadable date/time: %s',
+                        len(rejected), rejected)
+    return migrated, rejected
+
+
+@click.command('migrate-appointments')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of appointments converted per transaction')
+@with_appcontext
+def migrate_appointments_command(batch_size):
+    '''
+    Converts the appointment date/time strings to the starts_at column
+    '''
+    migrated, rejected = migrate_appointment_schedule(batch_size)
+    click.echo(f'Migrated {migrated} appointments, {len(rejected)} could not be parsed')
+
+
+def add_missing_columns(engine=None, tables=None):
+    '''
+    adds the model columns missing from the existing tables (create_all
+    does not alter tables), they are added nullable and left empty
+    engine and tables default to the main database and all the tables
+    returns the names of the added columns
+    '''
+    engine = engine or db.engine
+    added = []
+    inspector = sa.inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table in tables or db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.exec_driver_sql(
+                        f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN '
+                        f'{preparer.format_column(column)} {column.type.compile(engine.dialect)}')
+                    added.append(f'{table.name}.{column.name}')
+    return added
+
+
+def backfill_created_at(batch_size=1000):
+    '''
+    Dates the appointments and prescriptions saved before they had a
+    created_at column, in batches of `batch_size` ids per transaction
+    The appointments are dated by their start, the prescriptions (which
+    have no date of their own) by the time of the migration. The
+    appointments without a start (whose legacy date/time could not be
+    parsed, see migrate_appointment_schedule) are left undated rather
+    than dated by the migration.
+    returns the number of rows dated
+    '''
+    now = datetime.now()
+    dated = 0
+    appointments = Appointment.__table__
+    for table, created_at, undated in (
+            (appointments, appointments.c.starts_at,
+             sa.and_(appointments.c.created_at.is_(None), appointments.c.starts_at.is_not(None))),
+            (Prescription.__table__, now, Prescription.__table__.c.created_at.is_(None))):
+        first_id, last_id = db.session.execute(
+            sa.select(sa.func.min(table.c.id), sa.func.max(table.c.id)).where(undated)).one()
+        db.session.rollback()
+        if last_id is None:
+            continue
+        for start in range(first_id, last_id + 1, batch_size):
+            with db.engine.begin() as connection:
+                dated += connection.execute(table.update().where(
+                    undated, table.c.id >= start, table.c.id < start + batch_size).values(
+                    created_at=created_at, updated_at=created_at)).rowcount
+    return dated
+
+
+def backfill_branch():
+    '''
+    Puts the users saved before there were branches in DEFAULT_BRANCH,
+    whose clinical data is the one of the main database
+    returns the number of users updated
+    '''
+    with db.engine.begin() as connection:
+        return connection.execute(User.__table__.update().where(User.__table__.c.branch.is_(None)).values(
+            branch=branches()[0])).rowcount
+
+
+def _sharded_tables():
+    return [table for table in db.metadata.sorted_tables if table.name in SHARDED]
+
+
+def branch_engines():
+    '''
+    the engines of the branches having their own database, by branch
+    '''
+    return {branch: db.engines[branch_bind(branch)] for branch in branches() if branch_bind(branch) in db.engines}
+
+
+def create_branch_tables(engine):
+    '''
+    Creates the clinical tables missing from the database of a branch
+    they are created without their foreign keys, the users they refer
+    to are in the main database
+    returns the names of the created tables
+    '''
+    created = []
+    inspector = sa.inspect(engine)
+    with engine.begin() as connection:
+        for table in _sharded_tables():
+            if not inspector.has_table(table.name):
+                connection.execute(sa.schema.CreateTable(table, include_foreign_key_constraints=()))
+                created.append(table.name)
+    return created
+
+
+def migrate():
+    '''
+    brings the schema of the database, and of the database of every
+    branch having its own, up to date with the models
+    returns the names of the created columns, indexes and search tables
+    '''
+    db.create_all()
+    created = add_missing_columns()
+    # the legacy schedules are parsed before the appointments are dated by their start
+    migrated, _ = migrate_appointment_schedule()
+    if migrated:
+        logging.info('moved %d appointment schedules to starts_at', migrated)
+    dated = backfill_created_at()
+    if dated:
+        logging.info('dated %d appointments and prescriptions', dated)
+    backfill_branch()
+    created += create_indexes()
+
+    for branch, engine in branch_engines().items():
+        tables = _sharded_tables()
+        changes = create_branch_tables(engine) + add_missing_columns(engine, tables) + create_indexes(engine, tables)
+        created += [f'{branch}:{name}' for name in changes]
+    return created
+
+
+def create_indexes(engine=None, tables=None):
+    '''
+    creates the indexes of every table that are missing from the database
+    (create_all only creates the indexes of the tables it creates) and
+    the search tables
+    engine and tables default to the main database and all the tables
+    returns the names of the created indexes
+    '''
+    engine = engine or db.engine
+    created = []
+    inspector = sa.inspect(engine)
+    for table in tables or db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        created += sorted(create_table_indexes(engine, table))
+
+    with engine.begin() as connection:
+        created += create_search_tables(connection)
+    return created
+
+
+@click.command('create-indexes')
+@with_appcontext
+def create_indexes_command():
+    '''
+    Creates the indexes missing from the existing tables
+    '''
+    created = create_indexes()
+    for branch, engine in branch_engines().items():
+        created += [f'{branch}:{name}' for name in create_indexes(engine, _sharded_tables())]
+    click.echo(f'Created {len(created)} indexes' + (f': {", ".join(created)}' if created else ''))
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    '''
+    Creates the missing tables, columns, indexes and search tables, run
+    it once per deploy before the web workers start
+    '''
+    created = migrate()
+    click.echo('Database schema is up to date' + (f', created {", ".join(created)}' if created else ''))
+    for branch, engine in {branches()[0]: db.engine, **branch_engines()}.items():
+        for (doctor_id, starts_at), ids in double_bookings(engine).items():
+            click.echo(f'{branch}: doctor {doctor_id} is booked twice at {starts_at} (appointments '
+                       f'{", ".join(map(str, ids))}), {UNIQUE_BOOKING} is created once they are moved', err=True)
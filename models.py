@@ -1,10 +1,38 @@
+import json
+from datetime import datetime
+
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from flask_login import LoginManager
 
+from cache import counters, fragments, user_cache
+from routing import RoutingSession, branches, current_branch, shard_tables, use_branch
+from slots import slot_index
+
 
 login = LoginManager()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def after_commit(callback):
+    '''
+    runs callback once the transaction of the session is committed, it is
+    dropped when the transaction is rolled back
+    the caches are updated this way so that the writes of a batch (see the
+    commit arguments of the add methods) only show once they are saved
+    '''
+    db.session.info.setdefault('after_commit', []).append(callback)
+
+
+@db.event.listens_for(RoutingSession, 'after_commit')
+def _run_after_commit(session):
+    for callback in session.info.pop('after_commit', []):
+        callback()
+
+
+@db.event.listens_for(RoutingSession, 'after_rollback')
+def _drop_after_commit(session):
+    session.info.pop('after_commit', None)
 
 
 
@@ -17,6 +45,18 @@ class User(UserMixin, db.Model):
         -> patients
     '''
     __tablename__ = "user"
+    __table_args__ = (
+        # prefix lookups of the patient search, per status
+        db.Index('ix_user_status_lastname', 'status', 'lastname'),
+        db.Index('ix_user_status_firstname', 'status', 'firstname'),
+        db.Index('ix_user_status_phonenumber', 'status', 'phonenumber'),
+        # the doctor and patient lists of a branch
+        db.Index('ix_user_branch_status', 'branch', 'status'),
+        # the admin search, other databases use the trigram tables of search.py
+        db.Index('ft_user_search', 'firstname', 'lastname', 'email', 'phonenumber',
+                 mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     firstname = db.Column(db.String(100))
     lastname = db.Column(db.String(100))
@@ -25,8 +65,10 @@ class User(UserMixin, db.Model):
     gender = db.Column(db.String(50))
     password = db.Column(db.String(1000))
     status = db.Column(db.String(50)) # this is the fields that is used to differentiate between the different type of users
+    # the hospital branch whose database holds the user's appointments and prescriptions
+    branch = db.Column(db.String(50), default=current_branch)
 
-    def __init__(self, firstname, lastname, email, password, phonenumber, gender, status):
+    def __init__(self, firstname, lastname, email, password, phonenumber, gender, status, branch=None):
         self.firstname = firstname
         self.lastname = lastname
         self.email = email
@@ -34,34 +76,118 @@ class User(UserMixin, db.Model):
         self.gender = gender
         self.password = password
         self.status = status
+        self.branch = branch
 
-    def add_user(self):
+    def add_user(self, commit=True):
         '''
         Adds a user to the db
+        with commit=False the user is only flushed, it is saved by the
+        caller's commit along with the rest of its transaction
         '''
+        status = self.status
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        branch = self.branch
+        after_commit(lambda: counters.incr(('users_by_status', branch), field=status))
+        after_commit(lambda: fragments.bump(status))
+        if commit:
+            db.session.commit()
 
     def update_user(self):
         '''
         updates a user row
         '''
+        _id, status = self.id, self.status
         db.session.commit()
+        user_cache.invalidate(_id)
+        fragments.bump(status)
 
     def delete(self):
         '''
         removes a user from the database
         '''
-        db.session.delete(self)
+        User.delete_many([self.id])
+
+    @staticmethod
+    def delete_many(ids, status=None, branch=None):
+        '''
+        removes the users with the given ids, along with their appointments
+        and prescriptions in every branch, in a single transaction per database
+        passing status or branch only removes the users of that status or
+        branch
+        returns the number of users removed
+        '''
+        ids = list(ids)
+        if ids and (status is not None or branch is not None):
+            query = db.session.query(User.id).filter(User.id.in_(ids))
+            if status is not None:
+                query = query.filter(User.status == status)
+            if branch is not None:
+                query = query.filter(User.branch == branch)
+            ids = [_id for _id, in query]
+        if not ids:
+            return 0
+
+        for branch in branches():
+            with use_branch(branch):
+                for model in (Appointment, Prescription, AppointmentArchive, PrescriptionArchive):
+                    model.query.filter(db.or_(
+                        model.doctor_id.in_(ids), model.patient_id.in_(ids))).delete(synchronize_session=False)
+        deleted = User.query.filter(User.id.in_(ids)).delete(synchronize_session=False)
         db.session.commit()
 
+        user_cache.invalidate(*ids)
+        counters.invalidate()
+        fragments.bump('doctor', 'patient')
+        slot_index.invalidate()
+        return deleted
+
+    @staticmethod
+    def count_by_status(branch=None):
+        '''
+        counts the users of every status in a single grouped query,
+        optionally only those of one branch
+        '''
+        rows = db.session.query(User.status, db.func.count(User.id))
+        if branch is not None:
+            rows = rows.filter(User.branch == branch)
+        rows = rows.group_by(User.status)
+        return {status: count for status, count in rows}
+
+
+class CachedUser(UserMixin):
+    '''
+    A read only copy of a User row as kept in the user cache
+    it carries every column of the user except the password hash
+    '''
+
+    def __init__(self, columns):
+        self.__dict__.update(columns)
+
+    def __repr__(self):
+        return f'<CachedUser {self.id}>'
+
+
+def _user_columns(id):
+    '''
+    fetches a user and copies its columns for the user cache
+    '''
+    user = db.session.get(User, id)
+    if user is None:
+        return None
+    return {column.key: getattr(user, column.key)
+            for column in User.__table__.columns if column.key != 'password'}
+
 
 @login.user_loader
 def load_user(id):
     '''
     A callback to load the user data each session
+    the user is served from the user cache, the db is only hit on a miss
     '''
-    return User.query.get(int(id))
+    id = int(id)
+    columns = user_cache.get(id, lambda: _user_columns(id))
+    return CachedUser(columns) if columns is not None else None
 
 
 class Appointment(db.Model):
@@ -70,43 +196,143 @@ class Appointment(db.Model):
     Defines the appointment between the doctors and patients
     '''
     __tablename__ = "appointment"
+    __table_args__ = (
+        # per doctor / per patient schedule lookups are range scans on these,
+        # the doctor one is unique so that a slot can only be booked once
+        db.Index('uq_appointment_doctor_starts_at', 'doctor_id', 'starts_at', unique=True),
+        db.Index('ix_appointment_patient_starts_at', 'patient_id', 'starts_at'),
+        # the medical history of a patient is read newest first, see history.py
+        db.Index('ix_appointment_patient_created_at', 'patient_id', 'created_at', 'id'),
+        # the reminder scheduler reads the appointments of a time window
+        db.Index('ix_appointment_starts_at', 'starts_at'),
+        db.Index('ft_appointment_search', 'condition', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     firstname = db.Column(db.String(100))
     lastname = db.Column(db.String(100))
     gender = db.Column(db.String(50))
-    date = db.Column(db.String(50))
-    time = db.Column(db.String(50))
+    starts_at = db.Column(db.DateTime)
     phone_number = db.Column(db.String(20))
-    doctor_id = db.Column(db.Integer())
-    patient_id = db.Column(db.Integer())
+    doctor_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'))
+    patient_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'))
     condition = db.Column(db.String(50))
+    # when the row was written, for the conditional responses of the pages
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    # the users on both sides of the appointment, so views can load them
+    # together with the appointments instead of one query per row
+    doctor = db.relationship('User', foreign_keys=[doctor_id], lazy='select')
+    patient = db.relationship('User', foreign_keys=[patient_id], lazy='select')
 
-    def __init__(self, firstname, lastname, gender, date, time, phone_number, doctor_id, patient_id, condition):
+    def __init__(self, firstname, lastname, gender, starts_at, phone_number, doctor_id, patient_id, condition):
 
         self.firstname = firstname
         self.lastname = lastname
         self.gender = gender
-        self.date = date
-        self.time = time
+        self.starts_at = starts_at
         self.phone_number = phone_number
         self.doctor_id = doctor_id
         self.patient_id = patient_id
         self.condition = condition
 
-    def add_appointment(self):
+    @property
+    def date(self):
+        '''
+        the day of the appointment as displayed in the views
+        '''
+        return self.starts_at.strftime('%Y-%m-%d') if self.starts_at else ''
+
+    @property
+    def time(self):
+        '''
+        the time of the appointment as displayed in the views
+        '''
+        return self.starts_at.strftime('%H:%M') if self.starts_at else ''
+
+    def add_appointment(self, commit=True):
         '''
         add appointment to the db
+        with commit=False it is only flushed, see User.add_user
         '''
-        db.session.add(self)
-        db.session.commit()
+        Appointment.add_many([self], commit)
+
+    @staticmethod
+    def add_many(appointments, commit=True):
+        '''
+        adds appointments (a recurring series of them for example) in a
+        single flush, with a single confirmation for all of them
+        with commit=False they are only flushed, see User.add_user
+        '''
+        appointments = list(appointments)
+        db.session.add_all(appointments)
+        db.session.flush()
+        # the confirmation is sent by the job worker, in the same transaction
+        Job.enqueue('booking_confirmation', appointment_ids=[appointment.id for appointment in appointments])
+
+        booked = [(appointment.doctor_id, appointment.starts_at) for appointment in appointments]
+        branch = current_branch()
+
+        def book():
+            counters.incr(('appointments', branch), len(booked))
+            for doctor_id, starts_at in booked:
+                counters.incr(('doctor_appointments', doctor_id))
+                slot_index.book(doctor_id, starts_at)
+
+        after_commit(book)
+        if commit:
+            db.session.commit()
 
     def delete(self):
         '''
         remove appointment from the db
         '''
+        doctor_id = self.doctor_id
         db.session.delete(self)
         db.session.commit()
+        counters.incr(('appointments', current_branch()), -1)
+        counters.incr(('doctor_appointments', doctor_id), -1)
+        slot_index.invalidate(doctor_id)
+
+    @staticmethod
+    def delete_many(ids, doctor_id=None, patient_id=None):
+        '''
+        removes the appointments with the given ids in a single statement
+        passing doctor_id or patient_id only removes the appointments that
+        belong to that doctor or patient
+        returns the number of appointments removed
+        '''
+        ids = list(ids)
+        if not ids:
+            return 0
+
+        query = Appointment.query.filter(Appointment.id.in_(ids))
+        if doctor_id is not None:
+            query = query.filter(Appointment.doctor_id == doctor_id)
+        if patient_id is not None:
+            query = query.filter(Appointment.patient_id == patient_id)
+        deleted = query.delete(synchronize_session=False)
+        db.session.commit()
+
+        if doctor_id is not None:
+            counters.incr(('appointments', current_branch()), -deleted)
+            counters.incr(('doctor_appointments', doctor_id), -deleted)
+            slot_index.invalidate(doctor_id)
+        else:
+            counters.invalidate()
+            slot_index.invalidate()
+        return deleted
+
+    @staticmethod
+    def count(doctor_id=None):
+        '''
+        counts the appointments, optionally only those of one doctor
+        '''
+        query = db.session.query(db.func.count(Appointment.id))
+        if doctor_id is not None:
+            query = query.filter(Appointment.doctor_id == doctor_id)
+        return query.scalar()
 
 
 class Prescription(db.Model):
@@ -115,12 +341,24 @@ class Prescription(db.Model):
     Defines the prescription given to patients by doctors
     '''
     __tablename__ = 'prescription'
+    __table_args__ = (
+        db.Index('ix_prescription_patient_created_at', 'patient_id', 'created_at', 'id'),
+        # the archiver reads the prescriptions that are no longer active
+        db.Index('ix_prescription_created_at', 'created_at'),
+        db.Index('ft_prescription_search', 'drug', 'condition', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     drug = db.Column(db.String(100))
     quantity = db.Column(db.String(100))
     condition = db.Column(db.String(100))
-    patient_id = db.Column(db.Integer())
-    doctor_id = db.Column(db.Integer())
+    patient_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'))
+    doctor_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'))
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    doctor = db.relationship('User', foreign_keys=[doctor_id], lazy='select')
+    patient = db.relationship('User', foreign_keys=[patient_id], lazy='select')
 
     def __init__(self, drug, quantity, condition, patient_id, doctor_id) -> None:
         self.drug = drug
@@ -129,9 +367,125 @@ class Prescription(db.Model):
         self.patient_id = patient_id
         self.doctor_id = doctor_id
 
-    def add_prescription(self):
+    def add_prescription(self, commit=True):
         '''
         Add prescription to the db
+        with commit=False it is only flushed, see User.add_user
         '''
-        db.session.add(self)
-        db.session.commit()
+        Prescription.add_many([self], commit)
+
+    @staticmethod
+    def add_many(prescriptions, commit=True):
+        '''
+        adds the drugs of a prescription in a single flush, with a single
+        notice for all of them
+        with commit=False they are only flushed, see User.add_user
+        '''
+        prescriptions = list(prescriptions)
+        db.session.add_all(prescriptions)
+        db.session.flush()
+        Job.enqueue('prescription_notice', prescription_ids=[prescription.id for prescription in prescriptions])
+        if commit:
+            db.session.commit()
+
+
+class AppointmentArchive(db.Model):
+    '''
+    The AppointmentArchive model
+    The past appointments moved out of the appointment table by
+    `flask archive` (see archive.py), with their original ids. Only the
+    medical history reads them, when asked for the archived history.
+    '''
+    __tablename__ = 'appointment_archive'
+    __table_args__ = (
+        db.Index('ix_appointment_archive_patient_created_at', 'patient_id', 'created_at', 'id'),
+        db.Index('ix_appointment_archive_doctor_starts_at', 'doctor_id', 'starts_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    firstname = db.Column(db.String(100))
+    lastname = db.Column(db.String(100))
+    gender = db.Column(db.String(50))
+    starts_at = db.Column(db.DateTime)
+    phone_number = db.Column(db.String(20))
+    doctor_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'))
+    patient_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'))
+    condition = db.Column(db.String(50))
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime)
+
+
+class PrescriptionArchive(db.Model):
+    '''
+    The PrescriptionArchive model
+    The prescriptions that are no longer active, moved out of the
+    prescription table like the archived appointments
+    '''
+    __tablename__ = 'prescription_archive'
+    __table_args__ = (
+        db.Index('ix_prescription_archive_patient_created_at', 'patient_id', 'created_at', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    drug = db.Column(db.String(100))
+    quantity = db.Column(db.String(100))
+    condition = db.Column(db.String(100))
+    patient_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'))
+    doctor_id = db.Column(db.Integer(), db.ForeignKey('user.id', ondelete='CASCADE'))
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime)
+
+
+class Job(db.Model):
+    '''
+    The Job model
+    Defines the background work (the notifications to send) run by the
+    `flask jobs work` worker, see jobs.py
+    '''
+    __tablename__ = 'job'
+    __table_args__ = (
+        # the worker claims the queued jobs that are due
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50))
+    payload = db.Column(db.Text)
+    status = db.Column(db.String(20))  # queued, running, done or failed
+    attempts = db.Column(db.Integer)
+    run_at = db.Column(db.DateTime)
+    locked_by = db.Column(db.String(100))
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+
+    def __init__(self, kind, payload, run_at=None):
+        now = datetime.now()
+        self.kind = kind
+        self.payload = json.dumps(payload)
+        self.status = 'queued'
+        self.attempts = 0
+        self.run_at = run_at or now
+        self.created_at = now
+
+    @staticmethod
+    def enqueue(kind, run_at=None, **payload):
+        '''
+        adds a job to the session, it is queued when the session commits
+        the job runs against the clinical data of the current branch
+        '''
+        payload.setdefault('branch', current_branch())
+        job = Job(kind, payload, run_at)
+        db.session.add(job)
+        return job
+
+    @property
+    def arguments(self):
+        return json.loads(self.payload)
+
+
+# the clinical data lives in the database of its branch, see routing.py
+shard_tables(Appointment.__tablename__, Prescription.__tablename__,
+             AppointmentArchive.__tablename__, PrescriptionArchive.__tablename__)
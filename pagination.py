@@ -0,0 +1,120 @@
+from flask import current_app
+
+
+class KeysetPage:
+    '''
+    A single page of rows fetched with keyset (cursor) pagination
+
+    Rows are ordered by an integer key column (usually the primary key)
+    and a page is addressed by the key it starts `after` or ends `before`,
+    so every page is an indexed range scan no matter how deep it is.
+
+    Forward pages are streamed from the database in chunks while the
+    page is iterated, the cursors are known once iteration has finished:
+        -> next_cursor : pass as `after` to get the following page
+        -> prev_cursor : pass as `before` to get the preceding page
+    '''
+
+    def __init__(self, query, column, per_page, after=None, before=None, chunk_size=100):
+        self.query = query
+        self.column = column
+        self.per_page = per_page
+        self.after = after
+        self.before = before
+        self.chunk_size = chunk_size
+        self.first_key = None
+        self.last_key = None
+        self.has_next = False
+        self.has_prev = False
+
+    def __iter__(self):
+        if self.before is not None:
+            rows = self._backward()
+        else:
+            rows = self._forward()
+
+        for row in rows:
+            key = getattr(row, self.column.key)
+            if self.first_key is None:
+                self.first_key = key
+            self.last_key = key
+            yield row
+
+    def _forward(self):
+        '''
+        streams up to per_page rows after the cursor, one extra row is
+        read to know whether there is a next page
+        '''
+        query = self.query
+        if self.after is not None:
+            query = query.filter(self.column > self.after)
+        query = query.order_by(self.column.asc()).limit(self.per_page + 1)
+
+        self.has_prev = self.after is not None
+        for count, row in enumerate(query.yield_per(self.chunk_size)):
+            if count == self.per_page:
+                self.has_next = True
+                break
+            yield row
+
+    def _backward(self):
+        '''
+        reads the per_page rows before the cursor, they are fetched in
+        descending order so the page is bounded and then reversed
+        '''
+        query = self.query.filter(self.column < self.before)
+        rows = query.order_by(self.column.desc()).limit(self.per_page + 1).all()
+
+        self.has_next = True
+        if len(rows) > self.per_page:
+            self.has_prev = True
+            rows = rows[:self.per_page]
+        return reversed(rows)
+
+    @property
+    def next_cursor(self):
+        if not self.has_next:
+            return None
+        if self.last_key is None:
+            # the page came back empty, restart from where it was requested
+            return self.before - 1
+        return self.last_key
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev:
+            return None
+        if self.first_key is None:
+            return self.after + 1
+        return self.first_key
+
+
+def _int_arg(args, name):
+    '''
+    reads an optional integer query string argument
+    '''
+    try:
+        return int(args.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def page_size(args):
+    '''
+    the per_page request argument, PAGE_SIZE by default and capped by MAX_PAGE_SIZE
+    '''
+    per_page = _int_arg(args, 'per_page') or current_app.config['PAGE_SIZE']
+    return max(1, min(per_page, current_app.config['MAX_PAGE_SIZE']))
+
+
+def keyset_paginate(query, column, args):
+    '''
+    Builds a KeysetPage from the request arguments
+        -> after    : the cursor of the page to continue from
+        -> before   : the cursor of the page to go back from
+        -> per_page : the page size, capped by MAX_PAGE_SIZE
+    '''
+    return KeysetPage(query, column, page_size(args),
+                      after=_int_arg(args, 'after'),
+                      before=_int_arg(args, 'before'),
+                      chunk_size=current_app.config['PAGE_CHUNK_SIZE'])
@@ -0,0 +1,101 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from metrics import Histogram
+
+
+class PasswordHasher:
+    '''
+    Hashes and verifies the user passwords
+
+    The key derivation runs on a bounded pool of PASSWORD_HASH_WORKERS
+    threads (hashlib releases the GIL while it works) so a burst of
+    logins cannot take every CPU away from the rest of the requests.
+    The algorithm and cost are set with PASSWORD_HASH_METHOD, in the
+    werkzeug format, e.g. `pbkdf2:sha256:260000`. Hashes made with any
+    other method are reported as needing a rehash, the method is compared
+    as werkzeug stores it (`pbkdf2:sha256` is stored with its default
+    iterations).
+    '''
+
+    def __init__(self, method='pbkdf2:sha256:260000', salt_length=16, workers=4):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self._executor = None
+        self._prefix = None
+        self.hash_latency = Histogram()
+        self.verify_latency = Histogram()
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', self.method)
+        self.salt_length = app.config.get('PASSWORD_SALT_LENGTH', self.salt_length)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self._prefix = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='password-hash')
+        return self._executor
+
+    def _timed(self, histogram, function, *args):
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    def hash(self, password):
+        '''
+        returns the hash of password made with the configured method
+        '''
+        return self.executor.submit(
+            self._timed, self.hash_latency, generate_password_hash,
+            password, self.method, self.salt_length).result()
+
+    def verify(self, pwhash, password):
+        '''
+        checks password against the stored hash
+        returns whether it matches and whether the stored hash should be
+        replaced by one made with the configured method
+        '''
+        if not pwhash:
+            return False, False
+        matches = self.executor.submit(
+            self._timed, self.verify_latency, check_password_hash,
+            pwhash, password).result()
+        return matches, matches and self.needs_rehash(pwhash)
+
+    @property
+    def prefix(self):
+        '''
+        the method as werkzeug writes it at the start of a hash, read from
+        a hash made with it the first time it is needed
+        '''
+        if self._prefix is None:
+            self._prefix = generate_password_hash('', self.method, 1).split('$', 1)[0]
+        return self._prefix
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.prefix
+
+    def stats(self):
+        '''
+        the hash/verify latency histograms
+        '''
+        return {
+            'method': self.method,
+            'workers': self.workers,
+            'hash': self.hash_latency.snapshot(),
+            'verify': self.verify_latency.snapshot(),
+        }
+
+
+passwords = PasswordHasher()
@@ -0,0 +1,70 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+
+from models import db, User, Appointment, AppointmentArchive, Prescription
+from routing import branches, use_branch
+
+
+def summarize(branch):
+    '''
+    the counters of one branch: its doctors and patients (in the main
+    database), its appointments and prescriptions (in its own) and how
+    long reading them took
+    '''
+    started = time.perf_counter()
+    with use_branch(branch):
+        users = User.count_by_status(branch)
+        now = datetime.now()
+        appointments, upcoming = db.session.query(
+            db.func.count(Appointment.id),
+            db.func.count(db.case((Appointment.starts_at >= now, Appointment.id)))).one()
+        summary = {
+            'branch': branch,
+            'doctors': users.get('doctor', 0),
+            'patients': users.get('patient', 0),
+            'appointments': appointments,
+            'upcoming_appointments': upcoming,
+            'archived_appointments': db.session.query(db.func.count(AppointmentArchive.id)).scalar(),
+            'prescriptions': db.session.query(db.func.count(Prescription.id)).scalar(),
+        }
+        db.session.rollback()
+    summary['seconds'] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+class BranchReport:
+    '''
+    The counters of every branch for the admins, read in parallel
+
+    Every branch is summarized on a thread of its own, in its own app
+    context (so with its own session and connections), the report takes
+    as long as the slowest branch rather than the sum of all of them. At
+    most BRANCH_REPORT_WORKERS branches are read at once.
+    '''
+
+    def __init__(self, workers=8):
+        self.workers = workers
+
+    def init_app(self, app):
+        self.workers = app.config.get('BRANCH_REPORT_WORKERS', self.workers)
+
+    def _summarize(self, app, branch):
+        with app.app_context():
+            return summarize(branch)
+
+    def summaries(self):
+        '''
+        the summary of every branch, in the order of the branches, and the totals
+        '''
+        app = current_app._get_current_object()
+        codes = branches()
+        with ThreadPoolExecutor(max(1, min(self.workers, len(codes)))) as pool:
+            rows = list(pool.map(lambda branch: self._summarize(app, branch), codes))
+        totals = {key: sum(row[key] for row in rows) for key in rows[0] if key not in ('branch', 'seconds')}
+        return rows, totals
+
+
+branch_report = BranchReport()
@@ -0,0 +1,171 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request, session
+from flask_login import current_user
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql.util import find_tables
+
+
+'''
+The bind key of the optional read replica
+'''
+REPLICA = 'replica'
+
+'''
+The tables holding the clinical data of a branch, they live in the
+database of the current branch (see shard_tables)
+'''
+SHARDED = set()
+
+_branch = ContextVar('branch', default=None)
+
+
+def branch_bind(branch):
+    '''
+    the bind key of the database of a branch
+    '''
+    return f'branch:{branch}'
+
+
+def shard_tables(*names):
+    '''
+    Marks tables as holding clinical data, partitioned by branch
+    '''
+    SHARDED.update(names)
+
+
+def current_branch():
+    '''
+    the branch the clinical data is read from and written to: the one
+    set by use_branch, else the branch of the logged in doctor or patient
+    (an admin picks theirs, see the admin branch view), else DEFAULT_BRANCH
+    '''
+    branch = _branch.get()
+    if branch is not None:
+        return branch
+    if has_request_context():
+        if 'branch' not in g:
+            g.branch = _request_branch()
+        return g.branch
+    return current_app.config.get('DEFAULT_BRANCH', 'main')
+
+
+def _request_branch():
+    branches = current_app.config.get('BRANCHES', ())
+    if current_user.is_authenticated:
+        if current_user.status != 'admin' and current_user.branch:
+            return current_user.branch
+        if session.get('branch') in branches:
+            return session['branch']
+        if current_user.branch:
+            return current_user.branch
+    return current_app.config.get('DEFAULT_BRANCH', 'main')
+
+
+@contextmanager
+def use_branch(branch):
+    '''
+    runs the block against the clinical data of branch
+    '''
+    token = _branch.set(branch)
+    try:
+        yield branch
+    finally:
+        _branch.reset(token)
+
+
+def branches():
+    '''
+    the codes of every branch, the default one first
+    '''
+    return list(current_app.config.get('BRANCHES') or [current_app.config.get('DEFAULT_BRANCH', 'main')])
+
+
+class RoutingSession(Session):
+    '''
+    A session that sends the reads of read only views to the replica
+
+    A statement goes to the replica when the current request has been
+    marked with `read_only`, a `replica` bind is configured, the
+    statement is a SELECT and this session has not written anything yet.
+    Everything else (writes, flushes, reads after a write) stays on the
+    primary.
+
+    The statements on the SHARDED tables go to the database of the
+    current branch instead, when it has its own (a `branch:<code>` bind,
+    see BRANCH_DATABASES), reads included: the branch databases have no
+    replica. A statement cannot join the tables of two databases.
+    '''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engines = self._db.engines
+        # the branch is only looked up for the sharded tables, looking it
+        # up can load the logged in user
+        if bind is None and len(engines) > 1 and SHARDED and self._sharded(mapper, clause):
+            shard = engines.get(branch_bind(current_branch()))
+            if shard is not None:
+                return shard
+
+        if (bind is None and REPLICA in engines and not self._flushing
+                and not self.info.get('wrote') and use_replica()):
+            if clause is not None and getattr(clause, 'is_select', False):
+                return engines[REPLICA]
+
+        if clause is None or not getattr(clause, 'is_select', False):
+            self.info['wrote'] = True
+            if has_request_context():
+                g.wrote_primary = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    @staticmethod
+    def _sharded(mapper, clause):
+        '''
+        whether the statement is on the sharded tables
+        '''
+        if mapper is not None:
+            return mapper.local_table.name in SHARDED
+        if clause is None:
+            return False
+        return any(getattr(table, 'name', None) in SHARDED for table in find_tables(clause, include_crud=True))
+
+
+def use_replica():
+    '''
+    whether the current request may read from the replica
+    '''
+    if not has_request_context() or not g.get('read_only'):
+        return False
+    # read the user's own writes from the primary for a little while
+    return session.get('primary_until', 0) < time.time()
+
+
+def read_only(view):
+    '''
+    Marks the GET requests of a view as safe to serve from the replica
+    '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET':
+            g.read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def init_app(app):
+    '''
+    Remembers the requests that wrote to the primary, so that the same
+    user reads from the primary for REPLICA_STICKY_SECONDS afterwards
+    and does not see the replica lag behind their own changes, and gives
+    the templates the branches
+    '''
+    sticky = app.config.get('REPLICA_STICKY_SECONDS', 5)
+    app.jinja_env.globals.update(current_branch=current_branch, branches=branches)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if g.get('wrote_primary') and REPLICA in app.config.get('SQLALCHEMY_BINDS', {}):
+            session['primary_until'] = time.time() + sticky
+        return response
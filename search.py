@@ -0,0 +1,299 @@
+import bisect
+import re
+import threading
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.mysql import match
+from sqlalchemy.orm import selectinload
+
+from cache import fragments
+from models import db, User, Appointment, Prescription
+from routing import current_branch, shard_tables
+
+
+'''
+The user columns a patient is searched by
+'''
+SEARCH_FIELDS = ('lastname', 'firstname', 'email', 'phonenumber')
+
+
+def _like_prefix(prefix):
+    '''
+    a LIKE pattern matching the values that start with prefix
+    '''
+    escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+
+def _as_dict(row):
+    return {'id': row.id, 'name': f'{row.firstname} {row.lastname}',
+            'email': row.email, 'phonenumber': row.phonenumber}
+
+
+def _sort_key(row):
+    return ((row.lastname or '').lower(), (row.firstname or '').lower(), row.id)
+
+
+class PrefixIndex:
+    '''
+    In memory prefix index of the users of one status and branch
+
+    Keeps a sorted list of (lowercased field value, user id) for every
+    searched field, a prefix lookup is a binary search to the first
+    matching key followed by a walk over the matches.
+    '''
+
+    def __init__(self, rows):
+        self.rows = {row.id: row for row in rows}
+        self.keys = sorted(((getattr(row, field) or '').lower(), row.id)
+                           for row in self.rows.values() for field in SEARCH_FIELDS)
+
+    def search(self, prefix, limit):
+        prefix = prefix.lower()
+        found = {}
+        position = bisect.bisect_left(self.keys, (prefix,))
+        while position < len(self.keys) and len(found) < limit:
+            key, id = self.keys[position]
+            if not key.startswith(prefix):
+                break
+            found[id] = self.rows[id]
+            position += 1
+        return sorted(found.values(), key=_sort_key)
+
+
+class PatientSearch:
+    '''
+    Type-ahead search of the users of a status by name, email or phone
+    prefix, among the users of the current branch
+
+    By default every search is a single UNION ALL of one LIMITed prefix
+    query per field, each a range scan on the (status, field) index of
+    the user table (the email one on its unique index). With
+    PATIENT_SEARCH_INDEX the users are kept in a PrefixIndex per status
+    and branch instead, rebuilt when the status' version in the fragment
+    cache is bumped by a user write or after PATIENT_SEARCH_INDEX_TTL
+    seconds.
+    '''
+
+    def __init__(self, limit=10, max_limit=50, use_index=False, ttl=300):
+        self.limit = limit
+        self.max_limit = max_limit
+        self.use_index = use_index
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def init_app(self, app):
+        self.limit = app.config.get('PATIENT_SEARCH_LIMIT', self.limit)
+        self.max_limit = app.config.get('PATIENT_SEARCH_MAX_LIMIT', self.max_limit)
+        self.use_index = app.config.get('PATIENT_SEARCH_INDEX', self.use_index)
+        self.ttl = app.config.get('PATIENT_SEARCH_INDEX_TTL', self.ttl)
+
+    def search(self, prefix, status='patient', limit=None):
+        '''
+        returns the first `limit` users of status of the current branch
+        matching prefix as dicts, ordered by last name and first name
+        '''
+        prefix = (prefix or '').strip()
+        limit = min(limit or self.limit, self.max_limit)
+        if not prefix or limit < 1:
+            return []
+        branch = current_branch()
+        if self.use_index:
+            rows = self._index(status, branch).search(prefix, limit)
+        else:
+            rows = self._query(prefix, status, branch, limit)
+        return [_as_dict(row) for row in rows]
+
+    def _query(self, prefix, status, branch, limit):
+        table = User.__table__
+        columns = [table.c.id, table.c.firstname, table.c.lastname, table.c.email, table.c.phonenumber]
+        pattern = _like_prefix(prefix)
+        matches = [sa.select(*columns).where(table.c.status == status, table.c.branch == branch,
+                                            table.c[field].like(pattern, escape='\\'))
+                   .order_by(table.c[field]).limit(limit).subquery()
+                   for field in SEARCH_FIELDS]
+        query = sa.union_all(*(sa.select(matched) for matched in matches))
+
+        found = {row.id: row for row in db.session.execute(query)}
+        return sorted(found.values(), key=_sort_key)[:limit]
+
+    def _index(self, status, branch):
+        version = fragments.store.version(status)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._indexes.get((status, branch))
+            if entry is not None and entry[1] == version and entry[2] > now:
+                return entry[0]
+
+        rows = db.session.query(User.id, User.firstname, User.lastname, User.email,
+                                User.phonenumber).filter(User.status == status, User.branch == branch).all()
+        index = PrefixIndex(rows)
+        with self._lock:
+            self._indexes[(status, branch)] = (index, version, now + self.ttl)
+        return index
+
+
+patient_search = PatientSearch()
+
+
+'''
+What the admin search looks into: the model and its searched columns,
+by kind of result
+'''
+ADMIN_SEARCH = {
+    'users': (User, ('firstname', 'lastname', 'email', 'phonenumber')),
+    'appointments': (Appointment, ('condition',)),
+    'prescriptions': (Prescription, ('drug', 'condition')),
+}
+
+
+def _fts_table(model):
+    return f'{model.__tablename__}_fts'
+
+
+# the search tables of the clinical data live next to it, in the branch databases
+shard_tables(_fts_table(Appointment), _fts_table(Prescription))
+
+
+def _fts_ddl(model, columns):
+    '''
+    a SQLite FTS5 trigram table over the columns of model, kept in sync
+    with the model table by triggers
+    '''
+    table, fts = model.__tablename__, _fts_table(model)
+    names = ', '.join(columns)
+    new = ', '.join(f'new.{column}' for column in columns)
+    old = ', '.join(f'old.{column}' for column in columns)
+    return [
+        f"CREATE VIRTUAL TABLE {fts} USING fts5({names}, content='{table}', content_rowid='id', tokenize='trigram')",
+        f'CREATE TRIGGER {fts}_insert AFTER INSERT ON "{table}" BEGIN '
+        f'INSERT INTO {fts} (rowid, {names}) VALUES (new.id, {new}); END',
+        f'CREATE TRIGGER {fts}_delete AFTER DELETE ON "{table}" BEGIN '
+        f"INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', old.id, {old}); END",
+        f'CREATE TRIGGER {fts}_update AFTER UPDATE OF {names} ON "{table}" BEGIN '
+        f"INSERT INTO {fts} ({fts}, rowid, {names}) VALUES ('delete', old.id, {old}); "
+        f'INSERT INTO {fts} (rowid, {names}) VALUES (new.id, {new}); END',
+        f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')",
+    ]
+
+
+def create_search_tables(connection):
+    '''
+    creates the trigram search tables of a SQLite database that does not
+    have them yet and indexes the existing rows, the triggers then keep
+    them up to date on every insert, update and delete (bulk ones too)
+    MySQL uses the FULLTEXT indexes of the models instead
+    returns the names of the created tables
+    '''
+    if connection.dialect.name != 'sqlite':
+        return []
+    created = []
+    inspector = sa.inspect(connection)
+    for model, columns in ADMIN_SEARCH.values():
+        # a branch database only has the clinical tables
+        if inspector.has_table(model.__tablename__) and not inspector.has_table(_fts_table(model)):
+            for statement in _fts_ddl(model, columns):
+                connection.exec_driver_sql(statement)
+            created.append(_fts_table(model))
+    return created
+
+
+@sa.event.listens_for(db.metadata, 'after_create')
+def _create_search_tables(target, connection, **kw):
+    create_search_tables(connection)
+
+
+def trigram_query(text):
+    '''
+    the FTS5 query matching any trigram of the words of text, rows
+    sharing more trigrams with the text rank higher, so a misspelled
+    name still finds the right rows
+    '''
+    trigrams = {}
+    for word in re.findall(r'\w+', text.lower()):
+        for i in range(len(word) - 2):
+            trigrams[word[i:i + 3]] = None
+    return ' OR '.join(f'"{trigram}"' for trigram in trigrams)
+
+
+class SearchPage:
+    '''
+    One page of ranked search results
+    '''
+
+    def __init__(self, items, page, has_next):
+        self.items = items
+        self.page = page
+        self.prev_page = page - 1 if page > 1 else None
+        self.next_page = page + 1 if has_next else None
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+class AdminSearch:
+    '''
+    Ranked search of the users, appointments and prescriptions for the admins
+
+    On MySQL the rows are ranked by the FULLTEXT index of their model
+    (natural language mode), on SQLite by the bm25 rank of their trigram
+    table, which tolerates misspellings. Pages are numbered, the ranking
+    of a page is computed on the ids only and the rows of the page are
+    then loaded with their doctor and patient. The users are those of the
+    current branch, the clinical rows come from its database.
+    '''
+
+    def __init__(self, per_page=20):
+        self.per_page = per_page
+
+    def init_app(self, app):
+        self.per_page = app.config.get('SEARCH_PAGE_SIZE', self.per_page)
+
+    def search(self, kind, text, page=1):
+        '''
+        returns the SearchPage `page` of the rows of kind matching text
+        '''
+        model, columns = ADMIN_SEARCH[kind]
+        page = max(page, 1)
+        ids = self._rank(model, columns, (text or '').strip(), self.per_page + 1, (page - 1) * self.per_page)
+        has_next = len(ids) > self.per_page
+        ids = ids[:self.per_page]
+
+        query = model.query.filter(model.id.in_(ids))
+        if model is User:
+            query = query.filter(User.branch == current_branch())
+        else:
+            query = query.options(selectinload(model.doctor), selectinload(model.patient))
+        rows = {row.id: row for row in query} if ids else {}
+        return SearchPage([rows[id] for id in ids if id in rows], page, has_next)
+
+    def _rank(self, model, columns, text, limit, offset):
+        '''
+        the ids of the matching rows, best match first
+        '''
+        if not text:
+            return []
+        table = model.__table__
+
+        if db.session.get_bind(model.__mapper__).dialect.name == 'mysql':
+            score = match(*(table.c[column] for column in columns), against=text).in_natural_language_mode()
+            query = sa.select(table.c.id).where(score > 0).order_by(score.desc(), table.c.id)
+            if model is User:
+                query = query.where(table.c.branch == current_branch())
+        else:
+            terms = trigram_query(text)
+            if not terms:
+                return []
+            fts = sa.table(_fts_table(model), sa.column('rowid'))
+            score = sa.func.bm25(sa.literal_column(fts.name))
+            query = sa.select(fts.c.rowid).where(
+                sa.literal_column(fts.name).op('MATCH')(terms)).order_by(score, fts.c.rowid)
+            if model is User:
+                query = query.join(table, table.c.id == fts.c.rowid).where(table.c.branch == current_branch())
+
+        return [id for id, in db.session.execute(query.limit(limit).offset(offset))]
+
+
+admin_search = AdminSearch()
@@ -0,0 +1,143 @@
+import bisect
+import threading
+import time as clock
+from datetime import datetime, time, timedelta
+
+
+class SlotIndex:
+    '''
+    In process index of the booked appointment slots of every doctor
+
+    The clinic day (CLINIC_OPENS to CLINIC_CLOSES) is cut in slots of
+    APPOINTMENT_SLOT_MINUTES. For every doctor the start times of the
+    upcoming appointments are kept in a sorted list, so checking a slot
+    is a binary search and listing the next free slots only walks the
+    bookings it passes.
+
+    The index only speeds the checks up, double bookings are prevented
+    by the unique (doctor_id, starts_at) index of the appointment table.
+    Bookings made by other workers are picked up when a doctor's entry
+    expires after SLOT_INDEX_TTL seconds or is invalidated.
+    '''
+
+    def __init__(self, slot_minutes=30, opens=time(8), closes=time(17), ttl=60, horizon_days=60):
+        self.slot = timedelta(minutes=slot_minutes)
+        self.opens = opens
+        self.closes = closes
+        self.ttl = ttl
+        self.horizon = timedelta(days=horizon_days)
+        self._lock = threading.Lock()
+        self._booked = {}
+
+    def init_app(self, app):
+        self.slot = timedelta(minutes=app.config.get('APPOINTMENT_SLOT_MINUTES', 30))
+        self.opens = time.fromisoformat(app.config.get('CLINIC_OPENS', '08:00'))
+        self.closes = time.fromisoformat(app.config.get('CLINIC_CLOSES', '17:00'))
+        self.ttl = app.config.get('SLOT_INDEX_TTL', self.ttl)
+        self.horizon = timedelta(days=app.config.get('SLOT_HORIZON_DAYS', 60))
+
+    def _load(self, doctor_id):
+        '''
+        reads the doctor's upcoming appointment times, a range scan on
+        the (doctor_id, starts_at) index
+        '''
+        from models import db, Appointment
+
+        today = datetime.combine(datetime.now().date(), time())
+        rows = db.session.query(Appointment.starts_at).filter(
+            Appointment.doctor_id == doctor_id,
+            Appointment.starts_at >= today).order_by(Appointment.starts_at)
+        return [starts_at for starts_at, in rows]
+
+    def booked(self, doctor_id):
+        '''
+        the sorted start times of the doctor's upcoming appointments
+        '''
+        now = clock.monotonic()
+        with self._lock:
+            entry = self._booked.get(doctor_id)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+
+        booked = self._load(doctor_id)
+        with self._lock:
+            self._booked[doctor_id] = (booked, now + self.ttl)
+        return booked
+
+    def is_slot(self, starts_at):
+        '''
+        whether starts_at is the start of a slot of the clinic day
+        '''
+        opening = datetime.combine(starts_at.date(), self.opens)
+        closing = datetime.combine(starts_at.date(), self.closes)
+        return (opening <= starts_at and starts_at + self.slot <= closing
+                and (starts_at - opening) % self.slot == timedelta(0))
+
+    def is_free(self, doctor_id, starts_at):
+        '''
+        whether no appointment of the doctor overlaps the slot at starts_at
+        '''
+        booked = self.booked(doctor_id)
+        i = bisect.bisect_right(booked, starts_at - self.slot)
+        return i == len(booked) or booked[i] >= starts_at + self.slot
+
+    def _first_slot(self, after):
+        '''
+        the first slot starting at or after the given time
+        '''
+        opening = datetime.combine(after.date(), self.opens)
+        if after <= opening:
+            return opening
+        slots = -((opening - after) // self.slot)
+        start = opening + slots * self.slot
+        if start + self.slot > datetime.combine(after.date(), self.closes):
+            return opening + timedelta(days=1)
+        return start
+
+    def free_slots(self, doctor_id, after, count):
+        '''
+        the next `count` free slots of the doctor starting at or after
+        `after`, looking no further than SLOT_HORIZON_DAYS ahead
+        '''
+        booked = self.booked(doctor_id)
+        limit = after + self.horizon
+        slot = self._first_slot(after)
+        i = bisect.bisect_right(booked, slot - self.slot)
+
+        free = []
+        while len(free) < count and slot < limit:
+            if slot + self.slot > datetime.combine(slot.date(), self.closes):
+                slot = self._first_slot(datetime.combine(slot.date() + timedelta(days=1), time()))
+                continue
+            while i < len(booked) and booked[i] <= slot - self.slot:
+                i += 1
+            if i == len(booked) or booked[i] >= slot + self.slot:
+                free.append(slot)
+            slot += self.slot
+        return free
+
+    def book(self, doctor_id, starts_at):
+        '''
+        records a new booking of the doctor
+        the list is replaced rather than changed in place as other
+        threads may be searching it
+        '''
+        with self._lock:
+            entry = self._booked.get(doctor_id)
+            if entry is not None:
+                booked = list(entry[0])
+                bisect.insort(booked, starts_at)
+                self._booked[doctor_id] = (booked, entry[1])
+
+    def invalidate(self, *doctor_ids):
+        '''
+        drops the given doctors, or every doctor when none is given
+        '''
+        with self._lock:
+            if not doctor_ids:
+                self._booked.clear()
+            for doctor_id in doctor_ids:
+                self._booked.pop(doctor_id, None)
+
+
+slot_index = SlotIndex()
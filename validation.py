@@ -0,0 +1,70 @@
+from datetime import datetime
+
+
+'''
+The fields every new user and appointment must have, shared by the
+signup and booking views and the bulk import
+'''
+USER_FIELDS = ('firstname', 'lastname', 'email', 'gender', 'password', 'phonenumber', 'status')
+APPOINTMENT_FIELDS = ('firstname', 'lastname', 'gender', 'starts_at', 'phone_number',
+                      'doctor_id', 'patient_id', 'condition')
+PRESCRIPTION_FIELDS = ('drug', 'quantity', 'condition', 'patient_id', 'doctor_id')
+
+'''
+The kind of accounts that can sign up by themselves
+admins are created through the admin signup view
+'''
+SIGNUP_STATUSES = ('doctor', 'patient')
+
+
+def missing_fields(data, fields):
+    '''
+    returns the fields that are missing or empty in data
+    '''
+    return [field for field in fields if not data.get(field)]
+
+
+def validate_user(data, statuses=SIGNUP_STATUSES):
+    '''
+    checks a new user, returns the error message or None
+    '''
+    if missing_fields(data, USER_FIELDS):
+        return "Enter all required fields"
+    if data['status'] not in statuses:
+        return "Unknown account type"
+    return None
+
+
+def parse_starts_at(value):
+    '''
+    parses an appointment time as sent by the booking form or found in
+    an import file, returns None when it cannot be read
+    '''
+    if isinstance(value, datetime):
+        return value
+    for date_format in ('%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value, date_format)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def validate_appointment(data):
+    '''
+    checks a new appointment, returns the error message or None
+    '''
+    if missing_fields(data, APPOINTMENT_FIELDS):
+        return "Enter all required fields"
+    if parse_starts_at(data['starts_at']) is None:
+        return "Enter a valid date and time"
+    return None
+
+
+def validate_prescription(data):
+    '''
+    checks a new prescription, returns the error message or None
+    '''
+    if missing_fields(data, PRESCRIPTION_FIELDS):
+        return "Enter all required fields"
+    return None
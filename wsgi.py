@@ -0,0 +1,6 @@
+'''
+The WSGI entry point: gunicorn --config gunicorn.conf.py wsgi:application
+'''
+from application import create_app
+
+application = app = create_app()